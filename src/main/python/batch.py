@@ -0,0 +1,283 @@
+"""Headless batch rendering for DART Viewer
+
+Renders the plots of many netCDF files without a display, using the same
+subsetting and plotting code as the GUI and the Agg backend of matplotlib.
+Files are rendered in parallel by a pool of processes::
+
+    python batch.py "obs_seq/*.nc" --variable observation -o plots \\
+        --groups /Purple --bbox 0 90 -30 30 --qc 0 1
+"""
+
+# Standard library imports
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+# Plotting library imports
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure  # noqa: E402
+from matplotlib.backends.backend_agg import FigureCanvasAgg  # noqa: E402
+
+# Local imports
+from utils.io import DatasetHandle  # noqa: E402
+from utils.cache import get_summary  # noqa: E402
+from utils.subset import (  # noqa: E402
+    SubsetQuery, SubsetError, EMPTY_SUBSET_MESSAGE, select_rows)
+from utils.chunked import load_subset  # noqa: E402
+from utils.plot import (  # noqa: E402
+    Geo3DPlot, DensityPlot, QCTimeSeriesPlot, QCCountsPlot)
+
+PLOT_KINDS = ('geo3d', 'density', 'timeseries', 'qccounts')
+
+
+def render_file(path, query, variable, output_dir, plots=PLOT_KINDS,
+                image_format='png'):
+    """Subset one file and save its plots as images
+
+    :param path: Path of the netCDF file
+    :type path: str
+    :param query: The subset
+    :type query: utils.subset.SubsetQuery
+    :param variable: Name of the variable to plot
+    :type variable: str
+    :param output_dir: Directory where the images are written
+    :type output_dir: str
+    :param plots: Kinds of plots to render, see :data:`PLOT_KINDS`
+    :type plots: Iterable of str, optional
+    :param image_format: Format of the images, e.g. ``"png"`` or ``"pdf"``
+    :type image_format: str, optional
+    :return: The path of the file, the number of observations plotted
+        (a sample when the subset does not fit in the memory budget), the
+        written images and the time in seconds spent on each step. A file
+        where the subset is empty is ``skipped`` and has no images.
+    :rtype: dict
+    """
+    timings = dict()
+    start = time.perf_counter()
+
+    def lap(step):
+        nonlocal start
+        now = time.perf_counter()
+        timings[step] = now - start
+        start = now
+
+    with DatasetHandle(path) as handle:
+        summary = get_summary(handle)
+        lap('open')
+        try:
+            rows = select_rows(handle, query, summary)
+        except SubsetError as error:
+            if str(error) != EMPTY_SUBSET_MESSAGE:
+                raise
+            lap('subset')
+            return {'path': path,
+                    'n_obs': 0,
+                    'bytes_read': handle.bytes_read,
+                    'images': [],
+                    'skipped': True,
+                    'timings': timings}
+        qc_counts = summary.qc_index.counts_of(rows)
+        dataset, density = load_subset(handle.dataset, rows,
+                                       {variable, 'qc'})
+        lap('subset')
+
+        stem = os.path.splitext(os.path.basename(path))[0]
+        images = []
+        for kind in plots:
+            figure = Figure(dpi=100)
+            FigureCanvasAgg(figure)
+            if kind == 'geo3d':
+                Geo3DPlot(figure).update(dataset, variable)
+            elif kind == 'density' and density is not None:
+                DensityPlot(figure).show_grid(density)
+            elif kind == 'density':
+                DensityPlot(figure).update(dataset)
+            elif kind == 'timeseries':
+                QCTimeSeriesPlot(figure).update(dataset)
+            else:
+                QCCountsPlot(figure).update(qc_counts)
+            image = os.path.join(output_dir, '{}_{}.{}'.format(
+                stem, kind, image_format))
+            figure.savefig(image)
+            images.append(image)
+            lap(kind)
+
+        return {'path': path,
+                'n_obs': dataset.sizes['obs'],
+                'bytes_read': handle.bytes_read,
+                'images': images,
+                'timings': timings}
+
+
+def _render_task(path, query, variable, output_dir, plots, image_format):
+    """Run :func:`render_file` in a worker process, turning failures into
+    a result so that one bad file does not stop the batch
+    """
+    start = time.perf_counter()
+    try:
+        result = render_file(path, query, variable, output_dir, plots,
+                             image_format)
+    except Exception as error:  # pylint: disable=broad-except
+        result = {'path': path, 'error': str(error) or type(error).__name__,
+                  'timings': dict()}
+    result['timings']['total'] = time.perf_counter() - start
+    return result
+
+
+def render_files(paths, query, variable, output_dir, plots=PLOT_KINDS,
+                 image_format='png', workers=None, report=None):
+    """Render many files in parallel
+
+    :param paths: Paths of the netCDF files
+    :type paths: List of strings
+    :param workers: Number of worker processes, by default one per CPU
+    :type workers: int, optional
+    :param report: Called with the result of each file as it completes
+    :type report: callable, optional
+    :return: The result of :func:`render_file` for each file, in the order
+        of ``paths``. Files that failed have an ``error`` instead.
+    :rtype: List of dict
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    results = dict()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_render_task, path, query, variable,
+                                   output_dir, tuple(plots), image_format)
+                   for path in paths]
+        for future in as_completed(futures):
+            result = future.result()
+            results[result['path']] = result
+            if report is not None:
+                report(result)
+    return [results[path] for path in paths]
+
+
+def format_result(result):
+    """Return a one line report of the result of one file
+
+    :rtype: str
+    """
+    timings = ', '.join('{} {:.2f}s'.format(step, seconds)
+                        for step, seconds in result['timings'].items())
+    if 'error' in result:
+        return '{}: FAILED ({}) {}'.format(
+            result['path'], result['error'], timings)
+    if result.get('skipped'):
+        return '{}: 0 observations, skipped, {}'.format(
+            result['path'], timings)
+    return '{}: {} obs, {:.1f} MB read, {}'.format(
+        result['path'], result['n_obs'], result['bytes_read'] / 1e6,
+        timings)
+
+
+def build_query(args):
+    """Build the subset described by the command line arguments
+
+    :rtype: utils.subset.SubsetQuery
+    """
+    return SubsetQuery(
+        groups=args.groups,
+        operator=args.operator,
+        bbox=args.bbox,
+        time_range=tuple(None if time in ('', 'none') else np.datetime64(time)
+                         for time in args.time) if args.time else None,
+        qc=args.qc,
+        radius=args.radius)
+
+
+def parse_args(argv=None):
+    """Parse the command line
+
+    :rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Render DART Viewer plots for many netCDF files "
+                    "without a display.")
+    parser.add_argument(
+        'patterns', nargs='+', metavar='PATTERN',
+        help="netCDF files, or glob patterns matching them")
+    parser.add_argument(
+        '-v', '--variable', required=True, help="Variable to plot")
+    parser.add_argument(
+        '-o', '--output-dir', default='.',
+        help="Directory where the images are written")
+    parser.add_argument(
+        '--plots', nargs='+', choices=PLOT_KINDS, default=list(PLOT_KINDS),
+        help="Plots to render (default: all)")
+    parser.add_argument(
+        '--format', default='png', help="Image format (default: png)")
+    parser.add_argument(
+        '-j', '--workers', type=int, default=None,
+        help="Number of worker processes (default: one per CPU)")
+    parser.add_argument(
+        '--memory-budget', type=float, metavar='MB',
+        help="Largest subset loaded into memory; larger subsets are "
+             "sampled and rasterized in chunks (default: 512)")
+    parser.add_argument(
+        '--timings', metavar='FILE',
+        help="Also write the results and timings of every file as JSON")
+
+    subset = parser.add_argument_group('subset')
+    subset.add_argument(
+        '--groups', nargs='+', default=[], metavar='GROUP',
+        help="Paths of the groups to plot, e.g. /Purple")
+    subset.add_argument(
+        '--operator', choices=('and', 'or'), default='or',
+        help="Combine the groups with and/or (default: or)")
+    subset.add_argument(
+        '--bbox', nargs=4, type=float,
+        metavar=('LON_MIN', 'LON_MAX', 'LAT_MIN', 'LAT_MAX'),
+        help="Lon/lat box; LON_MIN > LON_MAX crosses the dateline")
+    subset.add_argument(
+        '--time', nargs=2, metavar=('START', 'END'),
+        help="Time window in ISO 8601, 'none' for an open end")
+    subset.add_argument(
+        '--qc', nargs='+', type=int, metavar='FLAG',
+        help="DART QC flags to keep")
+    subset.add_argument(
+        '--radius', nargs=3, type=float, metavar=('LON', 'LAT', 'KM'),
+        help="Keep the observations within KM km of a point")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Entry point of the batch renderer
+
+    :return: Exit status, 1 if any file failed; files where the subset
+        is empty are skipped and do not fail
+    :rtype: int
+    """
+    args = parse_args(argv)
+    paths = sorted({path for pattern in args.patterns
+                    for path in (glob.glob(pattern) or [pattern])})
+    query = build_query(args)
+    if args.memory_budget:
+        # Read by utils.chunked.memory_budget in the worker processes
+        os.environ['DART_VIEWER_MEMORY_BUDGET'] = str(args.memory_budget)
+
+    start = time.perf_counter()
+    results = render_files(
+        paths, query, args.variable, args.output_dir, args.plots,
+        args.format, args.workers,
+        report=lambda result: print(format_result(result), flush=True))
+    failed = [result for result in results if 'error' in result]
+    skipped = [result for result in results if result.get('skipped')]
+    print('{} files rendered in {:.2f}s, {} skipped, {} failed'.format(
+        len(results) - len(failed) - len(skipped),
+        time.perf_counter() - start, len(skipped), len(failed)))
+
+    if args.timings:
+        with open(args.timings, 'w') as timings_file:
+            json.dump(results, timings_file, indent=2, default=int)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
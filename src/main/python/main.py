@@ -4,31 +4,57 @@
 # Standard library imports
 import sys
 import os
-import re
-from functools import reduce
 import numpy as np
 
-# NetCDF library imports
-import xarray as xr
-from netCDF4 import Dataset
-
 # PyQt5 library imports
 from PyQt5.QtWidgets import (
     QMainWindow,
     QFileDialog,
     QDialog,
-    QCheckBox,
-    QErrorMessage)
-from PyQt5.QtCore import QRegExp
-from PyQt5.QtGui import QRegExpValidator
+    QHeaderView,
+    QErrorMessage,
+    QProgressBar,
+    QPushButton,
+    QDockWidget,
+    QTabWidget,
+    QTableWidget,
+    QTableWidgetItem,
+    QWidget,
+    QVBoxLayout,
+    QHBoxLayout)
+from PyQt5.QtCore import QRegExp, QLocale, Qt, QTimer
+from PyQt5.QtGui import QRegExpValidator, QDoubleValidator
 from fbs_runtime.application_context.PyQt5 import (
     ApplicationContext, cached_property)
 
+# Plotting library imports
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_qt5agg import (
+    FigureCanvasQTAgg, NavigationToolbar2QT)
+
 # Local imports
 from ui.main_window import Ui_MainWindow
 from ui.subset_dialog import Ui_subset_dialog
-from utils.io import walktree
-from utils.plot import geo_3d_plot, time_series_qc_plot, qc_observations_plot
+from utils.io import DatasetHandle
+from utils.group_model import GroupTreeModel
+from utils.metadata_model import MetadataModel
+from utils.cache import get_summary
+from utils.coastlines import land_polygons
+from utils.catalog import FileCollection
+from utils.jobs import JobManager, JobCancelled
+from utils.subset import SubsetQuery, SubsetCache, SubsetError, select_rows
+from utils.chunked import load_subset
+from utils.plot import Geo3DPlot, DensityPlot, QCTimeSeriesPlot, \
+    QCCountsPlot
+from utils.trace import TRACER, span
+
+# Index of the density map in the plot mode combo box
+DENSITY_MAP_MODE = 1
+# Columns of the table of the performance dock
+PERFORMANCE_COLUMNS = ("Span", "Calls", "Total (ms)", "Mean (ms)",
+                       "Max (ms)", "Rows", "MB read")
+# Milliseconds between refreshes of the performance dock
+PERFORMANCE_REFRESH_MS = 1000
 
 
 class AppContext(ApplicationContext):
@@ -71,6 +97,14 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.setupUi(self)
         self.ctx = ctx
         self.subset_dialog = SubsetDialog()
+        self.handle = None
+        self.collection = None
+        self.group_model = None
+        # Rows selected by earlier plots of the current file(s)
+        self.subset_cache = SubsetCache()
+        self.setup_job_widgets()
+        self.setup_plot_widgets()
+        self.setup_performance_widgets()
         self.setup_slots()
         self.setup_validators()
         self.open_file_dialog()
@@ -94,6 +128,24 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                 QRegExp("[0-9]+"),
                 self.obsIndexInput))
 
+        # Coordinates are parsed with float(), so the decimal point is
+        # always "." whatever the locale, without group separators
+        locale = QLocale.c()
+        locale.setNumberOptions(QLocale.RejectGroupSeparator)
+        dialog = self.subset_dialog
+        for line_edit, bottom, top in (
+                (dialog.lon_min_input, -360.0, 360.0),
+                (dialog.lon_max_input, -360.0, 360.0),
+                (dialog.lat_min_input, -90.0, 90.0),
+                (dialog.lat_max_input, -90.0, 90.0),
+                (dialog.center_lon_input, -360.0, 360.0),
+                (dialog.center_lat_input, -90.0, 90.0),
+                (dialog.radius_input, 0.0, 1e6)):
+            validator = QDoubleValidator(bottom, top, 6, line_edit)
+            validator.setLocale(locale)
+            validator.setNotation(QDoubleValidator.StandardNotation)
+            line_edit.setValidator(validator)
+
     def show_error_messages(self, error_message):
         """This function display an error message dialog to the user
 
@@ -105,68 +157,326 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         error_dialog.showMessage(error_message)
         error_dialog.exec_()
 
+    def setup_job_widgets(self):
+        """This function adds a progress bar and a cancel button to the status
+        bar. They are only visible while background jobs are running.
+        """
+        self.jobs = JobManager(self)
+        self.progressBar = QProgressBar(self.statusbar)
+        self.progressBar.setMaximumWidth(150)
+        self.cancelButton = QPushButton("Cancel", self.statusbar)
+        self.statusbar.addPermanentWidget(self.progressBar)
+        self.statusbar.addPermanentWidget(self.cancelButton)
+        self.progressBar.hide()
+        self.cancelButton.hide()
+
+        self.cancelButton.clicked.connect(lambda: self.jobs.cancel())
+        self.jobs.busy.connect(self.progressBar.setVisible)
+        self.jobs.busy.connect(self.cancelButton.setVisible)
+        self.jobs.progress.connect(
+            lambda name, percent: self.progressBar.setValue(percent))
+
+    def setup_plot_widgets(self):
+        """This function adds a dock with one tab per plot. The plots are
+        created the first time they are drawn and then updated in place.
+        """
+        self.plotTabs = QTabWidget()
+        self.plotDock = QDockWidget("Plots", self)
+        self.plotDock.setWidget(self.plotTabs)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.plotDock)
+        self.plotDock.hide()
+        self.plots = dict()
+
+    def setup_performance_widgets(self):
+        """This function adds a dock showing where the time goes, from the
+        spans recorded by :data:`utils.trace.TRACER`. Recording can be
+        switched on and off and the spans exported as Chrome trace events.
+        The dock is shown from the Help menu.
+        """
+        self.performanceTable = QTableWidget(0, len(PERFORMANCE_COLUMNS))
+        self.performanceTable.setHorizontalHeaderLabels(PERFORMANCE_COLUMNS)
+        self.performanceTable.horizontalHeader().setSectionResizeMode(
+            0, QHeaderView.Stretch)
+        self.performanceTable.verticalHeader().hide()
+        self.performanceTable.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.recordButton = QPushButton("Record")
+        self.recordButton.setCheckable(True)
+        self.recordButton.setChecked(TRACER.enabled)
+        clear_button = QPushButton("Clear")
+        export_button = QPushButton("Export...")
+
+        panel = QWidget()
+        layout = QVBoxLayout(panel)
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.recordButton)
+        buttons.addWidget(clear_button)
+        buttons.addWidget(export_button)
+        buttons.addStretch()
+        layout.addLayout(buttons)
+        layout.addWidget(self.performanceTable)
+        self.performanceDock = QDockWidget("Performance", self)
+        self.performanceDock.setWidget(panel)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.performanceDock)
+        self.performanceDock.hide()
+        self.menuHelp.addAction(self.performanceDock.toggleViewAction())
+
+        self.recordButton.toggled.connect(
+            lambda checked: setattr(TRACER, 'enabled', checked))
+        clear_button.clicked.connect(lambda: TRACER.clear())
+        clear_button.clicked.connect(lambda: self.show_performance(True))
+        export_button.clicked.connect(lambda: self.export_trace())
+        self.performanceDock.visibilityChanged.connect(
+            lambda visible: self.show_performance() if visible else None)
+        self._performance_shown = -1
+        self.performanceTimer = QTimer(self)
+        self.performanceTimer.timeout.connect(lambda: self.show_performance())
+        self.performanceTimer.start(PERFORMANCE_REFRESH_MS)
+
+    def show_performance(self, force=False):
+        """Fill the table of the performance dock with the recorded spans,
+        if the dock is visible and spans were recorded since it was filled
+
+        :param force: Whether to fill the table in any case
+        :type force: bool, optional
+        """
+        if not force and (not self.performanceDock.isVisible() or
+                          self._performance_shown == TRACER.n_recorded):
+            return
+        self._performance_shown = TRACER.n_recorded
+        summary = TRACER.summary()
+        self.performanceTable.setRowCount(len(summary))
+        for row, (name, entry) in enumerate(summary.items()):
+            counters = entry['counters']
+            rows = counters.get('rows_out', counters.get('rows'))
+            values = [
+                name, str(entry['calls']),
+                "{:.1f}".format(entry['total'] * 1e3),
+                "{:.1f}".format(entry['total'] * 1e3 / entry['calls']),
+                "{:.1f}".format(entry['max'] * 1e3),
+                '' if rows is None else str(rows),
+                "{:.1f}".format(counters['bytes_read'] / 1e6)
+                if 'bytes_read' in counters else '']
+            for column, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                if column > 0:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.performanceTable.setItem(row, column, item)
+
+    def export_trace(self):
+        """Ask for a file and write the recorded spans to it as Chrome trace
+        events, which chrome://tracing and Perfetto can show
+        """
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        path, _ = QFileDialog.getSaveFileName(
+            self, "Export Trace", "trace.json",
+            "JSON Files (*.json);;All Files (*)", options=options)
+        if not path:
+            return
+        try:
+            TRACER.export_chrome(path)
+        except OSError as error:
+            self.show_error_messages(
+                "Unable to export the trace: {}".format(error))
+            return
+        self.statusbar.showMessage("Trace written to {}".format(path))
+
+    def get_plot(self, title, plot_class):
+        """Return the plot shown in the tab called ``title``, creating the
+        tab with a new ``plot_class`` plot if needed
+
+        :param title: Title of the tab
+        :type title: str
+        :param plot_class: Class of the plot, see utils.plot.FigurePlot
+        :type plot_class: type
+        :rtype: utils.plot.FigurePlot
+        """
+        if title not in self.plots:
+            canvas = PlotCanvas(Figure(dpi=100), title)
+            if plot_class is Geo3DPlot:
+                plot = plot_class(canvas.figure, load_land=self.load_land)
+            else:
+                plot = plot_class(canvas.figure, blit=True)
+            tab = QWidget()
+            layout = QVBoxLayout(tab)
+            layout.addWidget(NavigationToolbar2QT(canvas, tab))
+            layout.addWidget(canvas)
+            self.plotTabs.addTab(tab, title)
+            self.plots[title] = (plot, tab)
+        return self.plots[title][0]
+
+    def load_land(self, resolution, on_loaded, on_failed):
+        """Build the land polygons of a plot in the background, see
+        :class:`utils.plot.Geo3DPlot`. If they cannot be built, e.g. without
+        network access on a cold cache, the plot keeps its current ones.
+
+        :param resolution: Natural Earth resolution of the polygons
+        :type resolution: str
+        :param on_loaded: Called with the polygons
+        :type on_loaded: callable
+        :param on_failed: Called with an error message, or None if the job
+            was cancelled
+        :type on_failed: callable
+        """
+        def on_error(message):
+            self.statusbar.showMessage(
+                "Unable to draw the {} coastlines: {}".format(
+                    resolution, message))
+            on_failed(message)
+        job = self.jobs.submit("land", load_land_polygons, resolution,
+                               on_result=on_loaded, on_error=on_error)
+        job.signals.finished.connect(
+            lambda: job.is_cancelled and on_failed(None))
+
     def open_file_dialog(self):
-        """Open a dialog for user to chose their dataset
+        """Open a dialog for user to chose their dataset. The file is then
+        opened in the background. Choosing several files opens them as one
+        collection, see :class:`utils.catalog.FileCollection`.
         """
         try:
             if os.environ['DEVELOPMENT'] == "true":
-                dataset_path = os.environ['TEST_FILE']
+                dataset_paths = os.environ['TEST_FILE'].split(os.pathsep)
         except KeyError:
             options = QFileDialog.Options()
             options |= QFileDialog.DontUseNativeDialog
-            dataset_path, _ = QFileDialog.getOpenFileName(
-                self, "Open NetCDF File", "",
+            dataset_paths, _ = QFileDialog.getOpenFileNames(
+                self, "Open NetCDF Files", "",
                 "NetCDF Files (*.nc);;All Files (*)", options=options)
-        try:
-            self.dataset = xr.open_dataset(dataset_path, decode_times=True)
-            self.root_group = Dataset(dataset_path, "r", format="NETCDF4")
-            self.ds_group_list = ['root']
-            # A dictionary that maps group_name (str()) to QCheckbox type
-            self.group_dict = dict()
-            self.show_dataset_info()
-        except OSError:
-            error_message = "Invalid. Please choose a different file"
-            self.show_error_messages(error_message)
+        dataset_paths = [path for path in dataset_paths if path]
+        if not dataset_paths:
+            return
+        if len(dataset_paths) == 1:
+            self.statusbar.showMessage("Opening {}".format(
+                os.path.basename(dataset_paths[0])))
+            self.jobs.submit(
+                "open", load_file, dataset_paths[0],
+                on_result=self.on_file_loaded,
+                on_error=lambda message: self.show_error_messages(
+                    "Invalid. Please choose a different file"),
+                supersedes=("plot",))
+        else:
+            self.statusbar.showMessage("Opening {} files".format(
+                len(dataset_paths)))
+            self.jobs.submit(
+                "open", load_files, dataset_paths,
+                on_result=self.on_files_loaded,
+                on_error=lambda message: self.show_error_messages(
+                    "Invalid. Please choose different files"),
+                supersedes=("plot",))
+
+    def close_files(self):
+        """Close the current file or collection of files. A superseded job
+        still reading them stops with :class:`utils.io.FileClosedError`
+        at its next read, since handles are closed under their lock.
+        """
+        if self.collection is not None:
+            self.collection.close()
+        elif self.handle is not None:
+            self.handle.close()
+        self.collection = None
+        self.handle = None
+        self.subset_cache.clear()
+
+    def on_file_loaded(self, result):
+        """Replace the current file with a file opened by :func:`load_file`
+
+        :param result: The new handle and the summary of the file
+        :type result: tuple
+        """
+        handle, summary = result
+        self.close_files()
+        self.handle = handle
+        self.dataset = handle.dataset
+        self.root_group = handle.root_group
+        self.summary = summary
+        self.group_tree = summary.group_tree
+        self.membership_index = summary.membership_index
+        self.extents = summary.extents
+        self.show_dataset_info()
+        self.show_bytes_read()
+
+    def on_files_loaded(self, collection):
+        """Replace the current file with a collection of files opened by
+        :func:`load_files`. The header and the variables shown are those of
+        the first file of the collection.
+
+        :param collection: The new collection
+        :type collection: utils.catalog.FileCollection
+        """
+        self.close_files()
+        self.collection = collection
+        # The file shown stays open however many files the subsets read
+        self.handle, self.summary = collection.acquire(collection.paths[0])
+        self.dataset = self.handle.dataset
+        self.root_group = self.handle.root_group
+        self.group_tree = collection.group_tree
+        self.membership_index = None
+        self.extents = collection.extents
+        self.show_dataset_info()
+        self.show_bytes_read()
+
+    def show_bytes_read(self):
+        """Display in the status bar how much data has been read from the
+        current file (or files) so far
+        """
+        if self.collection is not None:
+            self.statusbar.showMessage("Read {:.1f} MB from {} files".format(
+                self.collection.bytes_read / 1e6,
+                len(self.collection.paths)))
+            return
+        self.statusbar.showMessage("Read {:.1f} MB from {}".format(
+            self.handle.bytes_read / 1e6, os.path.basename(self.handle.path)))
 
     def show_dataset_info(self):
         """
         Display the general information about the dataset and list all the
         variables on the GUI
         """
-        self.headerContents.setText(str(self.dataset))
-        self.variableList.clear()
-        self.variableList.addItems(list(self.dataset.data_vars))
-        ds_group_list_temp = []
-        for children in walktree(self.root_group):
-            for child in children:
-                ds_group_list_temp.append(child.path)
-        self.ds_group_list += sorted(ds_group_list_temp)
-
-        for group in self.ds_group_list:
-            self.group_dict[group] = QCheckBox(self.groupListFrame)
-            self.verticalLayout.addWidget(self.group_dict[group])
-            self.group_dict[group].setObjectName('{}_checkbox'.format(group))
-            self.group_dict[group].setText(group)
+        with span('show_dataset_info', groups=len(self.group_tree)):
+            old_model = self.headerContents.model()
+            self.headerContents.setModel(MetadataModel(self.handle, self))
+            self.headerContents.header().setSectionResizeMode(
+                QHeaderView.ResizeToContents)
+            if old_model is not None:
+                old_model.deleteLater()
+            self.variableList.clear()
+            self.variableList.addItems(list(self.dataset.data_vars))
+
+            # The rows of the group tree are created as the user expands it
+            n_obs = len(self.collection) if self.collection is not None \
+                else self.summary.n_obs
+            old_model = self.group_model
+            self.group_model = GroupTreeModel(self.group_tree, n_obs, self)
+            self.groupTreeView.setModel(self.group_model)
+            self.groupTreeView.header().setSectionResizeMode(
+                0, QHeaderView.Stretch)
+            self.groupTreeView.header().setStretchLastSection(False)
+            self.groupTreeView.expand(self.group_model.node_index(0))
+            if old_model is not None:
+                old_model.deleteLater()
 
     def show_parent_groups(self):
         """Display all the groups that an observation is in based on user's
-        input of observation index
+        input of observation index. The groups come from the membership index
+        built when the file was opened, so no group is read again. In a
+        collection of files, observations are numbered across the files in
+        time order.
         """
-
+        if not self.obsIndexInput.text():
+            return
         obs_index = int(self.obsIndexInput.text())
         self.parentGroupList.clear()
-
-        for group in self.ds_group_list:
-            try:
-                obs_id = self.root_group['{}/obs_id'.format(
-                    group)][:].compressed()
-                if obs_index == obs_id[np.searchsorted(obs_id, obs_index)]:
-                    self.parentGroupList.addItem(group)
-            except BaseException:
-                continue
+        with span('show_parent_groups') as current:
+            if self.collection is not None:
+                groups = self.collection.groups_of(obs_index)
+            else:
+                groups = self.membership_index.groups_of(obs_index)
+            self.parentGroupList.addItems(groups)
+            current.set('rows', len(groups))
 
         if self.parentGroupList.count() == 0:
             self.parentGroupList.addItem("No groups available")
+        self.show_bytes_read()
 
     def get_selected_var(self):
         """Get variable selection from user input
@@ -182,224 +492,299 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                 "Please choose a variable from the list to plot")
 
     def get_selected_groups(self):
-        """Get group selection from user input
+        """Get group selection from user input. With "or", a checked group
+        stands for all of its descendants, which are not listed; with "and",
+        the checked groups without children are listed, since they are the
+        groups intersected. A checked ``root`` selects the whole file, see
+        :meth:`utils.group_model.GroupTreeModel.checked_paths`.
 
         :return: list of group names
         :rtype: Python list with type str()
         """
-        list_of_checked = []
-        for checkbox_string in self.group_dict:
-            checkbox = self.group_dict[checkbox_string]
-            if checkbox.isChecked():
-                list_of_checked.append(checkbox_string)
-        return list_of_checked
+        if self.group_model is None:
+            return []
+        return sorted(self.group_model.checked_paths(
+            leaves=self.and_radioButton.isChecked()))
 
     def setup_subset_dialog_ui(self):
         """This function pre-fills the min and max values for time, lat and lon
         input fields
         """
-        time = self.dataset['time'].values
-        time_max = max(time)
-        time_min = min(time)
+        time_min, time_max = self.extents['time']
         self.subset_dialog.time_max_input.setPlaceholderText(
             np.datetime_as_string(time_max, unit='s'))
         self.subset_dialog.time_min_input.setPlaceholderText(
             np.datetime_as_string(time_min, unit='s'))
 
+        lon_min, lon_max = self.extents['lon']
         self.subset_dialog.lon_max_input.setPlaceholderText(
-            str(np.around(max(self.dataset['lon'].values), decimals=2)))
+            str(np.around(lon_max, decimals=2)))
         self.subset_dialog.lon_min_input.setPlaceholderText(
-            str(np.around(min(self.dataset['lon'].values), decimals=2)))
+            str(np.around(lon_min, decimals=2)))
 
+        lat_min, lat_max = self.extents['lat']
         self.subset_dialog.lat_max_input.setPlaceholderText(
-            str(np.around(max(self.dataset['lat'].values), decimals=2)))
+            str(np.around(lat_max, decimals=2)))
         self.subset_dialog.lat_min_input.setPlaceholderText(
-            str(np.around(min(self.dataset['lat'].values), decimals=2)))
-
-        # TODO: connect the following buttons to the right slots
-        self.subset_dialog.buttonBox.accepted.connect(
-            lambda: print("accepted"))
-        self.subset_dialog.buttonBox.rejected.connect(lambda: print("denied"))
-
-    def get_dataset_subset(self):
-        """Displays the subset dialog, takes user input, and returns the new
-        dataset subset.
+            str(np.around(lat_min, decimals=2)))
 
-        The function is broken down into four helper functions, which helps
-        subset the dataset based on groups, location, time, and QC Values.
+    def get_subset_query(self):
+        """Displays the subset dialog and builds the subset query from the
+        user input.
 
-        :param dataset: the original dataset
-        :type dataset: xr.Dataset()
-        :return: the new dataset after subsetting
-        :rtype: xr.Dataset()
+        :return: the group, location, time and QC selection
+        :rtype: utils.subset.SubsetQuery
+        :raises SubsetError: if a coordinate is not a number in range, a
+            time is not a date, or the circle is missing its center or its
+            radius
         """
         self.setup_subset_dialog_ui()
         self.subset_dialog.exec_()
 
-        def subset_group(dataset):
-            checked_group_list = self.get_selected_groups()
-            if not checked_group_list:
-                return dataset
-
-            def get_obs_id_list(checked_group_list):
-                """Given a list of checked groups, this function returns a list
-                of obs_id arrays in those groups.
-
-                :param checked_group_list: List of groups that user selected
-                :type checked_group_list: List of strings
-                :return: A list of obs_id arrays in those groups
-                :rtype: List of lists
-                """
-                obs_id_list = []
-                final_list = checked_group_list.copy()
-
-                for group in checked_group_list:
-                    if self.root_group['{}'.format(group)].groups:
-                        new_list = [
-                            x for x in self.ds_group_list if re.search(
-                                r'^{}/+'.format(group), x)]
-                        final_list.remove(group)
-                        final_list += new_list
-                for group in final_list:
-                    obs_id = self.root_group['{}/obs_id'.format(
-                        group)][:].compressed()
-                    obs_id_list.append(obs_id)
-
-                return obs_id_list
-
-            if self.and_radioButton.isChecked():
-                if len(checked_group_list) < 2:
-                    self.show_error_messages("Please select at least 2 groups")
-                    return
-                if "root" in checked_group_list:
-                    checked_group_list.remove("root")
-                obs_index_array = reduce(
-                    np.intersect1d, get_obs_id_list(checked_group_list))
-            else:
-                if "root" in checked_group_list:
-                    return dataset
-                obs_index_array = np.unique(np.concatenate(
-                    get_obs_id_list(checked_group_list)))
-
-            dataset = dataset.loc[dict(obs=obs_index_array)]
-            if dataset['obs'].values.size:
-                return dataset
-            else:
-                self.show_error_messages(
-                    "No observation values satisfy user input range")
-
-        def subset_location(dataset):
-            (lon_max_input,
-             lat_max_input,
-             lon_min_input,
-             lat_min_input) = (self.subset_dialog.lon_max_input.text(),
-                               self.subset_dialog.lat_max_input.text(),
-                               self.subset_dialog.lon_min_input.text(),
-                               self.subset_dialog.lat_min_input.text())
-            if lon_max_input:
-                lon_max = float(lon_max_input)
-                dataset = dataset.where(
-                    lon_max >= dataset.coords['lon'], drop=True)
-            if lon_min_input:
-                lon_min = float(lon_min_input)
-                dataset = dataset.where(
-                    lon_min <= dataset.coords['lon'], drop=True)
-            if lat_max_input:
-                lat_max = float(lat_max_input)
-                dataset = dataset.where(
-                    lat_max >= dataset.coords['lat'], drop=True)
-            if lat_min_input:
-                lat_min = float(lat_min_input)
-                dataset = dataset.where(
-                    lat_min <= dataset.coords['lat'], drop=True)
-
-            if dataset['obs'].values.size:
-                return dataset
-            else:
-                self.show_error_messages(
-                    "No observation values satisfy user input range")
-
-        def subset_time(dataset):
-            (time_max_input,
-             time_min_input) = (self.subset_dialog.time_max_input.text(),
-                                self.subset_dialog.time_min_input.text())
-            if time_max_input:
-                time_max_input = np.datetime64(time_max_input)
-                dataset = dataset.where(
-                    time_max_input >= dataset['time'], drop=True)
-            if time_min_input:
-                time_min_input = np.datetime64(time_min_input)
-                dataset = dataset.where(
-                    time_min_input <= dataset['time'], drop=True)
-
-            if dataset['obs'].values.size:
-                return dataset
-            else:
-                self.show_error_messages(
-                    "No observation values satisfy user input range")
-            return dataset
-
-        def subset_qc(dataset):
-            list_of_checked = []
-            list_of_checkboxes = [self.subset_dialog.qc_checkbox_0,
-                                  self.subset_dialog.qc_checkbox_1,
-                                  self.subset_dialog.qc_checkbox_2,
-                                  self.subset_dialog.qc_checkbox_3,
-                                  self.subset_dialog.qc_checkbox_4,
-                                  self.subset_dialog.qc_checkbox_5,
-                                  self.subset_dialog.qc_checkbox_6,
-                                  self.subset_dialog.qc_checkbox_7,
-                                  self.subset_dialog.qc_checkbox_8]
-
-            for box in list_of_checkboxes:
-                if box.isChecked():
-                    list_of_checked.append(
-                        list_of_checkboxes.index(box))
-
-            # If none of the boxes is checked, then treat it like box "All" is
-            # checked
-            if (not list_of_checked) or (8 in list_of_checked):
-                return dataset
-
-            obs_index_array = np.concatenate([np.where(dataset['qc'].T[1].values == i)[
-                0] for i in list_of_checked], axis=0)
-
-            dataset = dataset.loc[dict(obs=obs_index_array)]
-            if dataset['obs'].values.size:
-                return dataset
-            else:
-                self.show_error_messages(
-                    "No observation values satisfy user input range")
-
-        return subset_time(
-            subset_qc(
-                subset_location(
-                    subset_group(
-                        self.dataset))))
+        def to_float(line_edit):
+            if not line_edit.text():
+                return None
+            # A validator still lets through partial input such as "-"
+            if not line_edit.hasAcceptableInput():
+                raise SubsetError("Invalid number: {}".format(
+                    line_edit.text()))
+            return float(line_edit.text())
+
+        def to_datetime(line_edit, name):
+            if not line_edit.text():
+                return None
+            try:
+                return np.datetime64(line_edit.text())
+            except ValueError:
+                raise SubsetError(
+                    "Invalid {}: {}. Enter a date such as {}".format(
+                        name, line_edit.text(),
+                        line_edit.placeholderText()))
+
+        list_of_checkboxes = [self.subset_dialog.qc_checkbox_0,
+                              self.subset_dialog.qc_checkbox_1,
+                              self.subset_dialog.qc_checkbox_2,
+                              self.subset_dialog.qc_checkbox_3,
+                              self.subset_dialog.qc_checkbox_4,
+                              self.subset_dialog.qc_checkbox_5,
+                              self.subset_dialog.qc_checkbox_6,
+                              self.subset_dialog.qc_checkbox_7,
+                              self.subset_dialog.qc_checkbox_8]
+        list_of_checked = [index for index, box in
+                           enumerate(list_of_checkboxes) if box.isChecked()]
+        # If none of the boxes is checked, then treat it like box "All" is
+        # checked
+        if (not list_of_checked) or (8 in list_of_checked):
+            list_of_checked = None
+
+        radius = (to_float(self.subset_dialog.center_lon_input),
+                  to_float(self.subset_dialog.center_lat_input),
+                  to_float(self.subset_dialog.radius_input))
+
+        if None in radius and any(value is not None for value in radius):
+            raise SubsetError(
+                "Please enter the center lon, center lat and radius of the "
+                "circle, or none of them")
+
+        return SubsetQuery(
+            groups=self.get_selected_groups(),
+            operator='and' if self.and_radioButton.isChecked() else 'or',
+            bbox=(to_float(self.subset_dialog.lon_min_input),
+                  to_float(self.subset_dialog.lon_max_input),
+                  to_float(self.subset_dialog.lat_min_input),
+                  to_float(self.subset_dialog.lat_max_input)),
+            time_range=(to_datetime(self.subset_dialog.time_min_input,
+                                    "start time"),
+                        to_datetime(self.subset_dialog.time_max_input,
+                                    "end time")),
+            qc=list_of_checked,
+            radius=radius if None not in radius else None)
 
     def master_plot(self):
         """Generate all the necessary plots for a single netCDF file
 
+        The subset and the plot data are prepared in the background; a newer
+        plot request cancels an older one that is still running. Filters
+        that did not change since an earlier plot are not evaluated again,
+        see :class:`utils.subset.SubsetCache`.
+        """
+        try:
+            query = self.get_subset_query()
+        except SubsetError as error:
+            self.show_error_messages(str(error))
+            return
+        variable = self.get_selected_var()
+        if self.collection is not None:
+            self.jobs.submit(
+                "plot", prepare_collection_plot_data, self.collection, query,
+                variable, self.subset_cache,
+                on_result=lambda result: self.draw_plots(*result, variable),
+                on_error=self.show_error_messages)
+            return
+        self.jobs.submit(
+            "plot", prepare_plot_data, self.handle, self.summary, query,
+            variable, self.subset_cache,
+            on_result=lambda result: self.draw_plots(*result, variable),
+            on_error=self.show_error_messages)
+
+    def draw_plots(self, dataset, qc_counts, density, variable):
+        """Draw the plots for a subset prepared by :func:`prepare_plot_data`.
+        When the subset was too large to load, ``dataset`` is a sample of it
+        and ``density`` its precomputed density raster.
+
         The plots generated are:
-        - Geo 3D Plot
+        - Geo 3D Plot, or a density map of the observations, depending on
+          the selected plot mode
         - Time series of quality control values
         - Counts of observations based on QC Values
+
+        Every plot is embedded in a tab of the plot dock and updated in
+        place.
         """
-        dataset = self.get_dataset_subset()
-        variable = self.get_selected_var()
+        with span('draw_plots', rows=dataset.sizes['obs']):
+            self._draw_plots(dataset, qc_counts, density, variable)
 
-        if dataset['obs'].values.size:
+    def _draw_plots(self, dataset, qc_counts, density, variable):
+        if self.plotModeComboBox.currentIndex() == DENSITY_MAP_MODE:
+            title = "Density Map"
             try:
-                geo_3d_plot(dataset, variable)
+                plot = self.get_plot(title, DensityPlot)
+                if density is None:
+                    plot.update(dataset)
+                else:
+                    plot.show_grid(density)
+            except BaseException:
+                self.show_error_messages("Unable to produce Density Map.")
+        else:
+            title = "Geo 3D Plot"
+            try:
+                self.get_plot(title, Geo3DPlot).update(dataset, variable)
             except BaseException:
                 error_message = "Unable to produce plots Geo 3D Plot.\n\
-                    Perhaps the variable that you chose is not compatible"
+                Perhaps the variable that you chose is not compatible"
                 self.show_error_messages(error_message)
-            time_series_qc_plot(dataset)
-            qc_observations_plot(dataset)
-        else:
-            self.show_error_messages(
-                "No observation values satisfy user input range")
+        self.get_plot("QC Time Series", QCTimeSeriesPlot).update(dataset)
+        self.get_plot("QC Counts", QCCountsPlot).update(qc_counts)
+        if title in self.plots:
+            self.plotTabs.setCurrentWidget(self.plots[title][1])
+        self.plotDock.show()
+        self.show_bytes_read()
+
+
+def load_file(job, dataset_path):
+    """Job function that opens a file and gets its summary, from the cache if
+    the file has not changed since it was last opened
+
+    :param job: The running job
+    :type job: utils.jobs.Job
+    :param dataset_path: Path of the netCDF file
+    :type dataset_path: str
+    :return: The handle and the summary of the file
+    :rtype: tuple
+    """
+    with span('load_file', file=os.path.basename(dataset_path)):
+        with span('DatasetHandle'):
+            handle = DatasetHandle(dataset_path, decode_times=True)
+        try:
+            job.report_progress(10)
+            summary = get_summary(
+                handle, progress=lambda percent: job.report_progress(
+                    10 + percent * 0.9))
+            job.report_progress(100)
+        except JobCancelled:
+            handle.close()
+            raise
+    return handle, summary
+
+
+def load_land_polygons(job, resolution):
+    """Job function that builds the land polygons of a resolution, see
+    :func:`utils.coastlines.land_polygons`
+
+    :param job: The running job
+    :type job: utils.jobs.Job
+    :param resolution: Natural Earth resolution of the polygons
+    :type resolution: str
+    :rtype: list
+    """
+    with span('load_land_polygons', resolution=resolution):
+        polys = land_polygons(resolution)
+    job.report_progress(100)
+    return polys
+
+
+def prepare_plot_data(job, handle, summary, query, variable, cache=None):
+    """Job function that subsets the dataset and loads the variables needed
+    for plotting into memory. A subset that does not fit in the memory
+    budget is reduced instead, see :func:`utils.chunked.load_subset`.
+    The subset starts from the rows of earlier queries kept in ``cache``.
+
+    :return: The subset (or a sample of it), with ``variable`` and ``qc``
+        loaded, the number of observations of each DART QC flag in it and
+        its density raster, or None if the whole subset was loaded
+    :rtype: tuple
+    """
+    with span('prepare_plot_data'):
+        rows = select_rows(
+            handle, query, summary,
+            progress=lambda percent: job.report_progress(percent * 0.8),
+            cache=cache)
+        with span('QCIndex.counts_of'):
+            qc_counts = summary.qc_index.counts_of(rows)
+        dataset, density = load_subset(
+            handle.dataset, rows, {variable, 'qc'},
+            progress=lambda percent: job.report_progress(80 + percent * 0.2))
+        job.report_progress(100)
+    return dataset, qc_counts, density
+
+
+def load_files(job, dataset_paths):
+    """Job function that opens a collection of files. Only the files that
+    are not in the catalog, or that changed since, are scanned.
+
+    :param job: The running job
+    :type job: utils.jobs.Job
+    :param dataset_paths: Paths of the netCDF files
+    :type dataset_paths: List of strings
+    :rtype: utils.catalog.FileCollection
+    """
+    with span('load_files', files=len(dataset_paths)):
+        collection = FileCollection.open(dataset_paths,
+                                         progress=job.report_progress)
+        # Open the first file here rather than on the GUI thread
+        collection.get(collection.paths[0])
+    return collection
+
+
+def prepare_collection_plot_data(job, collection, query, variable,
+                                 cache=None):
+    """Job function that subsets the files of a collection that overlap the
+    time window of the query and loads the variables needed for plotting
+
+    :return: See :meth:`utils.catalog.FileCollection.subset`
+    :rtype: tuple
+    """
+    with span('prepare_collection_plot_data'):
+        return collection.subset(query, {variable, 'qc'},
+                                 progress=job.report_progress, cache=cache)
+
+
+class PlotCanvas(FigureCanvasQTAgg):
+    """Canvas of a plot of the plot dock, whose rendering is traced
+
+    :param figure: Figure drawn on the canvas
+    :type figure: matplotlib.figure.Figure
+    :param title: Title of the plot, which names the rendering spans
+    :type title: str
+    """
+
+    def __init__(self, figure, title):
+        super(PlotCanvas, self).__init__(figure)
+        self.span_name = "render {}".format(title)
+
+    def draw(self):
+        with span(self.span_name):
+            super(PlotCanvas, self).draw()
 
 
 class SubsetDialog(QDialog, Ui_subset_dialog):
@@ -34,8 +34,9 @@ class Ui_MainWindow(object):
         self.headerLabel = QtWidgets.QLabel(self.headerFrame)
         self.headerLabel.setObjectName("headerLabel")
         self.gridLayout.addWidget(self.headerLabel, 0, 0, 1, 1)
-        self.headerContents = QtWidgets.QTextBrowser(self.headerFrame)
+        self.headerContents = QtWidgets.QTreeView(self.headerFrame)
         self.headerContents.setStyleSheet("background-color: rgb(244, 255, 245)")
+        self.headerContents.setUniformRowHeights(True)
         self.headerContents.setObjectName("headerContents")
         self.gridLayout.addWidget(self.headerContents, 1, 0, 1, 1)
         self.parentGroupFrame = QtWidgets.QFrame(self.centralwidget)
@@ -95,18 +96,15 @@ class Ui_MainWindow(object):
         self.groupBox_2.setObjectName("groupBox_2")
         self.verticalLayout_2 = QtWidgets.QVBoxLayout(self.groupBox_2)
         self.verticalLayout_2.setObjectName("verticalLayout_2")
-        self.groupListFrame = QtWidgets.QFrame(self.groupBox_2)
+        self.groupTreeView = QtWidgets.QTreeView(self.groupBox_2)
         sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Expanding)
         sizePolicy.setHorizontalStretch(0)
         sizePolicy.setVerticalStretch(20)
-        sizePolicy.setHeightForWidth(self.groupListFrame.sizePolicy().hasHeightForWidth())
-        self.groupListFrame.setSizePolicy(sizePolicy)
-        self.groupListFrame.setFrameShape(QtWidgets.QFrame.StyledPanel)
-        self.groupListFrame.setFrameShadow(QtWidgets.QFrame.Raised)
-        self.groupListFrame.setObjectName("groupListFrame")
-        self.verticalLayout = QtWidgets.QVBoxLayout(self.groupListFrame)
-        self.verticalLayout.setObjectName("verticalLayout")
-        self.verticalLayout_2.addWidget(self.groupListFrame)
+        sizePolicy.setHeightForWidth(self.groupTreeView.sizePolicy().hasHeightForWidth())
+        self.groupTreeView.setSizePolicy(sizePolicy)
+        self.groupTreeView.setUniformRowHeights(True)
+        self.groupTreeView.setObjectName("groupTreeView")
+        self.verticalLayout_2.addWidget(self.groupTreeView)
         self.groupBox_4 = QtWidgets.QGroupBox(self.groupBox_2)
         sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Fixed)
         sizePolicy.setHorizontalStretch(0)
@@ -123,6 +121,11 @@ class Ui_MainWindow(object):
         self.or_radioButton.setObjectName("or_radioButton")
         self.verticalLayout_2.addWidget(self.groupBox_4)
         self.verticalLayout_3.addWidget(self.groupBox_2)
+        self.plotModeComboBox = QtWidgets.QComboBox(self.widget)
+        self.plotModeComboBox.setObjectName("plotModeComboBox")
+        self.plotModeComboBox.addItem("")
+        self.plotModeComboBox.addItem("")
+        self.verticalLayout_3.addWidget(self.plotModeComboBox)
         self.plotButton = QtWidgets.QPushButton(self.widget)
         self.plotButton.setObjectName("plotButton")
         self.verticalLayout_3.addWidget(self.plotButton)
@@ -191,6 +194,8 @@ class Ui_MainWindow(object):
         self.groupBox_4.setTitle(_translate("MainWindow", "Selection Options"))
         self.and_radioButton.setText(_translate("MainWindow", "and"))
         self.or_radioButton.setText(_translate("MainWindow", "or"))
+        self.plotModeComboBox.setItemText(0, _translate("MainWindow", "3D Scatter"))
+        self.plotModeComboBox.setItemText(1, _translate("MainWindow", "Density Map"))
         self.plotButton.setText(_translate("MainWindow", "Plot"))
         self.menuFile.setTitle(_translate("MainWindow", "File"))
         self.menuPlot.setTitle(_translate("MainWindow", "Plot"))
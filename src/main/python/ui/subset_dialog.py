@@ -13,7 +13,7 @@ from PyQt5 import QtCore, QtGui, QtWidgets
 class Ui_subset_dialog(object):
     def setupUi(self, subset_dialog):
         subset_dialog.setObjectName("subset_dialog")
-        subset_dialog.resize(388, 459)
+        subset_dialog.resize(388, 559)
         self.gridLayout_2 = QtWidgets.QGridLayout(subset_dialog)
         self.gridLayout_2.setObjectName("gridLayout_2")
         self.buttonBox = QtWidgets.QDialogButtonBox(subset_dialog)
@@ -66,6 +66,24 @@ class Ui_subset_dialog(object):
         self.lon_min_label = QtWidgets.QLabel(self.frame)
         self.lon_min_label.setObjectName("lon_min_label")
         self.gridLayout.addWidget(self.lon_min_label, 0, 0, 1, 1)
+        self.center_lon_label = QtWidgets.QLabel(self.frame)
+        self.center_lon_label.setObjectName("center_lon_label")
+        self.gridLayout.addWidget(self.center_lon_label, 6, 0, 1, 1)
+        self.center_lat_label = QtWidgets.QLabel(self.frame)
+        self.center_lat_label.setObjectName("center_lat_label")
+        self.gridLayout.addWidget(self.center_lat_label, 6, 1, 1, 1)
+        self.center_lon_input = QtWidgets.QLineEdit(self.frame)
+        self.center_lon_input.setObjectName("center_lon_input")
+        self.gridLayout.addWidget(self.center_lon_input, 7, 0, 1, 1)
+        self.center_lat_input = QtWidgets.QLineEdit(self.frame)
+        self.center_lat_input.setObjectName("center_lat_input")
+        self.gridLayout.addWidget(self.center_lat_input, 7, 1, 1, 1)
+        self.radius_label = QtWidgets.QLabel(self.frame)
+        self.radius_label.setObjectName("radius_label")
+        self.gridLayout.addWidget(self.radius_label, 8, 0, 1, 1)
+        self.radius_input = QtWidgets.QLineEdit(self.frame)
+        self.radius_input.setObjectName("radius_input")
+        self.gridLayout.addWidget(self.radius_input, 9, 0, 1, 1)
         self.verticalLayout = QtWidgets.QVBoxLayout()
         self.verticalLayout.setObjectName("verticalLayout")
         self.qc_values_label = QtWidgets.QLabel(self.frame)
@@ -98,7 +116,7 @@ class Ui_subset_dialog(object):
         self.qc_checkbox_7 = QtWidgets.QCheckBox(self.frame)
         self.qc_checkbox_7.setObjectName("qc_checkbox_7")
         self.verticalLayout.addWidget(self.qc_checkbox_7)
-        self.gridLayout.addLayout(self.verticalLayout, 6, 0, 1, 2)
+        self.gridLayout.addLayout(self.verticalLayout, 10, 0, 1, 2)
         self.gridLayout_2.addWidget(self.frame, 0, 0, 1, 1)
 
         self.retranslateUi(subset_dialog)
@@ -115,6 +133,9 @@ class Ui_subset_dialog(object):
         self.time_min_label.setText(_translate("subset_dialog", "Time min"))
         self.time_max_label.setText(_translate("subset_dialog", "Time max"))
         self.lon_min_label.setText(_translate("subset_dialog", "Lon min"))
+        self.center_lon_label.setText(_translate("subset_dialog", "Center lon"))
+        self.center_lat_label.setText(_translate("subset_dialog", "Center lat"))
+        self.radius_label.setText(_translate("subset_dialog", "Radius around point (km)"))
         self.qc_values_label.setText(_translate("subset_dialog", "DART QC Values"))
         self.qc_checkbox_8.setText(_translate("subset_dialog", "All"))
         self.qc_checkbox_0.setText(_translate("subset_dialog", "Assimilated"))
@@ -0,0 +1,391 @@
+"""This module contains the on-disk cache of per-file summaries (group list,
+group membership index and coordinate extents), so that a file that has not
+changed since it was last opened does not have to be scanned again.
+
+Cache files live in the user cache directory, one ``.npz`` file per netCDF
+file. The directory can be overridden with the ``DART_VIEWER_CACHE_DIR``
+environment variable.
+"""
+
+import os
+import sys
+import hashlib
+import tempfile
+import numpy as np
+
+# Local imports
+from utils.io import GroupTree
+from utils.index import GroupMembershipIndex, GroupBitmaps, TimeIndex, \
+    QCIndex
+from utils.spatial import GridIndex
+from utils.trace import span
+
+CACHE_VERSION = 5
+# Number of bins of the coordinate histograms
+HISTOGRAM_BINS = 64
+# Number of bytes hashed at the start and at the end of a file
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def default_cache_dir():
+    """Return the directory where cache files are stored
+
+    :rtype: str
+    """
+    if os.environ.get('DART_VIEWER_CACHE_DIR'):
+        return os.environ['DART_VIEWER_CACHE_DIR']
+    if sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    elif sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME',
+                              os.path.expanduser('~/.cache'))
+    return os.path.join(base, 'dart_viewer')
+
+
+def file_key(path):
+    """Return what identifies the current version of a file: its absolute
+    path, size, modification time and a hash of its content. Only the first
+    and last ``HASH_BLOCK_SIZE`` bytes are hashed, so the key stays cheap for
+    multi-GB files.
+
+    :param path: Path of the netCDF file
+    :type path: str
+    :rtype: dict
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    digest = hashlib.sha1(str(stat.st_size).encode())
+    with open(path, 'rb') as nc_file:
+        digest.update(nc_file.read(HASH_BLOCK_SIZE))
+        if stat.st_size > 2 * HASH_BLOCK_SIZE:
+            nc_file.seek(-HASH_BLOCK_SIZE, os.SEEK_END)
+            digest.update(nc_file.read(HASH_BLOCK_SIZE))
+    return {'path': path,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'hash': digest.hexdigest()}
+
+
+def cache_path(path, cache_dir=None):
+    """Return the cache file used for a netCDF file
+
+    :rtype: str
+    """
+    name = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(cache_dir or default_cache_dir(), name + '.npz')
+
+
+class FileSummary(object):
+    """Everything about a file that needs a full scan to compute: the tree of
+    all groups, the group membership index, the sorted time index, the
+    DART QC index, the extents of the lon, lat and time coordinates and
+    histograms of lon, lat and time.
+
+    :param group_tree: Tree of all groups in the file
+    :type group_tree: utils.io.GroupTree
+    :param membership_index: Observation to group membership index
+    :type membership_index: utils.index.GroupMembershipIndex
+    :param extents: (min, max) of ``lon``, ``lat`` and ``time``
+    :type extents: dict
+    :param histograms: (bin edges, counts) of ``lon``, ``lat`` and ``time``
+        (in nanoseconds since the epoch)
+    :type histograms: dict
+    :param n_obs: Number of observations in the file
+    :type n_obs: int
+    :param time_index: Sorted observation times
+    :type time_index: utils.index.TimeIndex
+    :param qc_index: Observations grouped by DART QC flag
+    :type qc_index: utils.index.QCIndex
+    """
+
+    def __init__(self, group_tree, membership_index, extents, histograms,
+                 n_obs, time_index, qc_index):
+        self.group_tree = group_tree
+        self.membership_index = membership_index
+        self.time_index = time_index
+        self.qc_index = qc_index
+        self.extents = extents
+        self.histograms = histograms
+        self.n_obs = n_obs
+        self._group_bitmaps = None
+        self._spatial_index = None
+
+    @property
+    def group_paths(self):
+        """Sorted paths of all groups in the file
+
+        :rtype: List of strings
+        """
+        return self.group_tree.paths
+
+    @property
+    def group_bitmaps(self):
+        """Group bitmaps derived from the membership index on first use
+
+        :rtype: utils.index.GroupBitmaps
+        """
+        if self._group_bitmaps is None:
+            self._group_bitmaps = GroupBitmaps(self.membership_index)
+        return self._group_bitmaps
+
+    def spatial_index(self, handle):
+        """Spatial index of the observations, built from the lon and lat
+        coordinates of ``handle`` on first use
+
+        The coordinates are read in chunks within the memory budget, but
+        the index keeps the position, lon and lat of every observation,
+        24 bytes per observation, and needs about three times as much
+        while it is built.
+
+        :param handle: Handle of the file this summary belongs to
+        :type handle: utils.io.DatasetHandle
+        :rtype: utils.spatial.GridIndex
+        """
+        if self._spatial_index is None:
+            coordinates = read_whole(handle.dataset, ('lon', 'lat'))
+            self._spatial_index = GridIndex(coordinates['lon'],
+                                            coordinates['lat'])
+        return self._spatial_index
+
+    @classmethod
+    def build(cls, handle, progress=None):
+        """Scan the file behind ``handle``
+
+        :param handle: Handle of the open file
+        :type handle: utils.io.DatasetHandle
+        :param progress: Called with a percentage as the scan advances
+        :type progress: callable, optional
+        :rtype: FileSummary
+        """
+        def report(percent):
+            if progress is not None:
+                progress(percent)
+
+        group_tree = GroupTree.harvest(handle)
+        report(10)
+
+        # Imported here since utils.chunked depends on utils.subset, which
+        # depends on this module
+        from utils.chunked import chunk_rows, iter_chunks
+
+        # lon, lat, time and qc are read in chunks within the memory budget.
+        # Only the indexes are held in memory as a whole, the largest being
+        # the time index: 8 bytes per observation, 16 if the file is not in
+        # time order.
+        dataset = handle.dataset
+        size = chunk_rows(dataset, ('lon', 'lat', 'time', 'qc'))
+        extents = dict()
+        histograms = dict()
+        for name in ('lon', 'lat'):
+            extents[name] = tuple(function([
+                function(chunk[name]) for chunk
+                in iter_chunks(dataset, None, (name,), size)])
+                for function in (np.nanmin, np.nanmax))
+            edges = np.linspace(extents[name][0], extents[name][1],
+                                HISTOGRAM_BINS + 1)
+            counts = sum(np.histogram(chunk[name], bins=edges)[0] for chunk
+                         in iter_chunks(dataset, None, (name,), size))
+            histograms[name] = (edges, counts)
+        time_index = TimeIndex.from_times(
+            read_whole(dataset, ('time',), size)['time'])
+        extents['time'] = time_index.extent()
+        counts, edges = np.histogram(time_index.values.astype(np.int64),
+                                     bins=HISTOGRAM_BINS)
+        histograms['time'] = (edges, counts)
+        qc_index = QCIndex.from_codes(np.concatenate([
+            QCIndex.encode(chunk['qc'][:, 1])
+            for chunk in iter_chunks(dataset, None, ('qc',), size)]))
+        report(30)
+
+        membership_index = GroupMembershipIndex.build(
+            handle, group_tree,
+            progress=lambda percent: report(30 + percent * 0.7))
+        return cls(group_tree, membership_index, extents, histograms,
+                   handle.dataset.sizes['obs'], time_index, qc_index)
+
+    def to_arrays(self):
+        """Return the summary as a dictionary of numpy arrays
+
+        :rtype: dict
+        """
+        arrays = self.group_tree.to_arrays()
+        arrays.update({
+            'membership_paths': np.array(
+                self.membership_index.group_paths, dtype=str),
+            'membership_offsets': self.membership_index.offsets,
+            'membership_values': self.membership_index.values,
+            'n_obs': np.array(self.n_obs),
+            'time_values': self.time_index.values,
+            'time_sorted': np.array(self.time_index.is_sorted),
+            'qc_offsets': self.qc_index.offsets,
+            'qc_positions': self.qc_index.positions,
+        })
+        if not self.time_index.is_sorted:
+            arrays['time_order'] = self.time_index.order
+        for name, (minimum, maximum) in self.extents.items():
+            arrays['extent_' + name] = np.array([minimum, maximum])
+        for name, (edges, counts) in self.histograms.items():
+            arrays['histogram_edges_' + name] = edges
+            arrays['histogram_counts_' + name] = counts
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Inverse of :meth:`to_arrays`
+
+        :rtype: FileSummary
+        """
+        membership_index = GroupMembershipIndex(
+            [str(path) for path in arrays['membership_paths']],
+            arrays['membership_offsets'],
+            arrays['membership_values'])
+        extents = {name: (arrays['extent_' + name][0],
+                          arrays['extent_' + name][1])
+                   for name in ('lon', 'lat', 'time')}
+        histograms = {name: (arrays['histogram_edges_' + name],
+                             arrays['histogram_counts_' + name])
+                      for name in ('lon', 'lat', 'time')}
+        time_index = TimeIndex(
+            arrays['time_values'],
+            None if bool(arrays['time_sorted']) else arrays['time_order'])
+        return cls(GroupTree.from_arrays(arrays), membership_index, extents,
+                   histograms, int(arrays['n_obs']), time_index,
+                   QCIndex(arrays['qc_offsets'], arrays['qc_positions']))
+
+
+def read_whole(dataset, variables, size=None):
+    """Read whole variables along ``obs`` in chunks into arrays allocated up
+    front, so that reading them takes no more memory than the arrays and
+    one chunk
+
+    :param dataset: The dataset
+    :type dataset: xr.Dataset()
+    :param variables: Names of variables with ``obs`` as only dimension
+    :type variables: Iterable of str
+    :param size: Number of observations per chunk, see
+        :func:`utils.chunked.chunk_rows`
+    :type size: int, optional
+    :return: The values of every variable by name
+    :rtype: dict
+    """
+    # Imported here since utils.chunked depends on utils.subset, which
+    # depends on this module
+    from utils.chunked import chunk_rows, iter_chunks
+
+    if size is None:
+        size = chunk_rows(dataset, variables)
+    arrays = {name: np.empty(dataset.sizes['obs'], dataset[name].dtype)
+              for name in variables}
+    start = 0
+    for chunk in iter_chunks(dataset, None, variables, size):
+        stop = start + len(next(iter(chunk.values())))
+        for name, values in chunk.items():
+            arrays[name][start:stop] = values
+        start = stop
+    return arrays
+
+
+def load_summary(path, cache_dir=None):
+    """Load the cached summary of a file.
+
+    :param path: Path of the netCDF file
+    :type path: str
+    :return: The summary, or None if there is no cache file or if the file
+        has changed since the cache file was written. Stale cache files are
+        removed.
+    :rtype: FileSummary
+    """
+    location = cache_path(path, cache_dir)
+    if not os.path.exists(location):
+        return None
+    key = file_key(path)
+    try:
+        with np.load(location, allow_pickle=False) as cached:
+            # The arrays of an .npz file are read on access, so the key is
+            # checked before anything else is read
+            stored = set(cached.files)
+            stale = 'version' not in stored or \
+                int(cached['version']) != CACHE_VERSION or any(
+                    'key_' + name not in stored or
+                    cached['key_' + name].item() != value
+                    for name, value in key.items())
+            arrays = None if stale else dict(cached.items())
+    except (OSError, ValueError, KeyError):
+        return None
+    if stale:
+        try:
+            os.remove(location)
+        except OSError:
+            pass
+        return None
+    return FileSummary.from_arrays(arrays)
+
+
+def atomic_write(path, writer, mode='wb'):
+    """Write a cache file through a temporary file in the same directory,
+    which then replaces it, so that no reader sees a partly written file.
+    Errors, e.g. a read-only cache directory, are ignored.
+
+    :param path: Path of the file
+    :type path: str
+    :param writer: Called with the open temporary file
+    :type writer: callable
+    :param mode: Mode the temporary file is opened with
+    :type mode: str, optional
+    :return: Whether the file was written
+    :rtype: bool
+    """
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(
+            suffix=os.path.splitext(path)[1], dir=directory)
+    except OSError:
+        return False
+    try:
+        with os.fdopen(file_descriptor, mode) as temp_file:
+            writer(temp_file)
+        os.replace(temp_path, path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+    return True
+
+
+def save_summary(path, summary, cache_dir=None):
+    """Write the summary of a file to the cache, see :func:`atomic_write`
+
+    :param path: Path of the netCDF file
+    :type path: str
+    :param summary: Summary of the file
+    :type summary: FileSummary
+    """
+    location = cache_path(path, cache_dir)
+    arrays = summary.to_arrays()
+    arrays['version'] = np.array(CACHE_VERSION)
+    for name, value in file_key(path).items():
+        arrays['key_' + name] = np.array(value)
+    atomic_write(location, lambda output: np.savez(output, **arrays))
+
+
+def get_summary(handle, cache_dir=None, progress=None):
+    """Return the summary of the file behind ``handle``, from the cache if it
+    is still valid, otherwise by scanning the file and caching the result.
+
+    :param handle: Handle of the open file
+    :type handle: utils.io.DatasetHandle
+    :param progress: Called with a percentage while the file is scanned
+    :type progress: callable, optional
+    :rtype: FileSummary
+    """
+    with span('get_summary') as current:
+        summary = load_summary(handle.path, cache_dir)
+        current.set('cached', summary is not None)
+        if summary is None:
+            with span('FileSummary.build', rows=handle.dataset.sizes['obs']):
+                summary = FileSummary.build(handle, progress)
+            save_summary(handle.path, summary, cache_dir)
+    return summary
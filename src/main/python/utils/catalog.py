@@ -0,0 +1,400 @@
+"""This module contains the multi-file mode: many DART obs_seq files, e.g. the
+output of consecutive assimilation cycles, viewed as one collection of
+observations concatenated along ``obs`` in time order.
+
+A catalog of the time and coordinate extents and the groups of every file is
+kept in the cache directory (see :func:`utils.cache.default_cache_dir`), so a
+collection can be described, and a time window can skip files, without
+opening the files again. Only the files that overlap a subset are opened.
+"""
+
+import os
+import json
+import bisect
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+import numpy as np
+import xarray as xr
+
+# Local imports
+from utils.io import DatasetHandle, GroupTree
+from utils.cache import default_cache_dir, get_summary, atomic_write
+from utils.raster import rasterize
+from utils.subset import SubsetError, EMPTY_SUBSET_MESSAGE, select_rows
+from utils.chunked import load_subset
+from utils.trace import span
+
+CATALOG_VERSION = 2
+CATALOG_FILE = 'catalog.json'
+# Number of files of a collection kept open at the same time
+MAX_OPEN_FILES = 16
+
+
+class FileCatalog(object):
+    """Extents, number of observations and groups of many files.
+
+    An entry is only valid while the size and the modification time of its
+    file are unchanged, which is checked without opening the file.
+
+    :param entries: Entries, by absolute path
+    :type entries: dict
+    :param location: Path of the JSON file the catalog is saved to
+    :type location: str, optional
+    """
+
+    def __init__(self, entries=None, location=None):
+        self.entries = entries if entries is not None else dict()
+        self.location = location
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, cache_dir=None):
+        """Load the catalog from the cache directory. A missing or invalid
+        catalog file gives an empty catalog.
+
+        :rtype: FileCatalog
+        """
+        location = os.path.join(cache_dir or default_cache_dir(),
+                                CATALOG_FILE)
+        try:
+            with open(location) as catalog_file:
+                stored = json.load(catalog_file)
+            if stored.get('version') != CATALOG_VERSION:
+                raise ValueError(location)
+            entries = stored['entries']
+        except (OSError, ValueError, KeyError):
+            entries = dict()
+        return cls(entries, location)
+
+    def get(self, path):
+        """Return the entry of a file, or None if it is missing or stale
+
+        :rtype: dict
+        """
+        path = os.path.abspath(path)
+        entry = self.entries.get(path)
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if (entry['size'], entry['mtime']) != (stat.st_size,
+                                               stat.st_mtime_ns):
+            return None
+        return entry
+
+    def add(self, path, summary):
+        """Add (or replace) the entry of a file from its summary
+
+        :param path: Path of the netCDF file
+        :type path: str
+        :param summary: Summary of the file
+        :type summary: utils.cache.FileSummary
+        :return: The new entry
+        :rtype: dict
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        time_min, time_max = summary.extents['time']
+        entry = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'n_obs': int(summary.n_obs),
+            'time': [str(np.datetime64(time_min, 'ns')),
+                     str(np.datetime64(time_max, 'ns'))],
+            'lon': [float(value) for value in summary.extents['lon']],
+            'lat': [float(value) for value in summary.extents['lat']],
+            'group_paths': list(summary.group_paths),
+            'group_n_obs': [int(n_obs) for n_obs in summary.group_tree.n_obs],
+        }
+        with self._lock:
+            self.entries[path] = entry
+        return entry
+
+    def save(self):
+        """Write the catalog to its JSON file, see
+        :func:`utils.cache.atomic_write`
+        """
+        if self.location is None:
+            return
+        with self._lock:
+            stored = {'version': CATALOG_VERSION,
+                      'entries': dict(self.entries)}
+        atomic_write(self.location,
+                     lambda output: json.dump(stored, output), mode='w')
+
+
+class FileCollection(object):
+    """Many files viewed as one sequence of observations.
+
+    The files are ordered by their first observation time, and observation
+    ``i`` of the collection is observation ``i - offsets[k]`` of file ``k``.
+    The groups of the collection are the union of the groups of its files.
+    Files are opened on demand, and at most :data:`MAX_OPEN_FILES` of them
+    stay open, besides the files pinned with :meth:`acquire` (e.g. the file
+    shown in the main window, or a file being read by a job), which are
+    never closed before :meth:`close`.
+
+    :param paths: Paths of the netCDF files
+    :type paths: List of strings
+    :param catalog: Catalog holding a valid entry for every file
+    :type catalog: FileCatalog
+    :param cache_dir: Directory of the file summaries
+    :type cache_dir: str, optional
+    """
+
+    def __init__(self, paths, catalog, cache_dir=None):
+        self.catalog = catalog
+        self.cache_dir = cache_dir
+        entries = {path: catalog.get(path) for path in paths}
+        self.paths = sorted(paths, key=lambda path: entries[path]['time'][0])
+        self.entries = [entries[path] for path in self.paths]
+        self.offsets = np.concatenate(
+            [[0], np.cumsum([entry['n_obs'] for entry in self.entries])])
+        self.time_ranges = [
+            tuple(np.datetime64(time, 'ns') for time in entry['time'])
+            for entry in self.entries]
+        self._open = OrderedDict()
+        # Number of users of every pinned file
+        self._pins = dict()
+        self._bytes_read_closed = 0
+        self._lock = threading.RLock()
+
+    @classmethod
+    def open(cls, paths, cache_dir=None, progress=None):
+        """Describe a collection of files, reading the catalog and scanning
+        only the files that are not in it (or changed since)
+
+        :param paths: Paths of the netCDF files
+        :type paths: List of strings
+        :param progress: Called with a percentage after each file
+        :type progress: callable, optional
+        :rtype: FileCollection
+        """
+        catalog = FileCatalog.load(cache_dir)
+        changed = False
+        for count, path in enumerate(paths, 1):
+            if catalog.get(path) is None:
+                with DatasetHandle(path) as handle:
+                    catalog.add(path, get_summary(handle, cache_dir))
+                changed = True
+            if progress is not None:
+                progress(100 * count // len(paths))
+        if changed:
+            catalog.save()
+        return cls([os.path.abspath(path) for path in paths], catalog,
+                   cache_dir)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def group_paths(self):
+        """Sorted paths of the groups found in any of the files
+
+        :rtype: List of strings
+        """
+        return sorted(set().union(
+            *[entry['group_paths'] for entry in self.entries]))
+
+    @property
+    def group_tree(self):
+        """Tree of the groups found in any of the files. The ``obs_id``
+        length of a group is summed over the files.
+
+        :rtype: utils.io.GroupTree
+        """
+        n_obs = dict()
+        for entry in self.entries:
+            for path, count in zip(entry['group_paths'],
+                                   entry['group_n_obs']):
+                if count >= 0:
+                    n_obs[path] = n_obs.get(path, 0) + count
+        return GroupTree.from_paths(self.group_paths, n_obs)
+
+    @property
+    def extents(self):
+        """(min, max) of ``lon``, ``lat`` and ``time`` over all the files
+
+        :rtype: dict
+        """
+        extents = {name: (min(entry[name][0] for entry in self.entries),
+                          max(entry[name][1] for entry in self.entries))
+                   for name in ('lon', 'lat')}
+        extents['time'] = (min(start for start, _ in self.time_ranges),
+                           max(end for _, end in self.time_ranges))
+        return extents
+
+    @property
+    def bytes_read(self):
+        """Number of bytes read from all the files so far"""
+        with self._lock:
+            return self._bytes_read_closed + sum(
+                handle.bytes_read for handle, _ in self._open.values())
+
+    def files_overlapping(self, time_min=None, time_max=None):
+        """Return the paths of the files with observations in
+        [time_min, time_max], without opening any file
+
+        :rtype: List of strings
+        """
+        time_min = None if time_min is None else np.datetime64(time_min, 'ns')
+        time_max = None if time_max is None else np.datetime64(time_max, 'ns')
+        return [path for path, (start, end)
+                in zip(self.paths, self.time_ranges)
+                if (time_min is None or end >= time_min) and
+                (time_max is None or start <= time_max)]
+
+    def get(self, path):
+        """Return the handle and the summary of one file, opening it if
+        needed. Unless the file is pinned, the handle is closed once more
+        than :data:`MAX_OPEN_FILES` other files have been opened, so use
+        :meth:`acquire` to keep reading it.
+
+        :rtype: tuple
+        """
+        with self._lock:
+            if path in self._open:
+                self._open.move_to_end(path)
+                return self._open[path]
+            handle = DatasetHandle(path)
+            try:
+                self._open[path] = (
+                    handle, get_summary(handle, self.cache_dir))
+            except BaseException:
+                handle.close()
+                raise
+            self._evict()
+            return self._open[path]
+
+    def acquire(self, path):
+        """Return the handle and the summary of one file, like :meth:`get`,
+        and pin the file open until it is released as many times as it was
+        acquired
+
+        :rtype: tuple
+        """
+        with self._lock:
+            entry = self.get(path)
+            self._pins[path] = self._pins.get(path, 0) + 1
+            return entry
+
+    def release(self, path):
+        """Unpin a file pinned by :meth:`acquire`"""
+        with self._lock:
+            self._pins[path] -= 1
+            if not self._pins[path]:
+                del self._pins[path]
+            self._evict()
+
+    @contextmanager
+    def using(self, path):
+        """Context manager pinning a file while it is read, see
+        :meth:`acquire`
+        """
+        entry = self.acquire(path)
+        try:
+            yield entry
+        finally:
+            self.release(path)
+
+    def _evict(self):
+        """Close the least recently used files that are not pinned, until
+        at most :data:`MAX_OPEN_FILES` files are open
+        """
+        for path in list(self._open):
+            if len(self._open) <= MAX_OPEN_FILES:
+                break
+            if path not in self._pins:
+                handle, _ = self._open.pop(path)
+                self._bytes_read_closed += handle.bytes_read
+                handle.close()
+
+    def groups_of(self, obs_index):
+        """Return the paths of the groups that contain one observation of
+        the collection
+
+        :param obs_index: Observation index in the collection
+        :type obs_index: int
+        :rtype: List of strings
+        """
+        if not 0 <= obs_index < len(self):
+            return []
+        position = bisect.bisect_right(self.offsets, obs_index) - 1
+        with self.using(self.paths[position]) as (_, summary):
+            return summary.membership_index.groups_of(
+                obs_index - int(self.offsets[position]))
+
+    def subset(self, query, variables, progress=None, cache=None):
+        """Subset every file that overlaps the time window of the query and
+        concatenate the results along ``obs``. The subsets of files that do
+        not fit in the memory budget are reduced, see
+        :func:`utils.chunked.load_subset`. Groups are looked up in each file:
+        a file lacking one of the groups combined with "and" contributes no
+        observation, while groups combined with "or" only need to be in some
+        of the files.
+
+        :param query: The subset
+        :type query: utils.subset.SubsetQuery
+        :param variables: Names of the variables loaded into memory
+        :type variables: Iterable of str
+        :param progress: Called with a percentage while each file is read
+        :type progress: callable, optional
+        :param cache: Rows selected by earlier queries, see
+            :func:`utils.subset.select_rows`
+        :type cache: utils.subset.SubsetCache, optional
+        :raises SubsetError: if the query is invalid or the subset is empty
+        :return: The subset (sampled if any file was reduced), the number of
+            observations of each DART QC flag in it and its density raster,
+            or None if the whole subset was loaded
+        :rtype: tuple
+        """
+        query.predicates()
+        paths = self.files_overlapping(*query.time_range)
+        parts = []
+        densities = []
+        qc_counts = 0
+        for count, path in enumerate(paths, 1):
+            file_progress = None
+            if progress is not None:
+                def file_progress(percent, done=count - 1):
+                    progress((100 * done + percent) // len(paths))
+            with span('FileCollection.subset_file',
+                      file=os.path.basename(path)), \
+                    self.using(path) as (handle, summary):
+                try:
+                    rows = select_rows(handle, query, summary, cache=cache)
+                except SubsetError:
+                    # Nothing is selected in this file
+                    pass
+                else:
+                    qc_counts = qc_counts + summary.qc_index.counts_of(rows)
+                    part, density = load_subset(handle.dataset, rows,
+                                                variables,
+                                                progress=file_progress)
+                    parts.append(part)
+                    densities.append(density)
+            if progress is not None:
+                progress(100 * count // len(paths))
+        if not parts:
+            raise SubsetError(EMPTY_SUBSET_MESSAGE)
+        with span('FileCollection.concat', parts=len(parts)):
+            concatenated = xr.concat(parts, dim='obs')
+        density = None
+        if any(part_density is not None for part_density in densities):
+            density = sum(
+                rasterize(part['lon'].values, part['lat'].values)
+                if part_density is None else part_density
+                for part, part_density in zip(parts, densities))
+        return concatenated, qc_counts, density
+
+    def close(self):
+        """Close every open file, pinned or not"""
+        with self._lock:
+            for handle, _ in self._open.values():
+                self._bytes_read_closed += handle.bytes_read
+                handle.close()
+            self._open.clear()
+            self._pins.clear()
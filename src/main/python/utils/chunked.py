@@ -0,0 +1,310 @@
+"""This module contains the out-of-core evaluation of subsets that are too
+large to be loaded into memory.
+
+The selected rows are read along ``obs`` in chunks small enough for the
+memory budget, and every chunk is reduced before the next one is read: it
+is accumulated into a density raster, or only the observations of a sample
+chosen up front are kept. Only the reduced arrays are ever held in memory
+as a whole.
+"""
+
+import os
+import numpy as np
+import xarray as xr
+
+# Local imports
+from utils.lod import DEFAULT_POINT_BUDGET
+from utils.raster import RASTER_SHAPE, GLOBAL_EXTENT, rasterize
+from utils.subset import read_rows
+from utils.trace import traced
+
+# Memory budget, in bytes, of the values of a subset held at the same time
+DEFAULT_MEMORY_BUDGET = 512 * 2 ** 20
+# Coordinates loaded along with the variables of a subset
+COORDINATES = ('lon', 'lat', 'vertical', 'time')
+# Fraction of the budget used by one chunk, leaving room for the copies
+# made while the chunk is reduced
+CHUNK_FRACTION = 0.25
+
+
+def memory_budget():
+    """Return the memory budget: ``DART_VIEWER_MEMORY_BUDGET`` (in MB) if it
+    is set, otherwise :data:`DEFAULT_MEMORY_BUDGET`
+
+    :rtype: int
+    """
+    budget = os.environ.get('DART_VIEWER_MEMORY_BUDGET')
+    if budget:
+        return int(float(budget) * 2 ** 20)
+    return DEFAULT_MEMORY_BUDGET
+
+
+def row_nbytes(dataset, variables):
+    """Return the number of bytes of one observation of ``variables``
+
+    :param dataset: The dataset
+    :type dataset: xr.Dataset()
+    :param variables: Names of variables with ``obs`` as first dimension
+    :type variables: Iterable of str
+    :rtype: int
+    """
+    nbytes = 0
+    for name in set(variables):
+        variable = dataset[name]
+        nbytes += variable.dtype.itemsize * int(np.prod(
+            [size for dim, size in variable.sizes.items() if dim != 'obs']))
+    return nbytes
+
+
+def fits_in_memory(dataset, rows, variables, budget=None):
+    """Whether the values of ``variables`` at ``rows`` fit in the budget
+
+    :param rows: Sorted positions along ``obs``, or None for all of them
+    :type rows: numpy.ndarray
+    :param budget: Memory budget in bytes, by default :func:`memory_budget`
+    :type budget: int, optional
+    :rtype: bool
+    """
+    budget = memory_budget() if budget is None else budget
+    n_rows = dataset.sizes['obs'] if rows is None else rows.size
+    return n_rows * row_nbytes(dataset, variables) <= budget
+
+
+def chunk_rows(dataset, variables, budget=None):
+    """Return the largest number of consecutive observations read at once
+    within the budget
+
+    :rtype: int
+    """
+    budget = memory_budget() if budget is None else budget
+    return max(1, int(budget * CHUNK_FRACTION) //
+               max(1, row_nbytes(dataset, variables)))
+
+
+def iter_chunks(dataset, rows, variables, size, progress=None):
+    """Read ``variables`` at ``rows`` in chunks.
+
+    A chunk holds the selected observations of ``size`` consecutive
+    observations of the file, so that the slice read for it (see
+    :func:`utils.subset.read_rows`) stays within the budget. ``progress``
+    is called before every chunk is read, so a job that raises from it
+    (see :meth:`utils.jobs.Job.report_progress`) stops between chunks.
+
+    :param dataset: The dataset
+    :type dataset: xr.Dataset()
+    :param rows: Sorted positions along ``obs``, or None for all of them
+    :type rows: numpy.ndarray
+    :param variables: Names of variables with ``obs`` as first dimension
+    :type variables: Iterable of str
+    :param size: Number of consecutive observations per chunk, see
+        :func:`chunk_rows`
+    :type size: int
+    :param progress: Called with the percentage of chunks already read
+    :type progress: callable, optional
+    :return: For each chunk, the values of every variable by name
+    :rtype: Iterator of dict
+    """
+    variables = sorted(set(variables))
+    if rows is None:
+        starts = range(0, dataset.sizes['obs'], size)
+        for count, start in enumerate(starts):
+            if progress is not None:
+                progress(100 * count // len(starts))
+            part = slice(start, start + size)
+            yield {name: dataset[name].isel(obs=part).values
+                   for name in variables}
+        return
+    if not rows.size:
+        return
+    boundaries = np.flatnonzero(np.diff(rows // size)) + 1
+    for count, part in enumerate(np.split(rows, boundaries)):
+        if progress is not None:
+            progress(100 * count // (boundaries.size + 1))
+        yield {name: read_rows(dataset[name], part) for name in variables}
+
+
+def sample_rows(rows, n_obs, budget, seed=0):
+    """Choose at most ``budget`` of the selected observations, uniformly.
+    Only arrays of at most twice the size of the sample are allocated, see
+    :func:`sample_positions`.
+
+    :param rows: Sorted positions along ``obs``, or None for all of them
+    :type rows: numpy.ndarray
+    :param n_obs: Number of observations in the file
+    :type n_obs: int
+    :param budget: Largest number of observations kept
+    :type budget: int
+    :param seed: Seed of the sample
+    :type seed: int, optional
+    :return: Sorted positions along ``obs``
+    :rtype: numpy.ndarray
+    """
+    n_rows = n_obs if rows is None else rows.size
+    if n_rows <= budget:
+        return np.arange(n_obs) if rows is None else rows
+    keep = sample_positions(n_rows, budget, np.random.RandomState(seed))
+    return keep if rows is None else rows[keep]
+
+
+def sample_positions(n, k, random):
+    """Choose ``k`` distinct positions out of ``n``, uniformly, without the
+    permutation of all ``n`` positions made by ``RandomState.choice``.
+
+    Positions are drawn with replacement and deduplicated until ``k`` of
+    them are distinct. When more than half of the positions are kept, the
+    ones dropped are drawn instead, so few draws are repeated.
+
+    :param n: Number of positions
+    :type n: int
+    :param k: Number of positions chosen, at most ``n``
+    :type k: int
+    :param random: Source of the random numbers
+    :type random: numpy.random.RandomState
+    :return: Sorted positions
+    :rtype: numpy.ndarray
+    """
+    if 2 * k > n:
+        keep = np.ones(n, dtype=bool)
+        keep[sample_positions(n, n - k, random)] = False
+        return np.flatnonzero(keep)
+    chosen = np.unique(random.randint(0, n, size=k))
+    while chosen.size < k:
+        chosen = np.union1d(chosen,
+                            random.randint(0, n, size=k - chosen.size))
+    return chosen
+
+
+@traced()
+def reduce_subset(dataset, rows, variables, point_budget=DEFAULT_POINT_BUDGET,
+                  budget=None, shape=RASTER_SHAPE, extent=GLOBAL_EXTENT,
+                  progress=None):
+    """Reduce a subset that does not fit in memory to what the plots need:
+    a sample of its observations and the density of all of them.
+
+    :param dataset: The dataset
+    :type dataset: xr.Dataset()
+    :param rows: Sorted positions along ``obs``, or None for all of them
+    :type rows: numpy.ndarray
+    :param variables: Names of the variables of the sample, besides the
+        coordinates
+    :type variables: Iterable of str
+    :param point_budget: Number of observations in the sample
+    :type point_budget: int, optional
+    :param budget: Memory budget in bytes, by default :func:`memory_budget`
+    :type budget: int, optional
+    :param shape: (rows, columns) of the density raster
+    :type shape: tuple, optional
+    :param extent: (lon_min, lon_max, lat_min, lat_max) of the raster
+    :type extent: tuple, optional
+    :param progress: Called with a percentage before every chunk is read
+    :type progress: callable, optional
+    :return: The sample, as a dataset along ``obs``, and the number of
+        observations of the subset in every cell of the raster
+    :rtype: tuple
+    """
+    n_obs = dataset.sizes['obs']
+    counts = np.zeros(shape, dtype=np.int64)
+    coordinates = ('lon', 'lat')
+    # Every observation is read for the raster, only the sample afterwards
+    for chunk in iter_chunks(dataset, rows, coordinates,
+                             chunk_rows(dataset, coordinates, budget),
+                             _scaled(progress, 0, 80)):
+        counts += rasterize(chunk['lon'], chunk['lat'], shape=shape,
+                            extent=extent)
+
+    sample = sample_rows(rows, n_obs, point_budget)
+    return gather_rows(dataset, sample, _with_coordinates(dataset, variables),
+                       budget, _scaled(progress, 80, 100)), counts
+
+
+def _scaled(progress, start, stop):
+    """Map the percentages given to ``progress`` to [start, stop]"""
+    if progress is None:
+        return None
+    return lambda percent: progress(start + (stop - start) * percent // 100)
+
+
+def gather_rows(dataset, rows, variables, budget=None, progress=None):
+    """Read only ``variables`` of the selected observations into memory.
+
+    Every variable is read once, in chunks (see :func:`iter_chunks`), into
+    an array allocated up front for the selected rows; no other variable
+    of the file is read or copied. The ``obs`` labels of the rows and the
+    coordinates of the other dimensions of the variables are kept.
+
+    :param dataset: The dataset
+    :type dataset: xr.Dataset()
+    :param rows: Sorted positions along ``obs``, or None for all of them
+    :type rows: numpy.ndarray
+    :param variables: Names of variables with ``obs`` as first dimension
+    :type variables: Iterable of str
+    :param budget: Memory budget in bytes of a chunk read, by default
+        :func:`memory_budget`
+    :type budget: int, optional
+    :param progress: Called with a percentage before every chunk is read
+    :type progress: callable, optional
+    :rtype: xr.Dataset()
+    """
+    names = sorted(set(variables))
+    n_rows = dataset.sizes['obs'] if rows is None else rows.size
+    arrays = {name: np.empty((n_rows,) + dataset[name].shape[1:],
+                             dtype=dataset[name].dtype)
+              for name in names}
+    start = 0
+    for chunk in iter_chunks(dataset, rows, names,
+                             chunk_rows(dataset, names, budget), progress):
+        stop = start + len(chunk[names[0]])
+        for name in names:
+            arrays[name][start:stop] = chunk[name]
+        start = stop
+
+    coords = dict()
+    if 'obs' in dataset.indexes:
+        labels = dataset.indexes['obs'].values
+        coords['obs'] = labels if rows is None else labels[rows]
+    for name in names:
+        for dim in dataset[name].dims[1:]:
+            if dim in dataset.coords:
+                coords[dim] = dataset[dim].variable.load()
+    data_vars = {name: xr.Variable(dataset[name].dims, arrays[name],
+                                   dataset[name].attrs)
+                 for name in names}
+    return xr.Dataset(data_vars, coords=coords).set_coords(
+        [name for name in names if name in dataset.coords])
+
+
+def _with_coordinates(dataset, variables):
+    """Add the coordinates of :data:`COORDINATES` found in the dataset"""
+    return set(variables).union(
+        name for name in COORDINATES if name in dataset.variables)
+
+
+@traced()
+def load_subset(dataset, rows, variables, budget=None,
+                point_budget=DEFAULT_POINT_BUDGET, progress=None):
+    """Load the variables of a subset into memory if they fit in the budget,
+    otherwise reduce the subset with :func:`reduce_subset`. Only
+    ``variables`` and the coordinates are read, see :func:`gather_rows`.
+
+    :param dataset: The dataset
+    :type dataset: xr.Dataset()
+    :param rows: Sorted positions along ``obs``, or None for all of them
+    :type rows: numpy.ndarray
+    :param variables: Names of the variables to load, besides the
+        coordinates
+    :type variables: Iterable of str
+    :param budget: Memory budget in bytes, by default :func:`memory_budget`
+    :type budget: int, optional
+    :param progress: Called with a percentage before every chunk is read,
+        e.g. :meth:`utils.jobs.Job.report_progress` to stop a cancelled job
+    :type progress: callable, optional
+    :return: The subset, or a sample of it, and the number of observations
+        of the subset in every cell of the density raster, which is None
+        when the whole subset was loaded
+    :rtype: tuple
+    """
+    names = _with_coordinates(dataset, variables)
+    if fits_in_memory(dataset, rows, names, budget):
+        return gather_rows(dataset, rows, names, budget, progress), None
+    return reduce_subset(dataset, rows, variables, point_budget, budget,
+                         progress=progress)
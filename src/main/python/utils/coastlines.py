@@ -0,0 +1,128 @@
+"""This module contains the cache of Natural Earth land polygons drawn under
+the observations.
+
+Loading a Natural Earth feature and projecting its geometries takes seconds,
+so the projected polygons are kept in memory for the lifetime of the process
+and written to the cache directory (see :func:`utils.cache.default_cache_dir`)
+as packed numpy arrays, one file per resolution.
+"""
+
+import os
+import itertools
+import threading
+import numpy as np
+
+# Local imports
+from utils.cache import default_cache_dir, atomic_write
+
+COASTLINE_CACHE_VERSION = 1
+# Natural Earth resolutions, from the coarsest to the finest
+RESOLUTIONS = ('110m', '50m', '10m')
+# Largest lon/lat span (in degrees) drawn with each resolution but the
+# coarsest one
+RESOLUTION_SPANS = {'50m': 60.0, '10m': 15.0}
+
+_POLYGONS = dict()
+_LOCK = threading.Lock()
+
+
+def resolution_for_extent(lon_range, lat_range):
+    """Choose the Natural Earth resolution for the visible region: the finer
+    the zoom, the finer the coastlines
+
+    :param lon_range: (min, max) of the visible longitudes
+    :type lon_range: tuple
+    :param lat_range: (min, max) of the visible latitudes
+    :type lat_range: tuple
+    :rtype: str
+    """
+    span = max(abs(lon_range[1] - lon_range[0]),
+               abs(lat_range[1] - lat_range[0]))
+    for resolution in reversed(RESOLUTIONS[1:]):
+        if span <= RESOLUTION_SPANS[resolution]:
+            return resolution
+    return RESOLUTIONS[0]
+
+
+def land_polygons(resolution='110m', cache_dir=None):
+    """Return the Natural Earth land polygons, projected to PlateCarree.
+
+    The polygons are read from memory, then from the cache directory, and
+    only computed with cartopy if neither has them.
+
+    :param resolution: One of :data:`RESOLUTIONS`
+    :type resolution: str
+    :param cache_dir: Directory of the cache files
+    :type cache_dir: str, optional
+    :return: (n, 2) vertex arrays, which are views into one packed buffer
+    :rtype: List of numpy.ndarray
+    """
+    if resolution not in RESOLUTIONS:
+        raise ValueError("Unknown resolution {}".format(resolution))
+    with _LOCK:
+        if resolution not in _POLYGONS:
+            location = os.path.join(
+                cache_dir or default_cache_dir(),
+                'land_{}_v{}.npz'.format(resolution, COASTLINE_CACHE_VERSION))
+            packed = _load_packed(location)
+            if packed is None:
+                packed = pack_polygons(_project_polygons(resolution))
+                _save_packed(location, packed)
+            _POLYGONS[resolution] = unpack_polygons(*packed)
+        return _POLYGONS[resolution]
+
+
+def pack_polygons(polygons):
+    """Store polygons as one vertex buffer and the offset of each polygon
+
+    :param polygons: (n, 2) vertex arrays
+    :type polygons: List of numpy.ndarray
+    :return: vertices and offsets
+    :rtype: tuple of numpy.ndarray
+    """
+    offsets = np.zeros(len(polygons) + 1, dtype=np.int64)
+    np.cumsum([len(polygon) for polygon in polygons], out=offsets[1:])
+    vertices = np.concatenate(
+        [np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+         for polygon in polygons] or [np.empty((0, 2))])
+    return vertices, offsets
+
+
+def unpack_polygons(vertices, offsets):
+    """Inverse of :func:`pack_polygons`
+
+    :rtype: List of numpy.ndarray
+    """
+    return [vertices[start:end]
+            for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def _project_polygons(resolution):
+    # Cartopy is only needed when the cache is cold
+    import cartopy.feature
+    from cartopy.mpl.patch import geos_to_path
+    import cartopy.crs as ccrs
+
+    target_projection = ccrs.PlateCarree()
+    feature = cartopy.feature.NaturalEarthFeature(
+        'physical', 'land', resolution)
+    geoms = [target_projection.project_geometry(geom, feature.crs)
+             for geom in feature.geometries()]
+    paths = itertools.chain.from_iterable(
+        geos_to_path(geom) for geom in geoms)
+    return list(itertools.chain.from_iterable(
+        path.to_polygons() for path in paths))
+
+
+def _load_packed(location):
+    try:
+        with np.load(location, allow_pickle=False) as cached:
+            return cached['vertices'], cached['offsets']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _save_packed(location, packed):
+    vertices, offsets = packed
+    atomic_write(location, lambda output: np.savez(
+        output, vertices=vertices, offsets=offsets))
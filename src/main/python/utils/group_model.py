@@ -0,0 +1,236 @@
+"""This module contains the item model of the group tree shown in the main
+window. Rows are created only when their parent is expanded, so files with
+thousands of groups open without laying out a widget per group.
+"""
+
+import numpy as np
+
+# PyQt5 library imports
+from PyQt5.QtCore import QAbstractItemModel, QModelIndex, Qt
+
+# Number of children added to the view at a time
+FETCH_BATCH = 256
+# Columns of the model
+COLUMNS = ('Group', 'Observations')
+
+
+class GroupTreeModel(QAbstractItemModel):
+    """Checkable model over a :class:`utils.io.GroupTree`.
+
+    The single top level row is ``root``, the whole file, and the groups of
+    the file are below it. Checking a group checks all of its descendants
+    and a group with only some descendants checked is partially checked.
+    The check states are kept in an array with one entry per node: node 0
+    is ``root`` and node ``i + 1`` is group ``i`` of the tree.
+
+    :param group_tree: The groups of the file
+    :type group_tree: utils.io.GroupTree
+    :param n_obs: Number of observations in the file, shown for ``root``
+    :type n_obs: int, optional
+    :param parent: Parent object
+    :type parent: PyQt5.QtCore.QObject, optional
+    """
+
+    def __init__(self, group_tree, n_obs=-1, parent=None):
+        super(GroupTreeModel, self).__init__(parent)
+        self.tree = group_tree
+        size = len(group_tree) + 1
+        self.parents = np.concatenate([[-1], group_tree.parents + 1])
+        self.n_obs = np.concatenate([[n_obs], group_tree.n_obs])
+        self.states = np.full(size, Qt.Unchecked, dtype=np.uint8)
+
+        # Children of every node in CSR form, and the row of every node
+        # among its siblings
+        self.children = np.argsort(self.parents[1:], kind='mergesort') + 1
+        self.child_offsets = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.parents[1:], minlength=size),
+                  out=self.child_offsets[1:])
+        self.rows = np.zeros(size, dtype=np.int64)
+        self.rows[self.children] = np.arange(size - 1) - \
+            self.child_offsets[self.parents[self.children]]
+        # Number of children of every node that the view knows about
+        self.fetched = np.zeros(size, dtype=np.int64)
+        self._inserting = False
+
+    def node_children(self, node):
+        """Return the child nodes of a node
+
+        :rtype: numpy.ndarray
+        """
+        return self.children[self.child_offsets[node]:
+                             self.child_offsets[node + 1]]
+
+    def path(self, node):
+        """Return the group path of a node, ``"root"`` for node 0
+
+        :rtype: str
+        """
+        return 'root' if node == 0 else self.tree.paths[node - 1]
+
+    def node(self, index):
+        """Return the node of a model index, or -1 for the invisible root"""
+        return int(index.internalId()) if index.isValid() else -1
+
+    def node_index(self, node, column=0):
+        """Return the model index of a node"""
+        return self.createIndex(int(self.rows[node]), column, int(node))
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        node = self.node(parent)
+        if node < 0:
+            return self.createIndex(row, column, 0)
+        return self.createIndex(row, column,
+                                int(self.node_children(node)[row]))
+
+    def parent(self, index):
+        node = self.node(index)
+        if node <= 0:
+            return QModelIndex()
+        return self.node_index(self.parents[node])
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        node = self.node(parent)
+        return 1 if node < 0 else int(self.fetched[node])
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(COLUMNS)
+
+    def hasChildren(self, parent=QModelIndex()):
+        node = self.node(parent)
+        return bool(node < 0 or self.child_offsets[node + 1] >
+                    self.child_offsets[node])
+
+    def canFetchMore(self, parent):
+        node = self.node(parent)
+        # Views may ask for more rows while rows are being inserted
+        if node < 0 or parent.column() != 0 or self._inserting:
+            return False
+        return bool(self.fetched[node] <
+                    self.child_offsets[node + 1] - self.child_offsets[node])
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        node = self.node(parent)
+        total = self.child_offsets[node + 1] - self.child_offsets[node]
+        first = int(self.fetched[node])
+        last = int(min(total, first + FETCH_BATCH)) - 1
+        self._inserting = True
+        self.beginInsertRows(parent, first, last)
+        self.fetched[node] = last + 1
+        self.endInsertRows()
+        self._inserting = False
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return COLUMNS[section]
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if index.column() == 0:
+            flags |= Qt.ItemIsUserCheckable
+        return flags
+
+    def data(self, index, role=Qt.DisplayRole):
+        node = self.node(index)
+        if node < 0:
+            return None
+        if role == Qt.DisplayRole:
+            if index.column() == 0:
+                return 'root' if node == 0 else \
+                    self.tree.paths[node - 1].rsplit('/', 1)[-1]
+            return '' if self.n_obs[node] < 0 else str(self.n_obs[node])
+        if role == Qt.ToolTipRole:
+            return self.path(node)
+        if role == Qt.CheckStateRole and index.column() == 0:
+            return Qt.CheckState(int(self.states[node]))
+        if role == Qt.TextAlignmentRole and index.column() == 1:
+            return Qt.AlignRight | Qt.AlignVCenter
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.CheckStateRole or not index.isValid():
+            return False
+        self.set_checked(self.node(index), value == Qt.Checked)
+        return True
+
+    def set_checked(self, node, checked):
+        """Check or uncheck a node and all of its descendants, and update
+        the state of its ancestors
+
+        :param node: The node
+        :type node: int
+        :param checked: Whether to check the node
+        :type checked: bool
+        """
+        state = Qt.Checked if checked else Qt.Unchecked
+        pending = [node]
+        while pending:
+            current = pending.pop()
+            self.states[current] = state
+            children = self.node_children(current)
+            pending.extend(children)
+            if self.fetched[current]:
+                self.dataChanged.emit(
+                    self.node_index(children[0]),
+                    self.node_index(children[self.fetched[current] - 1]),
+                    [Qt.CheckStateRole])
+        self.dataChanged.emit(self.node_index(node), self.node_index(node),
+                              [Qt.CheckStateRole])
+
+        ancestor = self.parents[node]
+        while ancestor >= 0:
+            states = self.states[self.node_children(ancestor)]
+            if (states == Qt.Checked).all():
+                state = Qt.Checked
+            elif (states == Qt.Unchecked).all():
+                state = Qt.Unchecked
+            else:
+                state = Qt.PartiallyChecked
+            if self.states[ancestor] == state:
+                break
+            self.states[ancestor] = state
+            index = self.node_index(ancestor)
+            self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+            ancestor = self.parents[ancestor]
+
+    def checked_paths(self, leaves=False):
+        """Return the checked groups. Only checked and partially checked
+        branches are visited.
+
+        A checked group stands for all of its descendants, so by default
+        they are left out, and a checked ``root`` stands for the whole file,
+        including the observations that are in no group. With ``leaves``,
+        ``root`` is listed along with the groups, and is left out of their
+        intersection (see :class:`utils.subset.SubsetQuery`).
+
+        :param leaves: Return the checked groups without children instead,
+            e.g. to intersect them
+        :type leaves: bool, optional
+        :rtype: Set of strings
+        """
+        root_checked = self.states[0] == Qt.Checked
+        if root_checked and not leaves:
+            return {'root'}
+        checked = {'root'} if root_checked else set()
+        pending = list(self.node_children(0))
+        while pending:
+            node = pending.pop()
+            children = self.node_children(node)
+            if self.states[node] == Qt.Checked and \
+                    not (leaves and children.size):
+                checked.add(self.path(node))
+            elif self.states[node] != Qt.Unchecked:
+                pending.extend(children)
+        return checked
+
+    def clear_checks(self):
+        """Uncheck every node"""
+        self.set_checked(0, False)
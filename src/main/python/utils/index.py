@@ -0,0 +1,465 @@
+"""This module contains indexes that are built once per file to speed up
+lookups and subsetting.
+"""
+
+import numpy as np
+
+
+class GroupMembershipIndex(object):
+    """Map every observation to the groups that contain it.
+
+    The index is stored in CSR form: the group ids of observation ``i`` are
+    ``values[offsets[i]:offsets[i + 1]]``, and a group id is the position of
+    the group in ``group_paths``. Looking up one observation is O(1) plus the
+    size of the answer.
+
+    :param group_paths: Paths of the indexed groups
+    :type group_paths: List of strings
+    :param offsets: Start of the group ids of each observation, plus the end
+    :type offsets: numpy.ndarray
+    :param values: Group ids, ordered by observation
+    :type values: numpy.ndarray
+    """
+
+    def __init__(self, group_paths, offsets, values):
+        self.group_paths = list(group_paths)
+        self.offsets = offsets
+        self.values = values
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def from_obs_ids(cls, group_paths, obs_id_arrays, n_obs=0):
+        """Build the index from the ``obs_id`` array of every group
+
+        :param group_paths: Paths of the groups
+        :type group_paths: List of strings
+        :param obs_id_arrays: ``obs_id`` values of each group, in the same
+            order as ``group_paths``
+        :type obs_id_arrays: List of numpy.ndarray
+        :param n_obs: Number of observations in the file
+        :type n_obs: int
+        :rtype: GroupMembershipIndex
+        """
+        counts = [len(obs_id) for obs_id in obs_id_arrays]
+        obs = np.concatenate(
+            [np.asarray(obs_id, dtype=np.int64) for obs_id in obs_id_arrays]
+            or [np.empty(0, dtype=np.int64)])
+        groups = np.repeat(
+            np.arange(len(obs_id_arrays), dtype=np.int32), counts)
+        return cls.from_pairs(group_paths, obs, groups, n_obs)
+
+    @classmethod
+    def from_pairs(cls, group_paths, obs, groups, n_obs=0):
+        """Build the index from (observation, group id) pairs
+
+        :param group_paths: Paths of the groups
+        :type group_paths: List of strings
+        :param obs: Observation of every pair
+        :type obs: numpy.ndarray of int64
+        :param groups: Group id of every pair
+        :type groups: numpy.ndarray of int32
+        :param n_obs: Number of observations in the file
+        :type n_obs: int
+        :rtype: GroupMembershipIndex
+        """
+        # Sort the (observation, group) pairs and drop duplicates
+        order = np.lexsort((groups, obs))
+        obs, groups = obs[order], groups[order]
+        keep = np.ones(obs.size, dtype=bool)
+        keep[1:] = (obs[1:] != obs[:-1]) | (groups[1:] != groups[:-1])
+        obs, groups = obs[keep], groups[keep]
+
+        size = max(int(n_obs), int(obs[-1]) + 1 if obs.size else 0)
+        offsets = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(obs, minlength=size), out=offsets[1:])
+        return cls(group_paths, offsets, groups)
+
+    @classmethod
+    def build(cls, handle, group_tree, progress=None):
+        """Build the index by streaming the ``obs_id`` variable of every
+        group once, see :meth:`utils.io.DatasetHandle.iter_blocks`. Groups
+        without an ``obs_id`` variable are skipped.
+
+        :param handle: Handle of the open file
+        :type handle: utils.io.DatasetHandle
+        :param group_tree: Tree of the groups of the file
+        :type group_tree: utils.io.GroupTree
+        :param progress: Called with a percentage after each group is read
+        :type progress: callable, optional
+        :rtype: GroupMembershipIndex
+        """
+        group_paths = group_tree.paths
+        indexed = group_tree.n_obs >= 0
+        indexed_paths = [path for path, has_obs_id
+                         in zip(group_paths, indexed) if has_obs_id]
+        size = int(group_tree.n_obs[indexed].sum())
+
+        # The blocks are copied straight into the pair arrays, which are at
+        # most as large as all the obs_id variables together
+        obs = np.empty(size, dtype=np.int64)
+        groups = np.empty(size, dtype=np.int32)
+        filled = 0
+        group_id = 0
+        for count, (path, has_obs_id) in enumerate(
+                zip(group_paths, indexed), 1):
+            if has_obs_id:
+                for block in handle.iter_blocks('{}/obs_id'.format(path)):
+                    obs[filled:filled + block.size] = block
+                    groups[filled:filled + block.size] = group_id
+                    filled += block.size
+                group_id += 1
+            if progress is not None:
+                progress(100 * count // len(group_paths))
+        return cls.from_pairs(indexed_paths, obs[:filled], groups[:filled],
+                              handle.dataset.sizes['obs'])
+
+    def group_ids_of(self, obs_id):
+        """Return the ids of the groups that contain one observation
+
+        :param obs_id: Observation index
+        :type obs_id: int
+        :rtype: numpy.ndarray
+        """
+        if not 0 <= obs_id < len(self):
+            return self.values[:0]
+        return self.values[self.offsets[obs_id]:self.offsets[obs_id + 1]]
+
+    def groups_of(self, obs_id):
+        """Return the paths of the groups that contain one observation
+
+        :param obs_id: Observation index
+        :type obs_id: int
+        :rtype: List of strings
+        """
+        return [self.group_paths[group]
+                for group in self.group_ids_of(obs_id)]
+
+    def group_ids_of_many(self, obs_ids):
+        """Look up many observations at once.
+
+        :param obs_ids: Observation indexes
+        :type obs_ids: array-like of int
+        :return: CSR offsets and group ids for ``obs_ids``, in their order.
+            Observations that are out of range belong to no group.
+        :rtype: tuple of numpy.ndarray
+        """
+        obs_ids = np.asarray(obs_ids, dtype=np.int64)
+        valid = (obs_ids >= 0) & (obs_ids < len(self))
+        starts = np.where(valid, self.offsets[np.where(valid, obs_ids, 0)], 0)
+        ends = np.where(
+            valid, self.offsets[np.where(valid, obs_ids + 1, 0)], 0)
+        lengths = ends - starts
+
+        offsets = np.zeros(obs_ids.size + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = np.repeat(starts - offsets[:-1], lengths) + \
+            np.arange(offsets[-1])
+        return offsets, self.values[positions]
+
+    def groups_of_many(self, obs_ids):
+        """Return the paths of the groups of many observations at once
+
+        :param obs_ids: Observation indexes
+        :type obs_ids: array-like of int
+        :rtype: List of lists of strings
+        """
+        offsets, values = self.group_ids_of_many(obs_ids)
+        return [[self.group_paths[group]
+                 for group in values[offsets[i]:offsets[i + 1]]]
+                for i in range(len(offsets) - 1)]
+
+
+class GroupBitmaps(object):
+    """Per-group bitmaps over the observations, for group set algebra.
+
+    Each group's bitmap holds one bit per observation, packed eight to a byte
+    with ``numpy.packbits``. Bitmaps are derived from a
+    :class:`GroupMembershipIndex` without reading the file, from the sorted
+    members of each group, whenever an expression needs them.
+
+    Any and/or/not combination of groups is evaluated with bitwise
+    operations, in time linear in the number of groups and observations.
+
+    :param membership_index: Observation to group membership index
+    :type membership_index: GroupMembershipIndex
+    """
+
+    def __init__(self, membership_index):
+        self.group_paths = membership_index.group_paths
+        self.size = len(membership_index)
+        n_groups = len(self.group_paths)
+
+        # Transpose the CSR index so that the members of a group are
+        # contiguous. A stable sort keeps the members of a group sorted.
+        owners = np.repeat(np.arange(self.size, dtype=np.int64),
+                           np.diff(membership_index.offsets))
+        order = np.argsort(membership_index.values, kind='mergesort')
+        self._members = owners[order]
+        self._member_offsets = np.zeros(n_groups + 1, dtype=np.int64)
+        np.cumsum(np.bincount(membership_index.values, minlength=n_groups),
+                  out=self._member_offsets[1:])
+
+        self._ids = {path: i for i, path in enumerate(self.group_paths)}
+        self.descendants = {path: [] for path in self.group_paths}
+        for group_id, path in enumerate(self.group_paths):
+            parts = path.split('/')
+            for depth in range(2, len(parts)):
+                # Ancestors without an obs_id variable are not indexed, but
+                # still stand for their descendants
+                self.descendants.setdefault(
+                    '/'.join(parts[:depth]), []).append(group_id)
+
+    def expand(self, path):
+        """Return the ids of the descendants of a group, or the id of the
+        group itself if it has no descendants
+
+        :param path: Path of the group
+        :type path: str
+        :rtype: List of int
+        """
+        if self.descendants.get(path):
+            return list(self.descendants[path])
+        return [self._ids[path]] if path in self._ids else []
+
+    def members(self, group_id):
+        """Return the sorted observation indexes of one group
+
+        :rtype: numpy.ndarray
+        """
+        return self._members[self._member_offsets[group_id]:
+                             self._member_offsets[group_id + 1]]
+
+    def bitmap(self, group_id):
+        """Return the packed bitmap of one group
+
+        :rtype: numpy.ndarray
+        """
+        mask = np.zeros(self.size, dtype=bool)
+        mask[self.members(group_id)] = True
+        return np.packbits(mask)
+
+    def empty(self):
+        """Return a bitmap with no observation set"""
+        return np.zeros((self.size + 7) // 8, dtype=np.uint8)
+
+    def full(self):
+        """Return a bitmap with every observation set"""
+        return self.complement(self.empty())
+
+    def complement(self, bits):
+        """Return the complement of a bitmap"""
+        bits = np.invert(bits)
+        if self.size % 8:
+            # Clear the padding bits after the last observation
+            bits[-1] &= (0xFF << (8 - self.size % 8)) & 0xFF
+        return bits
+
+    def evaluate(self, expression):
+        """Evaluate a group expression into a bitmap.
+
+        An expression is a group id, a group path, or a tuple
+        ``("and", ...)``, ``("or", ...)`` or ``("not", expression)``. As in
+        the group selection of the main window, an operand that is a path
+        stands for the groups of :meth:`expand`, combined with the operator
+        of the tuple; a path on its own is combined with "or". A path that
+        is not in the file selects nothing, so it makes an "and" empty. An
+        "and" or "or" without operands is empty.
+
+        :param expression: The expression
+        :type expression: int, str or tuple
+        :rtype: numpy.ndarray
+        """
+        if isinstance(expression, str):
+            expression = ('or', expression)
+        if not isinstance(expression, tuple):
+            return self.bitmap(int(expression))
+
+        operator, operands = expression[0], expression[1:]
+        if operator == 'not':
+            return self.complement(self.evaluate(operands[0]))
+        expanded = []
+        for operand in operands:
+            if not isinstance(operand, str):
+                expanded.append(operand)
+                continue
+            group_ids = self.expand(operand)
+            if not group_ids and operator == 'and':
+                return self.empty()
+            expanded.extend(group_ids)
+        operands = expanded
+        if not operands:
+            return self.empty()
+        combine = np.bitwise_and if operator == 'and' else np.bitwise_or
+        result = self.evaluate(operands[0])
+        for operand in operands[1:]:
+            combine(result, self.evaluate(operand), out=result)
+        return result
+
+    def to_mask(self, bits):
+        """Unpack a bitmap into a boolean mask over the observations
+
+        :rtype: numpy.ndarray
+        """
+        return np.unpackbits(bits)[:self.size].astype(bool)
+
+
+class TimeIndex(object):
+    """Observation times in sorted order, for time window lookups.
+
+    ``values`` holds the valid (not NaT) times sorted, and ``order`` the
+    position of each of them along ``obs``. When the file is already
+    ordered by time and has no missing times, ``order`` is None and a time
+    window is a contiguous slice of the observations.
+
+    :param values: Sorted observation times
+    :type values: numpy.ndarray of datetime64[ns]
+    :param order: Position along ``obs`` of each value, or None if the
+        values are the times of the observations in file order
+    :type order: numpy.ndarray, optional
+    """
+
+    def __init__(self, values, order=None):
+        self.values = values
+        self.order = order
+
+    @classmethod
+    def from_times(cls, times):
+        """Build the index from the time of every observation
+
+        :param times: Observation times, in file order
+        :type times: numpy.ndarray of datetime64
+        :rtype: TimeIndex
+        """
+        times = np.asarray(times, dtype='datetime64[ns]')
+        valid = ~np.isnat(times)
+        if valid.all() and not (times[1:] < times[:-1]).any():
+            return cls(times)
+        positions = np.flatnonzero(valid)
+        order = positions[np.argsort(times[positions], kind='mergesort')]
+        return cls(times[order], order)
+
+    @property
+    def is_sorted(self):
+        """Whether the observations are stored in time order"""
+        return self.order is None
+
+    def extent(self):
+        """Return the earliest and the latest observation time
+
+        :rtype: tuple of numpy.datetime64
+        """
+        if not self.values.size:
+            return np.datetime64('NaT', 'ns'), np.datetime64('NaT', 'ns')
+        return self.values[0], self.values[-1]
+
+    def window(self, time_min=None, time_max=None):
+        """Return the observations whose time is in [time_min, time_max].
+        A missing bound is unbounded.
+
+        :return: A slice of the observations if they are stored in time
+            order, otherwise their sorted positions along ``obs``
+        :rtype: slice or numpy.ndarray
+        """
+        start = 0 if time_min is None else int(np.searchsorted(
+            self.values, np.datetime64(time_min, 'ns'), side='left'))
+        stop = self.values.size if time_max is None else int(np.searchsorted(
+            self.values, np.datetime64(time_max, 'ns'), side='right'))
+        stop = max(start, stop)
+        if self.is_sorted:
+            return slice(start, stop)
+        return np.sort(self.order[start:stop])
+
+
+class QCIndex(object):
+    """Observations grouped by DART QC flag.
+
+    Flags 0 to 7 get an id equal to the flag; any other value, including a
+    missing one, gets :attr:`INVALID`. The positions of the observations of
+    flag id ``i`` are ``positions[offsets[i]:offsets[i + 1]]``, sorted, so
+    the histogram of the flags is ``numpy.diff(offsets)``.
+
+    :param offsets: Start of the positions of each flag id, plus the end
+    :type offsets: numpy.ndarray
+    :param positions: Positions along ``obs``, ordered by flag id
+    :type positions: numpy.ndarray
+    """
+    FLAGS = tuple(range(8))
+    INVALID = len(FLAGS)
+
+    def __init__(self, offsets, positions):
+        self.offsets = offsets
+        self.positions = positions
+        self._codes = None
+
+    @classmethod
+    def from_values(cls, qc):
+        """Build the index from the DART QC value of every observation
+
+        :param qc: DART QC values, in file order
+        :type qc: numpy.ndarray
+        :rtype: QCIndex
+        """
+        return cls.from_codes(cls.encode(qc))
+
+    @classmethod
+    def from_codes(cls, codes):
+        """Build the index from the flag id of every observation
+
+        :param codes: Flag ids, see :meth:`encode`, in file order
+        :type codes: numpy.ndarray
+        :rtype: QCIndex
+        """
+        offsets = np.zeros(cls.INVALID + 2, dtype=np.int64)
+        np.cumsum(np.bincount(codes, minlength=cls.INVALID + 1),
+                  out=offsets[1:])
+        return cls(offsets, np.argsort(codes, kind='mergesort'))
+
+    @classmethod
+    def encode(cls, qc):
+        """Map DART QC values to flag ids
+
+        :rtype: numpy.ndarray of uint8
+        """
+        qc = np.ma.filled(np.ma.asarray(qc, dtype=np.float64), np.nan)
+        valid = np.isin(qc, cls.FLAGS)
+        return np.where(valid, np.nan_to_num(qc), cls.INVALID).astype(
+            np.uint8)
+
+    @property
+    def counts(self):
+        """Number of observations of each flag id
+
+        :rtype: numpy.ndarray
+        """
+        return np.diff(self.offsets)
+
+    def rows(self, flags):
+        """Return the positions of the observations with one of ``flags``
+
+        :param flags: Flag ids
+        :type flags: Iterable of int
+        :return: Sorted positions along ``obs``
+        :rtype: numpy.ndarray
+        """
+        parts = [self.positions[self.offsets[flag]:self.offsets[flag + 1]]
+                 for flag in sorted(set(flags)) if 0 <= flag <= self.INVALID]
+        if len(parts) == 1:
+            return parts[0]
+        return np.sort(np.concatenate(parts or [self.positions[:0]]))
+
+    def counts_of(self, rows=None):
+        """Return the number of observations of each flag id among ``rows``
+
+        :param rows: Positions along ``obs``, or None for all of them
+        :type rows: numpy.ndarray, optional
+        :rtype: numpy.ndarray
+        """
+        if rows is None:
+            return self.counts
+        if self._codes is None:
+            self._codes = np.empty(self.positions.size, dtype=np.uint8)
+            self._codes[self.positions] = np.repeat(
+                np.arange(self.INVALID + 1, dtype=np.uint8), self.counts)
+        return np.bincount(self._codes[rows], minlength=self.INVALID + 1)
@@ -1,6 +1,30 @@
 """This module contains helper functions for reading/writing netCDF files
 """
 
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# NetCDF library imports
+import xarray as xr
+from xarray.backends import NetCDF4DataStore
+from xarray.backends.netCDF4_ import NetCDF4ArrayWrapper
+from xarray.core import indexing
+from netCDF4 import Dataset
+
+# Local imports
+from utils.trace import count
+
+# Target size in bytes of the blocks read by DatasetHandle.iter_blocks
+BLOCK_BYTES = 4 * 2 ** 20
+# Selected rows of a variable with fewer bytes than this between them are
+# read with one slice
+READ_GAP_BYTES = 64 * 2 ** 10
+
+
+class FileClosedError(IOError):
+    """Raised when a file is read through a handle that has been closed"""
+
 
 def walktree(top):
     """
@@ -14,3 +38,367 @@ def walktree(top):
     for value in top.groups.values():
         for children in walktree(value):
             yield children
+
+
+class GroupTree(object):
+    """Flat, array-backed tree of the groups of a file, without the root.
+
+    Group ``i`` has the path ``paths[i]``, its parent is group
+    ``parents[i]`` (-1 for the children of the root) and its ``obs_id``
+    variable has ``n_obs[i]`` values (-1 if it has none). Groups are sorted
+    by path, so the children of a group are also sorted.
+
+    :param paths: Paths of the groups, sorted
+    :type paths: List of strings
+    :param parents: Index of the parent of every group
+    :type parents: numpy.ndarray
+    :param n_obs: Length of the ``obs_id`` variable of every group
+    :type n_obs: numpy.ndarray
+    """
+
+    def __init__(self, paths, parents, n_obs):
+        self.paths = list(paths)
+        self.parents = parents
+        self.n_obs = n_obs
+        self._child_offsets = None
+        self._children = None
+        self._indexes = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    @classmethod
+    def harvest(cls, handle):
+        """Walk the groups of a file once, without recursion, collecting
+        their paths and the length of their ``obs_id`` variable
+
+        :param handle: Handle of the open file
+        :type handle: DatasetHandle
+        :rtype: GroupTree
+        """
+        found = []
+        # The netCDF library is not thread safe, so the whole walk is done
+        # under the lock of the handle rather than spread over threads
+        with handle.lock:
+            handle.check_open()
+            pending = [(None, group)
+                       for group in handle.root_group.groups.values()]
+            while pending:
+                parent, group = pending.pop()
+                obs_id = group.variables.get('obs_id')
+                found.append((group.path, parent,
+                              -1 if obs_id is None else obs_id.size))
+                pending.extend((group.path, child)
+                               for child in group.groups.values())
+        found.sort()
+        indexes = {path: index for index, (path, _, _) in enumerate(found)}
+        return cls([path for path, _, _ in found],
+                   np.array([-1 if parent is None else indexes[parent]
+                             for _, parent, _ in found], dtype=np.int32),
+                   np.array([n_obs for _, _, n_obs in found],
+                            dtype=np.int64))
+
+    @classmethod
+    def from_paths(cls, paths, n_obs=None):
+        """Build the tree of the given groups, e.g. the union of the groups
+        of several files
+
+        :param paths: Paths of the groups; their ancestors are added
+        :type paths: Iterable of str
+        :param n_obs: Length of the ``obs_id`` variable of the groups that
+            have one, by path
+        :type n_obs: dict, optional
+        :rtype: GroupTree
+        """
+        n_obs = n_obs or dict()
+        found = set()
+        for path in paths:
+            while path not in ('', '/') and path not in found:
+                found.add(path)
+                path = path.rsplit('/', 1)[0]
+        found = sorted(found)
+        indexes = {path: index for index, path in enumerate(found)}
+        return cls(found,
+                   np.array([indexes.get(path.rsplit('/', 1)[0], -1)
+                             for path in found], dtype=np.int32),
+                   np.array([n_obs.get(path, -1) for path in found],
+                            dtype=np.int64))
+
+    def index_of(self, path):
+        """Return the index of the group at ``path``, or -1
+
+        :rtype: int
+        """
+        if self._indexes is None:
+            self._indexes = {path: index
+                             for index, path in enumerate(self.paths)}
+        return self._indexes.get(path, -1)
+
+    def children(self, index):
+        """Return the indexes of the children of a group, sorted by path
+
+        :param index: Index of the group, or -1 for the root
+        :type index: int
+        :rtype: numpy.ndarray
+        """
+        if self._children is None:
+            # Children in CSR form, keyed by parent index + 1
+            self._children = np.argsort(self.parents, kind='mergesort')
+            self._child_offsets = np.zeros(len(self) + 2, dtype=np.int64)
+            np.cumsum(np.bincount(self.parents + 1, minlength=len(self) + 1),
+                      out=self._child_offsets[1:])
+        return self._children[
+            self._child_offsets[index + 1]:self._child_offsets[index + 2]]
+
+    def to_arrays(self, prefix='tree_'):
+        """Return the tree as a dictionary of numpy arrays
+
+        :rtype: dict
+        """
+        return {prefix + 'paths': np.array(self.paths, dtype=str),
+                prefix + 'parents': self.parents,
+                prefix + 'n_obs': self.n_obs}
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix='tree_'):
+        """Inverse of :meth:`to_arrays`
+
+        :rtype: GroupTree
+        """
+        return cls([str(path) for path in arrays[prefix + 'paths']],
+                   arrays[prefix + 'parents'], arrays[prefix + 'n_obs'])
+
+
+class DatasetHandle(object):
+    """Single, lazily-loaded access point to a DART netCDF file.
+
+    The file is opened exactly once with netCDF4. The same handle backs both
+    the xarray view (``dataset``), used for subsetting and plotting, and the
+    group view (``root_group``), used for group lookups. Variables are only
+    read from disk when their values are requested, and every read is added
+    to ``bytes_read``. Selecting rows of the xarray view by position (e.g.
+    ``dataset.isel(obs=rows)``) reads slices around runs of nearby rows and
+    decodes only the selected ones.
+
+    A handle may be closed while another thread reads it: it is closed under
+    :attr:`lock`, and every later read raises :class:`FileClosedError`
+    instead of reading through a netCDF id the library may have given to
+    another file.
+
+    :param path: Path to the netCDF file
+    :type path: str
+    :param decode_times: Whether xarray should decode the time coordinate
+    :type decode_times: bool
+    """
+
+    def __init__(self, path, decode_times=True):
+        self.path = path
+        self.bytes_read = 0
+        self._counter_lock = threading.Lock()
+        self.root_group = Dataset(path, "r", format="NETCDF4")
+        self._store = _CountingDataStore(self.root_group, self.add_bytes_read,
+                                         self.check_open)
+        self.dataset = xr.open_dataset(self._store, decode_times=decode_times)
+
+    @property
+    def lock(self):
+        """Lock guarding every call into the netCDF library. It is shared with
+        the xarray view, so both views can be read from different threads.
+        """
+        return self._store.lock
+
+    @property
+    def closed(self):
+        """Whether :meth:`close` has been called"""
+        return not self.root_group.isopen()
+
+    def check_open(self):
+        """Raise :class:`FileClosedError` if the handle has been closed. Call
+        it while holding :attr:`lock`, before reading from the file.
+        """
+        if self.closed:
+            raise FileClosedError("{} has been closed".format(self.path))
+
+    def add_bytes_read(self, nbytes):
+        """Add ``nbytes`` to the running total of bytes read from the file
+
+        :param nbytes: Number of bytes read
+        :type nbytes: int
+        """
+        with self._counter_lock:
+            self.bytes_read += int(nbytes)
+        count('bytes_read', int(nbytes))
+
+    def read_variable(self, path, key=slice(None)):
+        """Read (part of) a variable through the group view
+
+        :param path: Full path of the variable, e.g. ``/Purple/obs_id``
+        :type path: str
+        :param key: Index applied to the variable, defaults to all values
+        :type key: slice or tuple, optional
+        :return: The requested values, with fill values masked
+        :rtype: numpy.ma.MaskedArray
+        """
+        with self.lock:
+            self.check_open()
+            variable = self.root_group[path]
+            # The xarray view turns masking off on shared variable objects,
+            # so it is switched back on explicitly for group reads.
+            variable.set_auto_maskandscale(True)
+            values = variable[key]
+        self.add_bytes_read(values.nbytes)
+        return values
+
+    def iter_blocks(self, path, block_bytes=BLOCK_BYTES, prefetch=True):
+        """Iterate over the values of a variable in blocks along its first
+        dimension, dropping fill values block by block.
+
+        Blocks are aligned with the HDF5 chunks of the variable, so that no
+        chunk is decompressed twice, and the next block is read while the
+        current one is being consumed. Unlike :meth:`read_variable` followed
+        by ``compressed()``, the whole variable is never held in memory.
+
+        :param path: Full path of the variable, e.g. ``/Purple/obs_id``
+        :type path: str
+        :param block_bytes: Target size of a block in bytes
+        :type block_bytes: int, optional
+        :param prefetch: Whether to read the next block in the background
+        :type prefetch: bool, optional
+        :return: The valid values of each block, in order
+        :rtype: Iterator of numpy.ndarray
+        """
+        with self.lock:
+            self.check_open()
+            variable = self.root_group[path]
+            size = variable.shape[0] if variable.shape else 0
+            length = block_length(variable, block_bytes)
+
+        def read(start):
+            values = self.read_variable(path, slice(start, start + length))
+            return np.ma.compressed(values), values.nbytes
+
+        starts = range(0, size, length)
+        if not prefetch or len(starts) < 2:
+            for start in starts:
+                yield read(start)[0]
+            return
+
+        def result(future):
+            # The reading thread has no open span, so the bytes of the
+            # block are added to the spans of the consuming thread
+            block, nbytes = future.result()
+            count('bytes_read', nbytes)
+            return block
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = executor.submit(read, starts[0])
+            for start in starts[1:]:
+                block = result(pending)
+                pending = executor.submit(read, start)
+                yield block
+            yield result(pending)
+
+    def close(self):
+        """Close the netCDF file behind both views. Closing twice does
+        nothing.
+        """
+        # The xarray view only wraps root_group, so closing root_group
+        # closes it too. xarray would take the lock again, which is not
+        # reentrant.
+        with self.lock:
+            if not self.closed:
+                self.root_group.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def block_length(variable, block_bytes=BLOCK_BYTES):
+    """Return the length along the first dimension of the blocks of about
+    ``block_bytes`` bytes in which a variable is read: a multiple of its
+    HDF5 chunk length, if it is chunked
+
+    :param variable: The variable
+    :type variable: netCDF4.Variable
+    :param block_bytes: Target size of a block in bytes
+    :type block_bytes: int, optional
+    :rtype: int
+    """
+    row_bytes = variable.dtype.itemsize * int(np.prod(variable.shape[1:]))
+    length = max(1, block_bytes // max(1, row_bytes))
+    chunking = variable.chunking()
+    if chunking and chunking != 'contiguous':
+        length = max(1, length // chunking[0]) * chunking[0]
+    return length
+
+
+class _CountingArrayWrapper(NetCDF4ArrayWrapper):
+    """Lazy array wrapper that reports how many bytes every read returns.
+
+    The netCDF library reads a list of positions one position at a time,
+    so positions along the first dimension are read as slices over runs of
+    positions less than :data:`READ_GAP_BYTES` apart and then indexed in
+    memory. The bytes reported are those of the slices, not only of the
+    selected positions.
+    """
+
+    def get_array(self, needs_lock=True):
+        # Called with the lock of the data store held while reading
+        self.datastore.check_open()
+        return super(_CountingArrayWrapper, self).get_array(needs_lock)
+
+    def _getitem(self, key):
+        rows = key[0] if key else None
+        if isinstance(rows, np.ndarray) and rows.ndim == 1 and \
+                rows.size > 1 and \
+                all(isinstance(item, slice) for item in key[1:]):
+            array, nbytes = self._read_runs(rows, tuple(key[1:]))
+        else:
+            array = super(_CountingArrayWrapper, self)._getitem(key)
+            nbytes = array.nbytes
+        self.datastore.on_read(nbytes)
+        return array
+
+    def _read_runs(self, rows, rest):
+        inverse = None
+        if (np.diff(rows) < 0).any():
+            rows, inverse = np.unique(rows, return_inverse=True)
+        row_bytes = self.dtype.itemsize * int(np.prod(self.shape[1:]))
+        gap_rows = max(1, READ_GAP_BYTES // max(1, row_bytes))
+        breaks = np.flatnonzero(np.diff(rows) > gap_rows) + 1
+        parts = []
+        nbytes = 0
+        for run in np.split(rows, breaks):
+            start = int(run[0])
+            block = super(_CountingArrayWrapper, self)._getitem(
+                (slice(start, int(run[-1]) + 1),) + rest)
+            nbytes += block.nbytes
+            parts.append(block[run - start])
+        if any(isinstance(part, np.ma.MaskedArray) for part in parts):
+            array = np.ma.concatenate(parts)
+        else:
+            array = np.concatenate(parts)
+        return (array if inverse is None else array[inverse]), nbytes
+
+
+class _CountingDataStore(NetCDF4DataStore):
+    """xarray data store over an already opened ``netCDF4.Dataset`` whose lazy
+    variables report the bytes they read to ``on_read`` and call
+    ``check_open`` before every read
+    """
+
+    def __init__(self, root_group, on_read, check_open):
+        super(_CountingDataStore, self).__init__(root_group)
+        self.on_read = on_read
+        self.check_open = check_open
+
+    def open_store_variable(self, name, var):
+        variable = super(_CountingDataStore, self).open_store_variable(
+            name, var)
+        data = indexing.LazilyOuterIndexedArray(
+            _CountingArrayWrapper(name, self))
+        return xr.Variable(variable.dims, data, variable.attrs,
+                           variable.encoding)
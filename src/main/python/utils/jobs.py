@@ -0,0 +1,165 @@
+"""This module contains the background job subsystem used to keep long
+running work (opening files, subsetting, preparing plot data) off the Qt GUI
+thread.
+"""
+
+import threading
+
+# PyQt5 library imports
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+
+class JobCancelled(Exception):
+    """Raised inside a job function when the job has been cancelled"""
+
+
+class JobSignals(QObject):
+    """Signals emitted by a running :class:`Job`
+
+    ``progress`` carries a percentage, ``result`` the return value of the job
+    function and ``error`` a message describing the exception it raised.
+    ``finished`` is always emitted last.
+    """
+    progress = pyqtSignal(int)
+    result = pyqtSignal(object)
+    error = pyqtSignal(str)
+    finished = pyqtSignal()
+
+
+class Job(QRunnable):
+    """Run ``fn(job, *args, **kwargs)`` on a worker thread of a QThreadPool.
+
+    The job function receives the job itself as its first argument and should
+    call :meth:`report_progress` regularly. Once the job is cancelled,
+    :meth:`report_progress` raises :class:`JobCancelled`, which stops the
+    function and suppresses its result.
+
+    :param fn: Function to run
+    :type fn: callable
+    """
+
+    def __init__(self, fn, *args, **kwargs):
+        super(Job, self).__init__()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = JobSignals()
+        self._cancelled = threading.Event()
+
+    @property
+    def is_cancelled(self):
+        """Whether :meth:`cancel` has been called on this job"""
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        """Ask the job to stop at its next progress report"""
+        self._cancelled.set()
+
+    def report_progress(self, percent):
+        """Report progress to the GUI thread
+
+        :param percent: Progress between 0 and 100
+        :type percent: int
+        :raises JobCancelled: if the job has been cancelled
+        """
+        if self.is_cancelled:
+            raise JobCancelled()
+        self.signals.progress.emit(int(percent))
+
+    def run(self):
+        try:
+            result = self.fn(self, *self.args, **self.kwargs)
+        except JobCancelled:
+            pass
+        except Exception as error:  # pylint: disable=broad-except
+            if not self.is_cancelled:
+                self.signals.error.emit(str(error) or type(error).__name__)
+        else:
+            if not self.is_cancelled:
+                self.signals.result.emit(result)
+        finally:
+            self.signals.finished.emit()
+
+
+class JobManager(QObject):
+    """Submit named jobs to a thread pool and cancel stale ones.
+
+    At most one job runs per name: submitting a job cancels the previous job
+    with the same name, as well as every job named in ``supersedes``.
+
+    ``busy`` is emitted with ``True`` when the first job starts and with
+    ``False`` once no jobs are left. ``progress`` forwards the progress of the
+    most recently submitted job.
+    """
+    busy = pyqtSignal(bool)
+    progress = pyqtSignal(str, int)
+
+    def __init__(self, parent=None, pool=None):
+        super(JobManager, self).__init__(parent)
+        self.pool = pool or QThreadPool.globalInstance()
+        self._jobs = dict()
+        self._latest = None
+
+    def submit(self, name, fn, *args, on_result=None, on_error=None,
+               supersedes=(), **kwargs):
+        """Run ``fn(job, *args, **kwargs)`` in the background
+
+        :param name: Name of the job, e.g. ``"open"`` or ``"plot"``
+        :type name: str
+        :param fn: Job function, see :class:`Job`
+        :type fn: callable
+        :param on_result: Slot called on the GUI thread with the result
+        :type on_result: callable, optional
+        :param on_error: Slot called on the GUI thread with an error message
+        :type on_error: callable, optional
+        :param supersedes: Names of other jobs made stale by this one
+        :type supersedes: Iterable of str, optional
+        :return: The submitted job
+        :rtype: Job
+        """
+        for stale in (name,) + tuple(supersedes):
+            stale_job = self._jobs.pop(stale, None)
+            if stale_job is not None:
+                stale_job.cancel()
+
+        job = Job(fn, *args, **kwargs)
+        if on_result is not None:
+            job.signals.result.connect(
+                lambda result: job.is_cancelled or on_result(result))
+        if on_error is not None:
+            job.signals.error.connect(
+                lambda message: job.is_cancelled or on_error(message))
+        job.signals.progress.connect(
+            lambda percent: self._on_progress(name, job, percent))
+        job.signals.finished.connect(lambda: self._on_finished(name, job))
+
+        if not self._jobs:
+            self.busy.emit(True)
+        self._jobs[name] = job
+        self._latest = job
+        self.progress.emit(name, 0)
+        self.pool.start(job)
+        return job
+
+    def cancel(self, name=None):
+        """Cancel the job called ``name``, or every job if no name is given
+
+        :param name: Name of the job to cancel
+        :type name: str, optional
+        """
+        names = list(self._jobs) if name is None else [name]
+        cancelled = [self._jobs.pop(key) for key in names if key in self._jobs]
+        for job in cancelled:
+            job.cancel()
+        if cancelled and not self._jobs:
+            self.busy.emit(False)
+
+    def _on_progress(self, name, job, percent):
+        if job is self._latest and not job.is_cancelled:
+            self.progress.emit(name, percent)
+
+    def _on_finished(self, name, job):
+        if self._jobs.get(name) is job:
+            del self._jobs[name]
+            if not self._jobs:
+                self.busy.emit(False)
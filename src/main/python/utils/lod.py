@@ -0,0 +1,160 @@
+"""This module contains the level-of-detail reduction used to scatter plot
+large subsets: the observations are either aggregated into a lon/lat/vertical
+voxel grid or sampled evenly across lon/lat cells, so that at most a given
+number of points is drawn.
+"""
+
+import numpy as np
+
+# Largest number of points drawn by a scatter plot
+DEFAULT_POINT_BUDGET = 50000
+# Number of vertical levels of the voxel grid
+VERTICAL_BINS = 16
+LOD_METHODS = ('voxel', 'sample')
+
+
+class ScatterLOD(object):
+    """Reduce a set of observations to at most ``budget`` points.
+
+    With the ``"voxel"`` method every point drawn stands for the
+    observations of one voxel: it is placed at their centroid, colored with
+    the mean of their values and carries their count. With the ``"sample"``
+    method the points drawn are observations sampled evenly across lon/lat
+    cells, so sparse regions keep all of their observations. When no more
+    than ``budget`` observations are visible, all of them are drawn.
+
+    :param lon: Longitude of every observation
+    :type lon: numpy.ndarray
+    :param lat: Latitude of every observation
+    :type lat: numpy.ndarray
+    :param vertical: Vertical coordinate of every observation
+    :type vertical: numpy.ndarray
+    :param values: Value of every observation
+    :type values: numpy.ndarray
+    :param budget: Largest number of points returned, or None to always
+        return every observation
+    :type budget: int, optional
+    :param method: ``"voxel"`` or ``"sample"``
+    :type method: str, optional
+    """
+
+    def __init__(self, lon, lat, vertical, values,
+                 budget=DEFAULT_POINT_BUDGET, method='voxel'):
+        if method not in LOD_METHODS:
+            raise ValueError("Unknown level of detail method {}".format(
+                method))
+        self.columns = [np.asarray(column, dtype=np.float64)
+                        for column in (lon, lat, vertical, values)]
+        valid = np.all([np.isfinite(column) for column in self.columns],
+                       axis=0)
+        if not valid.all():
+            self.columns = [column[valid] for column in self.columns]
+        self.budget = np.inf if budget is None else int(budget)
+        self.method = method
+
+    def __len__(self):
+        return self.columns[0].size
+
+    def points(self, lon_range=None, lat_range=None):
+        """Return the points to draw for the visible region
+
+        :param lon_range: (min, max) of the visible longitudes
+        :type lon_range: tuple, optional
+        :param lat_range: (min, max) of the visible latitudes
+        :type lat_range: tuple, optional
+        :return: ``lon``, ``lat``, ``vertical``, ``values`` and ``counts``
+            (the number of observations behind each point) of the points
+        :rtype: dict
+        """
+        columns = self.columns
+        if lon_range is not None or lat_range is not None:
+            visible = np.ones(len(self), dtype=bool)
+            for column, bounds in zip(columns, (lon_range, lat_range)):
+                if bounds is not None:
+                    visible &= (column >= min(bounds)) & \
+                        (column <= max(bounds))
+            columns = [column[visible] for column in columns]
+
+        if columns[0].size <= self.budget:
+            lon, lat, vertical, values = columns
+            counts = np.ones(lon.size, dtype=np.int64)
+        elif self.method == 'voxel':
+            lon, lat, vertical, values, counts = voxel_means(
+                columns, self.budget)
+        else:
+            keep = stratified_sample(columns[0], columns[1], self.budget)
+            lon, lat, vertical, values = [column[keep] for column in columns]
+            counts = np.ones(lon.size, dtype=np.int64)
+        return {'lon': lon, 'lat': lat, 'vertical': vertical,
+                'values': values, 'counts': counts}
+
+
+def voxel_means(columns, budget):
+    """Aggregate observations into at most ``budget`` voxels
+
+    :param columns: lon, lat, vertical and values of the observations
+    :type columns: List of numpy.ndarray
+    :return: The mean of every column in each non-empty voxel, followed by
+        the number of observations of each voxel
+    :rtype: List of numpy.ndarray
+    """
+    lon, lat, vertical = columns[:3]
+    n_vertical = max(1, min(VERTICAL_BINS, budget // 64))
+    lon_span = np.ptp(lon) or 1.0
+    lat_span = np.ptp(lat) or 1.0
+    # Square lon/lat cells, as many as the budget allows
+    cell = np.sqrt(lon_span * lat_span * n_vertical / budget)
+    n_lon = max(1, min(int(lon_span / cell), budget // n_vertical))
+    n_lat = max(1, min(int(lat_span / cell), budget // (n_lon * n_vertical)))
+
+    voxel = _bin(lon, n_lon)
+    voxel = voxel * n_lat + _bin(lat, n_lat)
+    voxel = voxel * n_vertical + _bin(vertical, n_vertical)
+    _, inverse, counts = np.unique(voxel, return_inverse=True,
+                                   return_counts=True)
+    return [np.bincount(inverse, weights=column) / counts
+            for column in columns] + [counts]
+
+
+def stratified_sample(lon, lat, budget, seed=0):
+    """Sample at most ``budget`` observations evenly across lon/lat cells:
+    every cell keeps the same number of observations, or all of them if it
+    has fewer
+
+    :param lon: Longitude of every observation
+    :type lon: numpy.ndarray
+    :param lat: Latitude of every observation
+    :type lat: numpy.ndarray
+    :param budget: Largest number of observations kept
+    :type budget: int
+    :param seed: Seed of the random order within each cell
+    :type seed: int, optional
+    :return: Sorted positions of the kept observations
+    :rtype: numpy.ndarray
+    """
+    n_cells = max(1, int(np.sqrt(budget)))
+    cells = _bin(lon, n_cells) * n_cells + _bin(lat, n_cells)
+    counts = np.bincount(cells)
+
+    # Largest quota per cell that keeps the sample within the budget
+    low, high = 0, int(counts.max())
+    while low < high:
+        quota = (low + high + 1) // 2
+        if np.minimum(counts, quota).sum() <= budget:
+            low = quota
+        else:
+            high = quota - 1
+
+    # Rank the observations of each cell in a random order
+    order = np.random.RandomState(seed).permutation(cells.size)
+    order = order[np.argsort(cells[order], kind='mergesort')]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    ranks = np.arange(cells.size) - np.repeat(starts, counts)
+    return np.sort(order[ranks < low])
+
+
+def _bin(values, n_bins):
+    low = values.min()
+    span = np.ptp(values) or 1.0
+    return np.minimum(((values - low) / span * n_bins).astype(np.int64),
+                      n_bins - 1)
@@ -0,0 +1,238 @@
+"""This module contains the item model of the file header shown in the main
+window: dimensions, coordinates, variables, attributes and groups as a tree.
+The rows of a branch are only made, and variable values only read, when the
+branch is expanded, so showing the header of a file does not depend on how
+many variables and attributes it has.
+"""
+
+import numpy as np
+
+# PyQt5 library imports
+from PyQt5.QtCore import QAbstractItemModel, QModelIndex, Qt
+
+# Number of values shown at each end of a variable
+PREVIEW_VALUES = 5
+# Number of rows added to the view at a time
+FETCH_BATCH = 256
+# Columns of the model
+COLUMNS = ('Name', 'Value')
+
+
+class _Node(object):
+    """One row of the metadata tree. The rows below it are made by
+    ``loader`` the first time they are needed.
+    """
+    __slots__ = ('name', 'value', 'parent', 'row', 'loader', 'children',
+                 'fetched')
+
+    def __init__(self, name, value='', loader=None):
+        self.name = name
+        self.value = value
+        self.parent = -1
+        self.row = 0
+        self.loader = loader
+        self.children = None if loader is not None else []
+        self.fetched = 0
+
+
+class MetadataModel(QAbstractItemModel):
+    """Lazily expanding tree of the metadata of an open file.
+
+    The top level rows are the dimensions, coordinates, data variables and
+    global attributes of the xarray view and the groups of the file.
+    Variables expand into their attributes and a preview of their first and
+    last :data:`PREVIEW_VALUES` values, read when the preview is expanded.
+
+    :param handle: Handle of the open file
+    :type handle: utils.io.DatasetHandle
+    :param parent: Parent object
+    :type parent: PyQt5.QtCore.QObject, optional
+    """
+
+    def __init__(self, handle, parent=None):
+        super(MetadataModel, self).__init__(parent)
+        self.handle = handle
+        self._inserting = False
+        dataset = handle.dataset
+        # Node 0 is the invisible root; nodes are referred to by position
+        self.nodes = [_Node('')]
+        self.nodes[0].children = self._add(0, [
+            _Node('Dimensions', str(len(dataset.sizes)),
+                  self._dimension_nodes),
+            _Node('Coordinates', str(len(dataset.coords)),
+                  lambda: self._variable_nodes(dataset.coords)),
+            _Node('Data variables', str(len(dataset.data_vars)),
+                  lambda: self._variable_nodes(dataset.data_vars)),
+            _Node('Attributes', str(len(dataset.attrs)),
+                  lambda: self._attribute_nodes(dataset.attrs)),
+            _Node('Groups', '', lambda: self._group_nodes('/')),
+        ])
+        self.nodes[0].fetched = len(self.nodes[0].children)
+
+    def _add(self, parent, children):
+        """Register ``children`` as the rows below node ``parent``
+
+        :return: The node ids of the children
+        :rtype: List of int
+        """
+        ids = []
+        for row, child in enumerate(children):
+            child.parent = parent
+            child.row = row
+            ids.append(len(self.nodes))
+            self.nodes.append(child)
+        return ids
+
+    def _children(self, node_id):
+        """Return the children of a node, making them on first use"""
+        node = self.nodes[node_id]
+        if node.children is None:
+            node.children = self._add(node_id, node.loader())
+        return node.children
+
+    def _dimension_nodes(self):
+        return [_Node(str(name), str(size))
+                for name, size in self.handle.dataset.sizes.items()]
+
+    def _attribute_nodes(self, attrs):
+        return [_Node(str(name), _format_value(value))
+                for name, value in attrs.items()]
+
+    def _variable_nodes(self, variables):
+        return [self._variable_node(name, variable)
+                for name, variable in variables.items()]
+
+    def _variable_node(self, name, variable):
+        description = '({}) {}'.format(', '.join(variable.dims),
+                                       variable.dtype)
+
+        def load():
+            return [
+                _Node('Shape', str(variable.shape)),
+                _Node('Attributes', str(len(variable.attrs)),
+                      lambda: self._attribute_nodes(variable.attrs)),
+                _Node('Values', '',
+                      lambda: _preview_nodes(variable, variable.dims)),
+            ]
+        return _Node(str(name), description, load)
+
+    def _group_nodes(self, path):
+        """Children of a group of the file: its variables and subgroups"""
+        handle = self.handle
+        with handle.lock:
+            handle.check_open()
+            if path == '/':
+                # The variables of the root group are in the xarray view
+                group = handle.root_group
+                variables = []
+            else:
+                group = handle.root_group[path]
+                variables = [(name, variable.dimensions, variable.dtype,
+                              variable.shape)
+                             for name, variable in group.variables.items()]
+            groups = [child.path for child in group.groups.values()]
+        nodes = []
+        for name, dims, dtype, shape in variables:
+            variable_path = '{}/{}'.format(path, name)
+            nodes.append(_Node(name, '({}) {}'.format(', '.join(dims),
+                                                      dtype),
+                               self._group_variable_loader(variable_path,
+                                                           shape)))
+        for child in groups:
+            nodes.append(_Node(child.rsplit('/', 1)[-1], 'group',
+                               lambda child=child: self._group_nodes(child)))
+        return nodes
+
+    def _group_variable_loader(self, path, shape):
+        def load():
+            length = shape[0] if shape else 0
+            head = self.handle.read_variable(
+                path, slice(0, min(length, PREVIEW_VALUES)))
+            tail = self.handle.read_variable(
+                path, slice(max(0, length - PREVIEW_VALUES), length))
+            return [_Node('Shape', str(shape)),
+                    _Node('First values', _format_value(head)),
+                    _Node('Last values', _format_value(tail))]
+        return load
+
+    def node(self, index):
+        """Return the node id of a model index, 0 for the invisible root"""
+        return int(index.internalId()) if index.isValid() else 0
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        return self.createIndex(
+            row, column, self._children(self.node(parent))[row])
+
+    def parent(self, index):
+        parent = self.nodes[self.node(index)].parent
+        if parent <= 0:
+            return QModelIndex()
+        return self.createIndex(self.nodes[parent].row, 0, parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        return self.nodes[self.node(parent)].fetched
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(COLUMNS)
+
+    def hasChildren(self, parent=QModelIndex()):
+        node = self.nodes[self.node(parent)]
+        return node.loader is not None or bool(node.children)
+
+    def canFetchMore(self, parent):
+        # Views may ask for more rows while rows are being inserted
+        if parent.column() > 0 or self._inserting:
+            return False
+        node_id = self.node(parent)
+        return self.nodes[node_id].fetched < len(self._children(node_id))
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        node = self.nodes[self.node(parent)]
+        first = node.fetched
+        last = min(len(node.children), first + FETCH_BATCH) - 1
+        self._inserting = True
+        self.beginInsertRows(parent, first, last)
+        node.fetched = last + 1
+        self.endInsertRows()
+        self._inserting = False
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return COLUMNS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        node = self.nodes[self.node(index)]
+        if role in (Qt.DisplayRole, Qt.ToolTipRole):
+            return node.name if index.column() == 0 else node.value
+        return None
+
+
+def _preview_nodes(variable, dims):
+    """Rows with the first and last values of a variable of the xarray view,
+    read along its first dimension
+    """
+    if not dims:
+        return [_Node('Value', _format_value(variable.values))]
+    length = variable.shape[0]
+    head = variable.isel({dims[0]: slice(0, PREVIEW_VALUES)}).values
+    tail = variable.isel(
+        {dims[0]: slice(max(0, length - PREVIEW_VALUES), length)}).values
+    return [_Node('First values', _format_value(head)),
+            _Node('Last values', _format_value(tail))]
+
+
+def _format_value(value):
+    """Format an attribute or a preview of values on one line"""
+    if isinstance(value, np.ndarray):
+        return np.array2string(value, threshold=2 * PREVIEW_VALUES,
+                               max_line_width=10 ** 6).replace('\n', '')
+    return str(value)
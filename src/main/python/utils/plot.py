@@ -1,82 +1,504 @@
 """This module contains helper functions for plotting the dataset.
-The features include: scatter plot 3D, time series plot, and DART QC plot.
+The features include: scatter plot 3D, density map, time series plot, and
+DART QC plot.
+
+Each plot is a :class:`FigurePlot` that builds its axes, colorbar and land
+polygons once and is then updated in place with new data, so that it can be
+embedded in a window and redrawn cheaply when the subset changes. The
+``*_plot`` functions draw a plot into a new pyplot figure and show it.
+Large subsets are scatter plotted at a reduced level of detail, see
+:mod:`utils.lod`.
 """
 
-import itertools
+import warnings
+
 import numpy as np
 
 # Plotting library imports
 import matplotlib.pyplot as plt
 from matplotlib.collections import LineCollection, PolyCollection
-from mpl_toolkits.mplot3d import Axes3D
+from matplotlib.colors import LogNorm, Normalize
+# Registers the 3d projection
+from mpl_toolkits.mplot3d import Axes3D  # pylint: disable=unused-import
 
 import seaborn as sns
 
-import cartopy.feature
-from cartopy.mpl.patch import geos_to_path
-import cartopy.crs as ccrs
-
 from pandas.plotting import register_matplotlib_converters
+
+# Local imports
+from utils.coastlines import land_polygons, resolution_for_extent
+from utils.lod import ScatterLOD, DEFAULT_POINT_BUDGET
+from utils.raster import rasterize, RASTER_SHAPE, GLOBAL_EXTENT
+from utils.trace import traced
+
 register_matplotlib_converters()
 
+# DART QC flags, in the order they are shown from top to bottom
+QC_FLAGS = [7, 6, 5, 4, 3, 2, 1, 0]
+
+
+class FigurePlot(object):
+    """Base class of the plots that are kept alive and updated in place.
+
+    The canvas of ``figure`` must exist before the plot is created. With
+    ``blit`` set, the data artists are animated: after an update that does
+    not change the axis limits, the cached background is restored and only
+    the data artists are drawn again. Otherwise the whole figure is redrawn.
+
+    :param figure: Figure to draw into
+    :type figure: matplotlib.figure.Figure
+    :param blit: Whether to blit updates of the data artists
+    :type blit: bool, optional
+    """
+
+    def __init__(self, figure, blit=False):
+        self.figure = figure
+        self.blit = blit
+        self.data_artists = []
+        self._background = None
+        self._limits = None
+        if blit:
+            figure.canvas.mpl_connect(
+                'draw_event', lambda event: self._on_draw())
+
+    def add_data_artist(self, artist):
+        """Register an artist that changes with the data
+
+        :rtype: matplotlib.artist.Artist
+        """
+        artist.set_animated(self.blit)
+        self.data_artists.append(artist)
+        return artist
+
+    def redraw(self, full=False):
+        """Show the updated data artists
+
+        :param full: Whether something else than the data artists changed
+        :type full: bool, optional
+        """
+        canvas = self.figure.canvas
+        if full or self._background is None or \
+                self._limits != self._axis_limits():
+            canvas.draw_idle()
+            return
+        canvas.restore_region(self._background)
+        self._draw_data_artists()
+        canvas.blit(self.figure.bbox)
+
+    def _on_draw(self):
+        canvas = self.figure.canvas
+        if hasattr(canvas, 'copy_from_bbox'):
+            self._background = canvas.copy_from_bbox(self.figure.bbox)
+            self._limits = self._axis_limits()
+        self._draw_data_artists()
+
+    def _draw_data_artists(self):
+        for artist in self.data_artists:
+            self.figure.draw_artist(artist)
+
+    def _axis_limits(self):
+        return [(axes.get_xlim(), axes.get_ylim())
+                for axes in self.figure.axes]
+
+
+class Geo3DPlot(FigurePlot):
+    """3D scatter plot of a variable over the land
+
+    Subsets with more than ``point_budget`` observations are reduced with
+    :class:`utils.lod.ScatterLOD`; the reduction is redone for the visible
+    region whenever the user zooms, so detail appears as the view narrows.
+    The land polygons are likewise swapped for a finer resolution, see
+    :func:`utils.coastlines.resolution_for_extent`. 3D axes depend on the
+    view angle, so they are never blitted.
+
+    Building the polygons of a finer resolution may download and project
+    the Natural Earth shapefiles, which takes seconds. ``load_land`` moves
+    that work off the caller's thread: it is called as
+    ``load_land(resolution, on_loaded, on_failed)``, builds the polygons
+    with :func:`utils.coastlines.land_polygons` and later calls
+    ``on_loaded(polygons)`` or ``on_failed(message)`` on the thread that
+    owns the figure, ``message`` being None if the build was cancelled.
+    Until then the current resolution stays drawn, and for good if the
+    polygons cannot be built. Without ``load_land`` the polygons are built
+    synchronously.
+
+    :param figure: Figure to draw into
+    :type figure: matplotlib.figure.Figure
+    :param point_budget: Largest number of points drawn, or None to draw
+        every observation
+    :type point_budget: int, optional
+    :param lod_method: ``"voxel"`` or ``"sample"``, see
+        :class:`utils.lod.ScatterLOD`
+    :type lod_method: str, optional
+    :param load_land: Builds the land polygons in the background, or None
+        to build them synchronously
+    :type load_land: callable, optional
+    """
+
+    def __init__(self, figure, point_budget=DEFAULT_POINT_BUDGET,
+                 lod_method='voxel', load_land=None):
+        super(Geo3DPlot, self).__init__(figure)
+        self.point_budget = point_budget
+        self.lod_method = lod_method
+        self.load_land = load_land
+        self.lod = None
+        self.title = ''
+
+        self.ax = figure.add_subplot(1, 1, 1, projection='3d')
+        self.ax.set_xlim(-180, 180)
+        self.ax.set_ylim(-90, 90)
+        self.ax.set_zlim(bottom=0)
+
+        self.land = None
+        self.land_resolution = None
+        self.pending_resolution = None
+        self.failed_resolutions = set()
+        self.update_land()
+
+        self.scatter_plot = self.add_data_artist(self.ax.scatter(
+            [], [], [], c=[], s=1, alpha=0.5))
+        self.colorbar = figure.colorbar(self.scatter_plot, ax=self.ax)
+        self.ax.set_xlabel('degrees_east')
+        self.ax.set_ylabel('degrees_north')
+        self.ax.set_zlabel('Height')
+
+        timer = figure.canvas.new_timer(interval=200)
+        timer.single_shot = True
+        timer.add_callback(self.refine)
+
+        def schedule(_):
+            if self.lod is not None and len(self.lod) > self.lod.budget or \
+                    self.visible_resolution() != self.land_resolution:
+                timer.stop()
+                timer.start()
+        self.ax.callbacks.connect('xlim_changed', schedule)
+        self.ax.callbacks.connect('ylim_changed', schedule)
+
+    @traced()
+    def update(self, dataset, variable):
+        """Show a new subset
+
+        :param dataset: Subset to plot
+        :type dataset: xarray.Dataset
+        :param variable: Name of the variable used to color the points
+        :type variable: str
+        """
+        lon = dataset['lon'].values
+        if np.nanmax(lon) >= 180:
+            lon = lon - 180
+        vertical = dataset['vertical'].values
+        values = dataset[variable].values
+        self.lod = ScatterLOD(lon, dataset['lat'].values, vertical, values,
+                              self.point_budget, self.lod_method)
+        self.title = "{} Data".format(variable.capitalize())
+        self.scatter_plot.set_clim(np.nanmin(values), np.nanmax(values))
+        self.colorbar.update_normal(self.scatter_plot)
+        self.ax.set_zlim(0, np.nanmax(vertical) * 1.5)
+        self.refine()
+
+    def visible_resolution(self):
+        """Return the resolution of the land polygons for the visible region
+
+        :rtype: str
+        """
+        return resolution_for_extent(self.ax.get_xlim(), self.ax.get_ylim())
+
+    def update_land(self):
+        """Draw the land polygons at the resolution of the visible region,
+        replacing the polygons drawn at another resolution
+
+        With ``load_land`` the polygons are only requested here and swapped
+        in by :meth:`land_loaded`.
+
+        :return: Whether the polygons were replaced
+        :rtype: bool
+        """
+        resolution = self.visible_resolution()
+        if resolution in (self.land_resolution, self.pending_resolution) or \
+                resolution in self.failed_resolutions:
+            return False
+        if self.load_land is not None:
+            self.pending_resolution = resolution
+            self.load_land(
+                resolution,
+                lambda polys: self.land_loaded(resolution, polys),
+                lambda message: self.land_failed(resolution, message))
+            return False
+        try:
+            polys = land_polygons(resolution)
+        except Exception as error:  # pylint: disable=broad-except
+            self.land_failed(resolution, str(error))
+            warnings.warn("Unable to build the {} land polygons: {}".format(
+                resolution, error))
+            return False
+        self.set_land(resolution, polys)
+        return True
+
+    def land_loaded(self, resolution, polys):
+        """Swap in the land polygons built by ``load_land``
+
+        :param resolution: Resolution that was requested
+        :type resolution: str
+        :param polys: Polygons of the land at that resolution
+        :type polys: list
+        """
+        if resolution != self.pending_resolution:
+            return
+        self.pending_resolution = None
+        self.set_land(resolution, polys)
+        # The view may have moved on while the polygons were built
+        self.update_land()
+        self.redraw(full=True)
+
+    def land_failed(self, resolution, message):
+        """Keep the current land polygons when those of ``resolution``
+        cannot be built. They are not requested again, unless their build
+        was only cancelled.
 
-def geo_3d_plot(dataset, variable):
+        :param resolution: Resolution that was requested
+        :type resolution: str
+        :param message: Why the polygons could not be built, or None if
+            the build was cancelled
+        :type message: str
+        """
+        if resolution == self.pending_resolution:
+            self.pending_resolution = None
+        if message is not None:
+            self.failed_resolutions.add(resolution)
+
+    def set_land(self, resolution, polys):
+        """Replace the drawn land polygons
+
+        :param resolution: Resolution of ``polys``
+        :type resolution: str
+        :param polys: Polygons of the land
+        :type polys: list
+        """
+        color = True
+        if color:
+            line_collection = PolyCollection(polys, edgecolor='black',
+                                             facecolor='green', closed=False)
+        else:
+            line_collection = LineCollection(polys, color='black')
+        if self.land is not None:
+            self.land.remove()
+        self.ax.add_collection3d(line_collection)
+        self.land = line_collection
+        self.land_resolution = resolution
+
+    @traced()
+    def refine(self):
+        """Redo the level of detail reduction and choose the resolution of
+        the land polygons for the visible region"""
+        land_changed = self.update_land()
+        if self.lod is None:
+            if land_changed:
+                self.redraw(full=True)
+            return
+        if len(self.lod) > self.lod.budget:
+            points = self.lod.points(self.ax.get_xlim(), self.ax.get_ylim())
+        else:
+            points = self.lod.points()
+        # pylint: disable=protected-access
+        self.scatter_plot._offsets3d = (
+            points['lon'], points['lat'], points['vertical'])
+        self.scatter_plot.set_array(points['values'])
+        self.scatter_plot.set_sizes(_point_sizes(points['counts']))
+        self.ax.set_title(_lod_title(self.title, points, len(self.lod)))
+        self.redraw(full=True)
+
+
+class DensityPlot(FigurePlot):
+    """Map of the observations rasterized into a lon/lat grid.
+
+    Unlike :class:`Geo3DPlot`, the cost of drawing does not grow with the
+    number of observations: they are aggregated with
+    :func:`utils.raster.rasterize` and shown as one image over the land.
+
+    :param figure: Figure to draw into
+    :type figure: matplotlib.figure.Figure
+    :param shape: (rows, columns) of the grid
+    :type shape: tuple, optional
+    :param blit: Whether to blit updates, see :class:`FigurePlot`
+    :type blit: bool, optional
+    """
+
+    def __init__(self, figure, shape=RASTER_SHAPE, blit=False):
+        super(DensityPlot, self).__init__(figure, blit)
+        self.shape = shape
+        self.ax = figure.add_subplot(1, 1, 1)
+        self.ax.add_collection(PolyCollection(
+            land_polygons(resolution_for_extent(GLOBAL_EXTENT[:2],
+                                                GLOBAL_EXTENT[2:])),
+            edgecolor='black', facecolor='lightgrey', linewidth=0.5))
+        self.image = self.add_data_artist(self.ax.imshow(
+            np.ma.masked_all(shape), origin='lower', extent=GLOBAL_EXTENT,
+            interpolation='nearest'))
+        self.colorbar = figure.colorbar(self.image, ax=self.ax)
+        self.ax.set_xlim(GLOBAL_EXTENT[:2])
+        self.ax.set_ylim(GLOBAL_EXTENT[2:])
+        self.ax.set_xlabel('degrees_east')
+        self.ax.set_ylabel('degrees_north')
+
+    @traced()
+    def update(self, dataset, variable=None, how='count'):
+        """Show a new subset
+
+        :param dataset: Subset to plot
+        :type dataset: xarray.Dataset
+        :param variable: Name of the variable aggregated, unless ``how`` is
+            ``"count"``
+        :type variable: str, optional
+        :param how: ``"count"``, ``"mean"``, ``"min"`` or ``"max"``
+        :type how: str, optional
+        """
+        values = None if how == 'count' else dataset[variable].values
+        self.show_grid(rasterize(dataset['lon'].values, dataset['lat'].values,
+                                 values, how, self.shape, GLOBAL_EXTENT),
+                       variable, how)
+
+    @traced()
+    def show_grid(self, grid, variable=None, how='count'):
+        """Show an already rasterized subset, e.g. the density computed by
+        :func:`utils.chunked.reduce_subset` for a subset too large to load
+
+        :param grid: Aggregate of every cell, see
+            :func:`utils.raster.rasterize`
+        :type grid: numpy.ndarray
+        :param variable: Name of the variable aggregated, unless ``how`` is
+            ``"count"``
+        :type variable: str, optional
+        :param how: ``"count"``, ``"mean"``, ``"min"`` or ``"max"``
+        :type how: str, optional
+        """
+        if how == 'count':
+            grid = np.ma.masked_equal(grid, 0)
+            norm = LogNorm(vmin=1, vmax=max(1, grid.max() or 1))
+            label = 'Number of Observations'
+            title = "Observation Density"
+        else:
+            grid = np.ma.masked_invalid(grid)
+            norm = Normalize(vmin=grid.min(), vmax=grid.max())
+            label = ''
+            title = "{} {}".format(how.capitalize(), variable.capitalize())
+
+        old_norm = self.image.norm
+        full = type(norm) is not type(old_norm) or \
+            (norm.vmin, norm.vmax) != (old_norm.vmin, old_norm.vmax) or \
+            title != self.ax.get_title()
+        self.image.set_data(grid)
+        if full:
+            self.image.set_norm(norm)
+            self.colorbar.update_normal(self.image)
+            self.colorbar.set_label(label)
+            self.ax.set_title(title)
+        self.redraw(full)
+
+
+class QCTimeSeriesPlot(FigurePlot):
+    """Time series of the DART QC values
+
+    :param figure: Figure to draw into
+    :type figure: matplotlib.figure.Figure
+    :param blit: Whether to blit updates, see :class:`FigurePlot`
+    :type blit: bool, optional
+    """
+
+    def __init__(self, figure, blit=False):
+        super(QCTimeSeriesPlot, self).__init__(figure, blit)
+        sns.set()
+        self.ax = figure.add_subplot(1, 1, 1)
+        self.ax.xaxis_date()
+        self.line, = self.ax.plot([], [], 'o', markerfacecolor="None",
+                                  ms=5, alpha=0.3)
+        self.add_data_artist(self.line)
+        self.ax.set_title("QC Values Time Series")
+        self.ax.set_ylabel("QC Values")
+        self.ax.set_xlabel("Time")
+        self.ax.set_ylim(-0.1, 7.1)
+
+    @traced()
+    def update(self, dataset):
+        """Show a new subset
+
+        :param dataset: Subset to plot
+        :type dataset: xarray.Dataset
+        """
+        # Filter out invalid qc values:
+        qc = dataset['qc'].isel(qc_copy=1).values
+        valid = (qc >= 0) & (qc < 8)
+        time = dataset['time'].values[valid]
+        self.line.set_data(time, qc[valid])
+        if time.size:
+            old_limits = self.ax.get_xlim()
+            self.ax.relim()
+            self.ax.autoscale_view(scalex=True, scaley=False)
+            self.redraw(full=self.ax.get_xlim() != old_limits)
+        else:
+            self.redraw()
+
+
+class QCCountsPlot(FigurePlot):
+    """Count of observation corresponding to each qc value
+
+    :param figure: Figure to draw into
+    :type figure: matplotlib.figure.Figure
+    :param blit: Whether to blit updates, see :class:`FigurePlot`
+    :type blit: bool, optional
+    """
+
+    def __init__(self, figure, blit=False):
+        super(QCCountsPlot, self).__init__(figure, blit)
+        sns.set()
+        self.ax = figure.add_subplot(1, 1, 1)
+        # TODO: change the following to allow users choose which Quality
+        # Contorl they want to use
+        self.bars = self.ax.barh(
+            [str(flag) for flag in QC_FLAGS], np.zeros(len(QC_FLAGS)),
+            color=sns.color_palette(n_colors=len(QC_FLAGS)))
+        for bar in self.bars:
+            self.add_data_artist(bar)
+        self.ax.set_title("Distribution of DART Quality Control Values")
+        self.ax.set_xlabel('Number of Observations')
+        self.ax.set_ylabel('DART QC Values')
+
+    @traced()
+    def update(self, qc_counts):
+        """Show new counts
+
+        :param qc_counts: Number of observations of each DART QC flag, as
+            returned by utils.index.QCIndex.counts_of()
+        :type qc_counts: numpy.ndarray
+        """
+        counts = np.asarray(qc_counts)[QC_FLAGS]
+        for bar, count in zip(self.bars, counts):
+            bar.set_width(count)
+        limit = max(1, counts.max()) * 1.05
+        full = self.ax.get_xlim() != (0, limit)
+        if full:
+            self.ax.set_xlim(0, limit)
+        self.redraw(full)
+
+
+def geo_3d_plot(dataset, variable, point_budget=DEFAULT_POINT_BUDGET,
+                lod_method='voxel'):
     """
     Display 3D scatter plot of a variable within a specific group in a dataset
+
+    See :class:`Geo3DPlot` for the parameters.
+    """
+    Geo3DPlot(plt.figure(dpi=100), point_budget, lod_method).update(
+        dataset, variable)
+    plt.show()
+
+
+def density_plot(dataset, variable=None, how='count',
+                 shape=RASTER_SHAPE):
+    """Display a map of the observations rasterized into a lon/lat grid
+
+    See :class:`DensityPlot` for the parameters.
     """
-    fig = plt.figure(dpi=100)
-    ax = Axes3D(fig, xlim=[-180, 180], ylim=[-90, 90])
-    ax.set_zlim(bottom=0)
-
-    def concat(iterable):
-        return list(itertools.chain.from_iterable(iterable))
-    target_projection = ccrs.PlateCarree()
-    feature = cartopy.feature.NaturalEarthFeature(
-        'physical', 'land', '110m')
-    geoms = feature.geometries()
-    geoms = [target_projection.project_geometry(geom, feature.crs)
-             for geom in geoms]
-    paths = concat(geos_to_path(geom) for geom in geoms)
-
-    color = True
-    if color:
-        polys = concat(path.to_polygons() for path in paths)
-        line_collection = PolyCollection(polys, edgecolor='black',
-                                         facecolor='green', closed=False)
-    else:
-        segments = []
-        for path in paths:
-            vertices = [vertex for vertex, _ in path.iter_segments()]
-            vertices = np.asarray(vertices)
-            segments.append(vertices)
-        line_collection = LineCollection(segments, color='black')
-    ax.add_collection3d(line_collection)
-
-    if max(dataset['lon'].values) >= 180:
-        scatter_plot = ax.scatter(
-            dataset['lon'].values - 180,
-            dataset['lat'].values,
-            dataset['vertical'].values,
-            c=dataset[variable].values,
-            s=1,
-            alpha=0.5)
-    else:
-        scatter_plot = ax.scatter(
-            dataset['lon'].values,
-            dataset['lat'].values,
-            dataset['vertical'].values,
-            c=dataset[variable].values,
-            s=1,
-            alpha=0.5)
-
-    plt.colorbar(scatter_plot)
-    ax.add_collection3d(scatter_plot)
-
-    ax.set_zlim(0, max(dataset['vertical'].values) * 1.5)
-    ax.set_xlabel('degrees_east')
-    ax.set_ylabel('degrees_north')
-    ax.set_zlabel('Height')
-    plt.title("{} Data".format(variable.capitalize()))
+    DensityPlot(plt.figure(dpi=100), shape).update(dataset, variable, how)
     plt.show()
 
 
@@ -91,39 +513,28 @@ def time_series_qc_plot(dataset):
         dpi=80,
         facecolor='w',
         edgecolor='k')
-    sns.set()
-    # Filter out invalid qc values:
-    temp = dataset.where(dataset['qc'].T[1] < 8, drop=True)
-    plt.plot_date(x=temp['time'], xdate=True,
-                  y=temp['qc'].T[1].values,
-                  markerfacecolor="None", ms=5, alpha=0.3)
-    plt.title("QC Values Time Series")
-    plt.ylabel("QC Values")
-    plt.xlabel("Time")
-    plt.ylim(-0.1, 7.1)
+    QCTimeSeriesPlot(fig).update(dataset)
     plt.show()
 
 
-def qc_observations_plot(dataset):
+def qc_observations_plot(qc_counts):
     """Display count of observation corresponding to each qc value
 
-    :param dataset: Dataset returned from main.get_dataset_subset()
-    :type dataset: xarray.Dataset
+    :param qc_counts: Number of observations of each DART QC flag, as
+        returned by utils.index.QCIndex.counts_of()
+    :type qc_counts: numpy.ndarray
     """
-    plt.figure(figsize=(4, 3))
-    sns.set()
-    temp = dataset.where(dataset['qc'].T[1] < 8, drop=True)
-    try:
-        # TODO: change the following to allow users choose which Quality Contorl
-        # they want to use
-        sns.countplot(
-            y=dataset['qc'].T[1].values, order=[
-                7, 6, 5, 4, 3, 2, 1, 0])
-    except KeyError:
-        sns.countplot(
-            y=dataset['qc'].T[1].values, order=[
-                7, 6, 5, 4, 3, 2, 1, 0])
-    plt.title("Distribution of DART Quality Control Values")
-    plt.xlabel('Number of Observations')
-    plt.ylabel('DART QC Values')
+    QCCountsPlot(plt.figure(figsize=(4, 3))).update(qc_counts)
     plt.show()
+
+
+def _point_sizes(counts):
+    """Marker sizes growing with the number of observations behind a point"""
+    return np.minimum(np.sqrt(counts), 20)
+
+
+def _lod_title(title, points, total):
+    if points['counts'].size == total:
+        return title
+    return "{}\n({} points for {} observations)".format(
+        title, points['counts'].size, total)
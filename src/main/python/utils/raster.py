@@ -0,0 +1,76 @@
+"""This module contains the rasterization of observations into a fixed size
+lon/lat grid, used to draw density maps whose cost does not depend on how
+many observations are plotted.
+"""
+
+import numpy as np
+
+# (rows, columns) of the raster: half a degree cells over the globe
+RASTER_SHAPE = (360, 720)
+# (lon_min, lon_max, lat_min, lat_max) of the raster
+GLOBAL_EXTENT = (-180.0, 180.0, -90.0, 90.0)
+AGGREGATIONS = ('count', 'mean', 'min', 'max')
+
+
+def rasterize(lon, lat, values=None, how='count', shape=RASTER_SHAPE,
+              extent=GLOBAL_EXTENT):
+    """Aggregate observations into the cells of a lon/lat grid
+
+    Longitudes may use either the -180..180 or the 0..360 convention; they
+    are wrapped into the longitude range of ``extent``. Observations outside
+    of ``extent`` or with a missing coordinate are ignored.
+
+    :param lon: Longitude of every observation
+    :type lon: numpy.ndarray
+    :param lat: Latitude of every observation
+    :type lat: numpy.ndarray
+    :param values: Value of every observation, needed unless ``how`` is
+        ``"count"``
+    :type values: numpy.ndarray, optional
+    :param how: One of :data:`AGGREGATIONS`
+    :type how: str, optional
+    :param shape: (rows, columns) of the grid; rows go from south to north
+    :type shape: tuple, optional
+    :param extent: (lon_min, lon_max, lat_min, lat_max) of the grid
+    :type extent: tuple, optional
+    :return: The aggregate of every cell. Cells without observations are 0
+        for ``"count"`` and NaN otherwise.
+    :rtype: numpy.ndarray
+    """
+    if how not in AGGREGATIONS:
+        raise ValueError("Unknown aggregation {}".format(how))
+    if how != 'count' and values is None:
+        raise ValueError("Aggregation {} needs values".format(how))
+    n_rows, n_columns = shape
+    lon_min, lon_max, lat_min, lat_max = extent
+
+    lon = lon_min + np.mod(np.asarray(lon, dtype=np.float64) - lon_min, 360)
+    lat = np.asarray(lat, dtype=np.float64)
+    columns = np.floor((lon - lon_min) / (lon_max - lon_min) * n_columns)
+    rows = np.floor((lat - lat_min) / (lat_max - lat_min) * n_rows)
+    # Values on the upper edges belong to the last cell
+    columns[lon == lon_max] = n_columns - 1
+    rows[lat == lat_max] = n_rows - 1
+    inside = (columns >= 0) & (columns < n_columns) & \
+        (rows >= 0) & (rows < n_rows)
+    if values is not None:
+        values = np.asarray(values, dtype=np.float64)
+        inside &= ~np.isnan(values)
+        values = values[inside]
+    cells = (rows[inside] * n_columns + columns[inside]).astype(np.int64)
+
+    counts = np.bincount(cells, minlength=n_rows * n_columns)
+    if how == 'count':
+        return counts.reshape(shape)
+    grid = np.full(n_rows * n_columns, np.nan)
+    filled = counts > 0
+    if how == 'mean':
+        grid[filled] = np.bincount(
+            cells, weights=values, minlength=n_rows * n_columns)[filled] / \
+            counts[filled]
+    else:
+        order = np.argsort(cells, kind='mergesort')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+        reduce = np.minimum if how == 'min' else np.maximum
+        grid[filled] = reduce.reduceat(values[order], starts)
+    return grid.reshape(shape)
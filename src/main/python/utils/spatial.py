@@ -0,0 +1,168 @@
+"""This module contains the spatial index used to answer lon/lat bounding box
+and great-circle radius queries without scanning every observation.
+"""
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def normalize_lon(lon):
+    """Map longitudes to [0, 360)
+
+    :type lon: float or numpy.ndarray
+    """
+    return np.mod(lon, 360.0)
+
+
+def lon_ranges(lon_min, lon_max):
+    """Split a longitude interval into ranges within [0, 360].
+
+    Both conventions, -180..180 and 0..360, are accepted. An interval whose
+    minimum is larger than its maximum crosses the dateline (e.g. 170 to
+    -170), and an interval that is 360 degrees or wider covers every
+    longitude.
+
+    :return: (start, end) pairs, with 0 <= start <= end <= 360
+    :rtype: List of tuples
+    """
+    width = lon_max - lon_min
+    if width >= 360:
+        return [(0.0, 360.0)]
+    start = float(normalize_lon(lon_min))
+    end = start + float(np.mod(width, 360.0))
+    if end <= 360:
+        return [(start, end)]
+    return [(start, 360.0), (0.0, end - 360)]
+
+
+def haversine_km(lon1, lat1, lon2, lat2):
+    """Great-circle distance in km between points given in degrees"""
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class GridIndex(object):
+    """Uniform lat/lon bucket index over the observations.
+
+    Observations are bucketed into cells of ``cell_size`` degrees and stored
+    sorted by cell, together with their coordinates. A query only visits the
+    cells that overlap the queried region and tests the observations in them
+    exactly, so its cost depends on the size of the region rather than on
+    the number of observations in the file.
+
+    :param lon: Longitude of every observation
+    :type lon: numpy.ndarray
+    :param lat: Latitude of every observation
+    :type lat: numpy.ndarray
+    :param cell_size: Size of a cell in degrees
+    :type cell_size: float, optional
+    """
+
+    def __init__(self, lon, lat, cell_size=1.0):
+        self.cell_size = float(cell_size)
+        self.n_lon = int(np.ceil(360 / self.cell_size))
+        self.n_lat = int(np.ceil(180 / self.cell_size))
+
+        lon = normalize_lon(np.asarray(lon, dtype=np.float64))
+        lat = np.asarray(lat, dtype=np.float64)
+        valid = np.flatnonzero(~(np.isnan(lon) | np.isnan(lat)))
+        cells = self._cell(lon[valid], lat[valid])
+
+        order = np.argsort(cells, kind='mergesort')
+        self.positions = valid[order]
+        self.lon = lon[self.positions]
+        self.lat = lat[self.positions]
+        self.offsets = np.zeros(self.n_lon * self.n_lat + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=self.n_lon * self.n_lat),
+                  out=self.offsets[1:])
+
+    def _lon_bin(self, lon):
+        return np.minimum((lon // self.cell_size).astype(np.int64),
+                          self.n_lon - 1)
+
+    def _lat_bin(self, lat):
+        return np.clip(((lat + 90) // self.cell_size).astype(np.int64),
+                       0, self.n_lat - 1)
+
+    def _cell(self, lon, lat):
+        return self._lat_bin(lat) * self.n_lon + self._lon_bin(lon)
+
+    def _candidates(self, lon_bins, lat_bins):
+        """Return the indexes (into the cell-sorted arrays) of the
+        observations in the given cells
+        """
+        cells = (lat_bins[:, None] * self.n_lon + lon_bins[None, :]).ravel()
+        starts, ends = self.offsets[cells], self.offsets[cells + 1]
+        lengths = ends - starts
+        total = int(lengths.sum())
+        if not total:
+            return np.empty(0, dtype=np.int64)
+        shifts = np.repeat(starts - np.concatenate([[0], np.cumsum(
+            lengths)[:-1]]), lengths)
+        return shifts + np.arange(total)
+
+    def _lat_bins(self, lat_min, lat_max):
+        return np.arange(self._lat_bin(np.float64(lat_min)),
+                         self._lat_bin(np.float64(lat_max)) + 1)
+
+    def query_bbox(self, lon_min=None, lon_max=None, lat_min=None,
+                   lat_max=None):
+        """Return the positions of the observations inside a lon/lat box.
+
+        Longitude bounds follow :func:`lon_ranges`. A missing bound is
+        unbounded.
+
+        :return: Sorted positions along ``obs``
+        :rtype: numpy.ndarray
+        """
+        lat_min = -90.0 if lat_min is None else lat_min
+        lat_max = 90.0 if lat_max is None else lat_max
+        if lon_min is None or lon_max is None:
+            ranges = [(0.0, 360.0)]
+        else:
+            ranges = lon_ranges(lon_min, lon_max)
+        if lat_min > lat_max:
+            return np.empty(0, dtype=np.int64)
+
+        lat_bins = self._lat_bins(lat_min, lat_max)
+        found = []
+        for start, end in ranges:
+            lon_bins = np.arange(self._lon_bin(np.float64(start)),
+                                 self._lon_bin(np.float64(end)) + 1)
+            candidates = self._candidates(lon_bins, lat_bins)
+            lon, lat = self.lon[candidates], self.lat[candidates]
+            inside = (lon >= start) & (lon <= end) & \
+                (lat >= lat_min) & (lat <= lat_max)
+            found.append(self.positions[candidates[inside]])
+        return np.unique(np.concatenate(found))
+
+    def query_radius(self, lon, lat, radius_km):
+        """Return the positions of the observations within ``radius_km`` of
+        a point, measured along the great circle.
+
+        :return: Sorted positions along ``obs``
+        :rtype: numpy.ndarray
+        """
+        radius_deg = np.degrees(radius_km / EARTH_RADIUS_KM)
+        lat_min, lat_max = lat - radius_deg, lat + radius_deg
+        if lat_min <= -90 or lat_max >= 90 or radius_deg >= 90:
+            # The circle contains a pole: every longitude can be inside
+            ranges = [(0.0, 360.0)]
+        else:
+            half_width = np.degrees(np.arcsin(
+                np.sin(np.radians(radius_deg)) / np.cos(np.radians(lat))))
+            ranges = lon_ranges(lon - half_width, lon + half_width)
+
+        lat_bins = self._lat_bins(max(lat_min, -90.0), min(lat_max, 90.0))
+        found = []
+        for start, end in ranges:
+            lon_bins = np.arange(self._lon_bin(np.float64(start)),
+                                 self._lon_bin(np.float64(end)) + 1)
+            candidates = self._candidates(lon_bins, lat_bins)
+            inside = haversine_km(lon, lat, self.lon[candidates],
+                                  self.lat[candidates]) <= radius_km
+            found.append(self.positions[candidates[inside]])
+        return np.unique(np.concatenate(found))
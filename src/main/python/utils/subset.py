@@ -0,0 +1,633 @@
+"""This module contains helper functions for subsetting a DART dataset based on
+groups, location, time and QC values.
+
+A subset is described by a :class:`SubsetQuery`. The query is split into
+predicates, which :func:`plan` orders so that the most selective and cheapest
+predicate runs first; every later predicate only looks at the rows that are
+still selected. The result is a selection vector, the sorted positions of
+the selected rows along ``obs``, from which a consumer reads only the
+variables it needs (see :func:`utils.chunked.gather_rows`) rather than a
+copy of the dataset. Nothing here touches a widget, so subsetting can run on a
+worker thread, and the same query can be built from a script::
+
+    with DatasetHandle(path) as handle:
+        subset = subset_dataset(handle, SubsetQuery(
+            groups=['/Purple'], bbox=(0, 90, -30, 30), qc={0, 1}))
+
+The rows selected after every predicate can be kept in a
+:class:`SubsetCache`, so that a query differing from an earlier one in a
+single filter only evaluates that filter again, over the rows of the
+earlier query when the filter was narrowed.
+"""
+
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+# Local imports
+from utils.cache import get_summary
+from utils.spatial import EARTH_RADIUS_KM, lon_ranges
+from utils.trace import span, traced
+
+EMPTY_SUBSET_MESSAGE = "No observation values satisfy user input range"
+# Memory, in bytes, of the rows kept by a SubsetCache
+DEFAULT_CACHE_BYTES = 64 * 2 ** 20
+
+
+class SubsetError(Exception):
+    """Raised when the user input does not produce a valid subset"""
+
+
+class SubsetQuery(object):
+    """Declarative description of a subset
+
+    :param groups: Paths of the selected groups
+    :type groups: List of strings, optional
+    :param operator: ``"and"`` to intersect the groups, ``"or"`` to unite them
+    :type operator: str, optional
+    :param bbox: (lon_min, lon_max, lat_min, lat_max), any of which may be
+        None
+    :type bbox: tuple, optional
+    :param time_range: (time_min, time_max) as numpy.datetime64, either of
+        which may be None
+    :type time_range: tuple, optional
+    :param qc: DART QC values to keep, None keeps all of them
+    :type qc: Iterable of int, optional
+    :param exclude_groups: Paths of groups whose observations are dropped
+    :type exclude_groups: List of strings, optional
+    :param radius: (lon, lat, radius in km) of a circle around a point
+    :type radius: tuple, optional
+    """
+
+    def __init__(self, groups=(), operator='or', bbox=None, time_range=None,
+                 qc=None, exclude_groups=(), radius=None):
+        self.groups = list(groups)
+        self.operator = operator
+        self.exclude_groups = list(exclude_groups)
+        self.bbox = tuple(bbox) if bbox is not None else (None,) * 4
+        self.time_range = tuple(time_range) if time_range is not None \
+            else (None,) * 2
+        self.qc = frozenset(qc) if qc is not None else None
+        self.radius = tuple(radius) if radius is not None else None
+
+    def predicates(self):
+        """Split the query into the predicates that actually filter rows
+
+        :raises SubsetError: if fewer than two groups are combined with "and"
+        :rtype: List of Predicate
+        """
+        predicates = []
+        if self.groups:
+            if self.operator == 'and' and len(self.groups) < 2:
+                raise SubsetError("Please select at least 2 groups")
+        groups = [group for group in self.groups if group != "root"]
+        if self.operator == 'or' and "root" in self.groups:
+            groups = []
+        if groups or self.exclude_groups:
+            predicates.append(
+                GroupPredicate(groups, self.operator, self.exclude_groups))
+        if any(bound is not None for bound in self.bbox):
+            predicates.append(BBoxPredicate(*self.bbox))
+        if self.radius is not None:
+            predicates.append(RadiusPredicate(*self.radius))
+        if any(bound is not None for bound in self.time_range):
+            predicates.append(TimePredicate(*self.time_range))
+        if self.qc is not None:
+            predicates.append(QCPredicate(self.qc))
+        return predicates
+
+
+class Predicate(object):
+    """A filter on the rows of the ``obs`` dimension.
+
+    ``cost`` is the relative work per row. :meth:`selectivity` estimates the
+    fraction of rows that pass from the statistics of a
+    :class:`utils.cache.FileSummary`, and :meth:`evaluate` returns a boolean
+    mask over ``rows`` (positions along ``obs``, or None for all rows).
+    Predicates with the same :meth:`key` keep the same rows, and
+    :meth:`narrows` tells whether a predicate keeps a subset of the rows of
+    another one.
+    """
+    cost = 1.0
+
+    def key(self):
+        raise NotImplementedError
+
+    def narrows(self, other):
+        """Whether every row kept by this predicate is kept by ``other``
+
+        :type other: Predicate
+        :rtype: bool
+        """
+        return self.key() == other.key()
+
+    def selectivity(self, summary):
+        raise NotImplementedError
+
+    def evaluate(self, handle, summary, rows):
+        raise NotImplementedError
+
+
+class GroupPredicate(Predicate):
+    """Keep the observations in the selected groups and not in the excluded
+    ones. A selected group that has children stands for all of its
+    descendants, which are then combined with the operator.
+    """
+    cost = 0.5
+
+    def __init__(self, groups, operator, exclude_groups=()):
+        self.groups = groups
+        self.operator = operator
+        self.exclude_groups = exclude_groups
+
+    def key(self):
+        return ('groups', tuple(sorted(self.groups)), self.operator,
+                tuple(sorted(self.exclude_groups)))
+
+    def expression(self, bitmaps):
+        """Return the group expression evaluated by
+        :meth:`utils.index.GroupBitmaps.evaluate`
+        """
+        expression = None
+        if self.groups:
+            expression = (self.operator,) + tuple(self.groups)
+        if self.exclude_groups:
+            excluded = ('not', ('or',) + tuple(self.exclude_groups))
+            expression = excluded if expression is None \
+                else ('and', expression, excluded)
+        return expression
+
+    def selectivity(self, summary):
+        bitmaps = summary.group_bitmaps
+        fractions = [
+            sum(len(bitmaps.members(group_id))
+                for group_id in bitmaps.expand(group)) /
+            max(summary.n_obs, 1)
+            for group in self.groups] or [1.0]
+        if self.operator == 'and':
+            selectivity = float(np.prod(fractions))
+        else:
+            selectivity = min(1.0, sum(fractions))
+        excluded = sum(len(bitmaps.members(group_id))
+                       for group in self.exclude_groups
+                       for group_id in bitmaps.expand(group))
+        return selectivity * max(0.0, 1 - excluded / max(summary.n_obs, 1))
+
+    def evaluate(self, handle, summary, rows):
+        bitmaps = summary.group_bitmaps
+        selected = bitmaps.to_mask(bitmaps.evaluate(self.expression(bitmaps)))
+
+        # The bitmaps are indexed by obs label; convert them to positions
+        labels = handle.dataset.indexes['obs']
+        n_obs = handle.dataset.sizes['obs']
+        if labels.equals(pd.RangeIndex(n_obs)):
+            mask = np.zeros(n_obs, dtype=bool)
+            mask[:min(n_obs, selected.size)] = selected[:n_obs]
+        else:
+            positions = labels.get_indexer(np.flatnonzero(selected))
+            mask = np.zeros(n_obs, dtype=bool)
+            mask[positions[positions >= 0]] = True
+        return mask if rows is None else mask[rows]
+
+
+class BBoxPredicate(Predicate):
+    """Keep the observations inside a lon/lat box.
+
+    When both longitude bounds (or none) are given, the box is looked up in
+    the spatial index of the file; longitudes may then use either the
+    -180..180 or the 0..360 convention, and a box whose minimum longitude is
+    larger than its maximum crosses the dateline. A single longitude bound
+    is compared against the raw coordinate values.
+    """
+
+    def __init__(self, lon_min, lon_max, lat_min, lat_max):
+        self.bounds = {'lon': (lon_min, lon_max), 'lat': (lat_min, lat_max)}
+        self.use_index = (lon_min is None) == (lon_max is None)
+        self.cost = 0.5 if self.use_index else 2.0
+
+    def key(self):
+        return ('bbox', self.bounds['lon'], self.bounds['lat'])
+
+    def narrows(self, other):
+        if not isinstance(other, BBoxPredicate) or \
+                not self.use_index or not other.use_index:
+            return Predicate.narrows(self, other)
+        if not _within(self.bounds['lat'], other.bounds['lat']):
+            return False
+        if other.bounds['lon'][0] is None:
+            return True
+        if self.bounds['lon'][0] is None:
+            return False
+        # Compare the longitudes in 0..360, split at the dateline
+        return all(any(_within(inner, outer)
+                       for outer in lon_ranges(*other.bounds['lon']))
+                   for inner in lon_ranges(*self.bounds['lon']))
+
+    def selectivity(self, summary):
+        (lon_min, lon_max), (lat_min, lat_max) = \
+            self.bounds['lon'], self.bounds['lat']
+        lat_fraction = _histogram_fraction(
+            summary.histograms['lat'], lat_min, lat_max, summary.n_obs)
+        if not self.use_index or lon_min is None:
+            return lat_fraction * _histogram_fraction(
+                summary.histograms['lon'], lon_min, lon_max, summary.n_obs)
+        # The coordinates may use either convention, so every range is
+        # looked up both as 0..360 and as -180..180
+        lon_fraction = sum(
+            _histogram_fraction(summary.histograms['lon'], start - shift,
+                                end - shift, summary.n_obs)
+            for start, end in lon_ranges(lon_min, lon_max)
+            for shift in (0, 360))
+        return lat_fraction * min(1.0, lon_fraction)
+
+    def evaluate(self, handle, summary, rows):
+        if self.use_index:
+            (lon_min, lon_max), (lat_min, lat_max) = \
+                self.bounds['lon'], self.bounds['lat']
+            return _positions_mask(
+                summary.spatial_index(handle).query_bbox(
+                    lon_min, lon_max, lat_min, lat_max),
+                handle.dataset.sizes['obs'], rows)
+        mask = None
+        for name, (low, high) in self.bounds.items():
+            if low is None and high is None:
+                continue
+            values = read_rows(handle.dataset[name], rows)
+            mask = _combine(mask, _between(values, low, high))
+        return mask
+
+
+class RadiusPredicate(Predicate):
+    """Keep the observations within a great-circle distance of a point"""
+    cost = 0.5
+
+    def __init__(self, lon, lat, radius_km):
+        self.lon = lon
+        self.lat = lat
+        self.radius_km = radius_km
+
+    def key(self):
+        return ('radius', self.lon, self.lat, self.radius_km)
+
+    def narrows(self, other):
+        return isinstance(other, RadiusPredicate) and \
+            (self.lon, self.lat) == (other.lon, other.lat) and \
+            self.radius_km <= other.radius_km
+
+    def selectivity(self, summary):
+        radius_deg = np.degrees(self.radius_km / EARTH_RADIUS_KM)
+        width = radius_deg / max(np.cos(np.radians(self.lat)), 1e-6)
+        return BBoxPredicate(
+            self.lon - width, self.lon + width,
+            self.lat - radius_deg, self.lat + radius_deg).selectivity(summary)
+
+    def evaluate(self, handle, summary, rows):
+        return _positions_mask(
+            summary.spatial_index(handle).query_radius(
+                self.lon, self.lat, self.radius_km),
+            handle.dataset.sizes['obs'], rows)
+
+
+class TimePredicate(Predicate):
+    """Keep the observations inside a time window, looked up in the sorted
+    time index of the file
+    """
+    cost = 0.5
+
+    def __init__(self, time_min, time_max):
+        self.time_min = time_min
+        self.time_max = time_max
+
+    def key(self):
+        return ('time', _to_ns(self.time_min), _to_ns(self.time_max))
+
+    def narrows(self, other):
+        return isinstance(other, TimePredicate) and _within(
+            self.key()[1:], other.key()[1:])
+
+    def selectivity(self, summary):
+        return _histogram_fraction(
+            summary.histograms['time'], _to_ns(self.time_min),
+            _to_ns(self.time_max), summary.n_obs)
+
+    def evaluate(self, handle, summary, rows):
+        window = summary.time_index.window(self.time_min, self.time_max)
+        if not isinstance(window, slice):
+            return _positions_mask(window, summary.n_obs, rows)
+        if rows is None:
+            mask = np.zeros(summary.n_obs, dtype=bool)
+            mask[window] = True
+            return mask
+        return (rows >= window.start) & (rows < window.stop)
+
+
+class QCPredicate(Predicate):
+    """Keep the observations with one of the selected DART QC values, looked
+    up in the QC index of the file
+    """
+    cost = 0.5
+
+    def __init__(self, qc):
+        self.qc = sorted(qc)
+
+    def key(self):
+        return ('qc', tuple(self.qc))
+
+    def narrows(self, other):
+        return isinstance(other, QCPredicate) and \
+            set(self.qc).issubset(other.qc)
+
+    def selectivity(self, summary):
+        counts = summary.qc_index.counts
+        return counts[[flag for flag in self.qc
+                       if 0 <= flag < counts.size]].sum() / \
+            max(summary.n_obs, 1)
+
+    def evaluate(self, handle, summary, rows):
+        return _positions_mask(
+            summary.qc_index.rows(self.qc), summary.n_obs, rows)
+
+
+def _to_ns(time):
+    if time is None:
+        return None
+    return np.datetime64(time, 'ns').astype(np.int64)
+
+
+def _within(bounds, outer):
+    """Whether the interval ``bounds`` is inside ``outer``; both are
+    (low, high) pairs where None is unbounded
+    """
+    (low, high), (outer_low, outer_high) = bounds, outer
+    if outer_low is not None and (low is None or low < outer_low):
+        return False
+    return outer_high is None or (high is not None and high <= outer_high)
+
+
+def _histogram_fraction(histogram, low, high, total):
+    """Estimate the fraction of values in [low, high], interpolating linearly
+    inside the histogram bins
+    """
+    edges, counts = histogram
+    cumulative = np.concatenate([[0], np.cumsum(counts)])
+    low = edges[0] if low is None else low
+    high = edges[-1] if high is None else high
+    inside = np.interp(high, edges, cumulative) - \
+        np.interp(low, edges, cumulative)
+    return max(0.0, float(inside)) / max(total, 1)
+
+
+def _positions_mask(positions, n_obs, rows):
+    """Turn sorted positions into a mask over ``rows``"""
+    if rows is None:
+        mask = np.zeros(n_obs, dtype=bool)
+        mask[positions] = True
+        return mask
+    if not positions.size:
+        return np.zeros(rows.size, dtype=bool)
+    found = np.minimum(np.searchsorted(positions, rows), positions.size - 1)
+    return positions[found] == rows
+
+
+def _between(values, low, high):
+    mask = None
+    if low is not None:
+        mask = values >= low
+    if high is not None:
+        mask = _combine(mask, values <= high)
+    return mask
+
+
+def _combine(mask, other):
+    if mask is None or other is None:
+        return other if mask is None else mask
+    mask &= other
+    return mask
+
+
+def read_rows(data_array, rows):
+    """Read the values of a variable along ``obs`` at the given positions.
+
+    Variables of a :class:`utils.io.DatasetHandle` read runs of nearby
+    positions as slices, and only the values read are decoded (e.g. times).
+
+    :param data_array: Variable with ``obs`` as its first dimension
+    :type data_array: xr.DataArray
+    :param rows: Sorted positions along ``obs``, or None for all of them
+    :type rows: numpy.ndarray
+    :rtype: numpy.ndarray
+    """
+    if rows is None:
+        return data_array.values
+    if not rows.size:
+        return data_array.isel(obs=slice(0, 0)).values
+    return data_array.isel(obs=rows).values
+
+
+def plan(query, summary):
+    """Order the predicates of a query so that the rows are filtered as
+    cheaply as possible.
+
+    For independent filters, running them by decreasing
+    ``(1 - selectivity) / cost`` minimizes the expected work: a filter that
+    drops many rows for little work shrinks the input of all the others.
+
+    :param query: The subset
+    :type query: SubsetQuery
+    :param summary: Statistics of the file
+    :type summary: utils.cache.FileSummary
+    :return: The predicates, in the order they should run
+    :rtype: List of Predicate
+    """
+    return sorted(
+        query.predicates(),
+        key=lambda predicate: -(1 - predicate.selectivity(summary)) /
+        predicate.cost)
+
+
+def selection_vector(mask):
+    """Return the positions of the selected rows of a mask over ``obs``, as
+    32-bit integers unless the dimension is too long for them
+
+    :param mask: Boolean mask over ``obs``
+    :type mask: numpy.ndarray
+    :rtype: numpy.ndarray
+    """
+    positions = np.flatnonzero(mask)
+    if mask.size <= np.iinfo(np.int32).max:
+        return positions.astype(np.int32)
+    return positions
+
+
+class SubsetCache(object):
+    """Least recently used cache of the rows selected by earlier queries.
+
+    Every entry holds the rows of a file kept by a set of predicates, and
+    is stored by :func:`select_rows` after each predicate it evaluates. A
+    new query can start from an entry when each predicate of the entry is
+    in the query, or narrowed by a predicate of the query: only the other
+    predicates of the query are then evaluated, over the rows of the entry.
+    The cache can be shared between threads.
+
+    :param max_bytes: Memory of the rows kept; the least recently used
+        entries are dropped beyond it
+    :type max_bytes: int, optional
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # (path, keys of the predicates) -> (predicates, rows)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, path, predicates):
+        """Return the entry with the fewest rows that a query can start from
+
+        :param path: Path of the file
+        :type path: str
+        :param predicates: Predicates of the query
+        :type predicates: List of Predicate
+        :return: The predicates applied to the rows of the entry and the
+            rows, or None if no entry can be used
+        :rtype: tuple
+        """
+        with self._lock:
+            best = None
+            for entry_key, (applied, rows) in self._entries.items():
+                if entry_key[0] != path or \
+                        (best is not None and rows.size >= best[2].size):
+                    continue
+                if all(any(predicate.narrows(other)
+                           for predicate in predicates)
+                       for other in applied):
+                    best = (entry_key, applied, rows)
+            if best is None:
+                return None
+            self._entries.move_to_end(best[0])
+            return best[1], best[2]
+
+    def store(self, path, predicates, rows):
+        """Keep the rows of a file kept by a set of predicates. The rows are
+        made read-only, as they may be returned again.
+
+        :param path: Path of the file
+        :type path: str
+        :param predicates: The predicates applied
+        :type predicates: List of Predicate
+        :param rows: Sorted positions along ``obs``
+        :type rows: numpy.ndarray
+        """
+        entry_key = (path, frozenset(predicate.key()
+                                     for predicate in predicates))
+        rows.setflags(write=False)
+        with self._lock:
+            if entry_key in self._entries:
+                self._entries.move_to_end(entry_key)
+                return
+            if rows.nbytes > self.max_bytes:
+                return
+            self._entries[entry_key] = (tuple(predicates), rows)
+            self.nbytes += rows.nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        """Drop every entry"""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+@traced()
+def select_rows(handle, query, summary, progress=None, cache=None):
+    """Evaluate a query into the positions of the selected observations
+
+    With a ``cache``, the evaluation starts from the rows of the closest
+    earlier query, see :class:`SubsetCache`, and the rows after every
+    predicate evaluated are added to the cache.
+
+    :param cache: Rows selected by earlier queries
+    :type cache: SubsetCache, optional
+    :return: Sorted positions along ``obs``, see :func:`selection_vector`,
+        or None if every observation is selected
+    :rtype: numpy.ndarray
+    :raises SubsetError: if the query is invalid or selects nothing
+    """
+    with span('plan'):
+        predicates = plan(query, summary)
+    rows = None
+    applied = []
+    if cache is not None and predicates:
+        cached = cache.lookup(handle.path, predicates)
+        if cached is not None:
+            applied, rows = list(cached[0]), cached[1]
+            done = {predicate.key() for predicate in applied}
+            predicates = [predicate for predicate in predicates
+                          if predicate.key() not in done]
+    if rows is not None and not rows.size:
+        raise SubsetError(EMPTY_SUBSET_MESSAGE)
+    for count, predicate in enumerate(predicates, 1):
+        with span(type(predicate).__name__, rows_in=summary.n_obs
+                  if rows is None else rows.size) as current:
+            keep = predicate.evaluate(handle, summary, rows)
+            rows = selection_vector(keep) if rows is None else rows[keep]
+            current.set('rows_out', rows.size)
+        applied.append(predicate)
+        if cache is not None:
+            cache.store(handle.path, applied, rows)
+        if not rows.size:
+            raise SubsetError(EMPTY_SUBSET_MESSAGE)
+        if progress is not None:
+            progress(100 * count // len(predicates))
+    return rows
+
+
+def subset_dataset(handle, query, summary=None, progress=None):
+    """Subset the dataset based on groups, location, QC values and time.
+
+    The selected rows are computed with :func:`select_rows` and the dataset
+    is indexed once with ``isel``. Contiguous rows (e.g. a time window of a
+    file stored in time order) are selected with a slice, which stays lazy;
+    otherwise the result is a single copy of the selected rows. No variable
+    is converted to a NaN-able type.
+
+    :param handle: Handle of the open file
+    :type handle: utils.io.DatasetHandle
+    :param query: The subset
+    :type query: SubsetQuery
+    :param summary: Statistics of the file, read from the cache (or
+        computed) if not given
+    :type summary: utils.cache.FileSummary, optional
+    :param progress: Called with a percentage as the subsetting advances
+    :type progress: callable, optional
+    :raises SubsetError: if the query is invalid or the subset is empty
+    :return: the new dataset after subsetting
+    :rtype: xr.Dataset()
+    """
+    if summary is None:
+        summary = get_summary(handle)
+    return take_rows(handle.dataset,
+                     select_rows(handle, query, summary, progress))
+
+
+@traced()
+def take_rows(dataset, rows):
+    """Select rows along ``obs``
+
+    :param dataset: The dataset
+    :type dataset: xr.Dataset()
+    :param rows: Sorted positions, as returned by :func:`select_rows`
+    :type rows: numpy.ndarray
+    :rtype: xr.Dataset()
+    """
+    if rows is None:
+        return dataset
+    if rows[-1] - rows[0] + 1 == rows.size:
+        return dataset.isel(obs=slice(int(rows[0]), int(rows[-1]) + 1))
+    return dataset.isel(obs=rows)
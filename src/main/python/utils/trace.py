@@ -0,0 +1,267 @@
+"""This module contains a lightweight tracer used to find where the time of
+the viewer goes: reading files, looking up groups, subsetting or drawing.
+
+Work is measured in spans, nested per thread, which may carry counters such
+as the rows they select or the bytes they read::
+
+    with span('select_rows', rows_in=n_obs) as current:
+        rows = ...
+        current.set('rows_out', rows.size)
+
+Bytes read from a file are added to every open span of the reading thread
+with :func:`count`. Tracing is off unless the environment variable
+``DART_VIEWER_TRACE`` is set or :data:`TRACER` is enabled, e.g. from the
+"Performance" dock of the main window; a disabled span is a shared object
+that does nothing. Finished spans are kept in memory, summarized by
+:meth:`Tracer.summary` and written as Chrome trace events (viewable in
+``chrome://tracing`` or Perfetto) by :meth:`Tracer.export_chrome`.
+"""
+
+# Standard library imports
+import os
+import json
+import time
+import functools
+import threading
+from collections import deque, OrderedDict
+
+# Largest number of finished spans kept, older spans are dropped
+MAX_EVENTS = 100000
+
+
+class Span(object):
+    """A timed piece of work, recorded by its tracer when it ends
+
+    :param tracer: The tracer recording the span
+    :type tracer: Tracer
+    :param name: Name of the span
+    :type name: str
+    :param args: Counters of the span
+    :type args: dict
+    """
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def set(self, key, value):
+        """Set a counter of the span"""
+        self.args[key] = value
+
+    def add(self, key, value):
+        """Add to a counter of the span"""
+        self.args[key] = self.args.get(key, 0) + value
+
+    def __enter__(self):
+        self.tracer.stack().append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        end = time.perf_counter()
+        stack = self.tracer.stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        self.tracer.record(self.name, self.start, end, self.args)
+        return False
+
+
+class _NullSpan(object):
+    """The span returned while tracing is disabled"""
+    __slots__ = ()
+
+    def set(self, key, value):
+        pass
+
+    def add(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Tracer(object):
+    """Collects the spans of every thread
+
+    :param enabled: Whether spans are recorded
+    :type enabled: bool, optional
+    :param max_events: Largest number of spans kept
+    :type max_events: int, optional
+    """
+
+    def __init__(self, enabled=False, max_events=MAX_EVENTS):
+        self.enabled = enabled
+        self.events = deque(maxlen=max_events)
+        self.thread_names = dict()
+        # Number of spans recorded since the tracer was created
+        self.n_recorded = 0
+        self._origin = time.perf_counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def stack(self):
+        """Return the open spans of the calling thread, innermost last
+
+        :rtype: List of Span
+        """
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def span(self, name, **args):
+        """Return a span to use as a context manager, or a span that does
+        nothing if tracing is disabled
+
+        :param name: Name of the span
+        :type name: str
+        :param args: Initial counters of the span
+        :rtype: Span
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def count(self, key, value):
+        """Add to a counter of every open span of the calling thread
+
+        :param key: Name of the counter, e.g. ``"bytes_read"``
+        :type key: str
+        :param value: Amount added
+        :type value: int
+        """
+        if not self.enabled:
+            return
+        for current in self.stack():
+            current.add(key, value)
+
+    def record(self, name, start, end, args):
+        """Keep a finished span
+
+        :param start: Start time, from time.perf_counter
+        :type start: float
+        :param end: End time, from time.perf_counter
+        :type end: float
+        """
+        thread = threading.current_thread()
+        with self._lock:
+            self.thread_names[thread.ident] = thread.name
+            self.events.append((name, thread.ident, start - self._origin,
+                                end - start, args))
+            self.n_recorded += 1
+
+    def clear(self):
+        """Drop every finished span"""
+        with self._lock:
+            self.events.clear()
+
+    def summary(self):
+        """Aggregate the finished spans by name
+
+        :return: For every name, in order of first appearance, the number of
+            calls, the total and largest duration in seconds and the sum of
+            every counter
+        :rtype: OrderedDict
+        """
+        with self._lock:
+            events = list(self.events)
+        summary = OrderedDict()
+        for name, _, _, duration, args in events:
+            entry = summary.setdefault(
+                name, {'calls': 0, 'total': 0.0, 'max': 0.0, 'counters': {}})
+            entry['calls'] += 1
+            entry['total'] += duration
+            entry['max'] = max(entry['max'], duration)
+            for key, value in args.items():
+                if isinstance(value, (int, float)):
+                    entry['counters'][key] = \
+                        entry['counters'].get(key, 0) + value
+        return summary
+
+    def chrome_events(self):
+        """Return the finished spans as Chrome trace events
+
+        :rtype: List of dict
+        """
+        pid = os.getpid()
+        with self._lock:
+            events = list(self.events)
+            thread_names = dict(self.thread_names)
+        trace_events = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+             'args': {'name': name}}
+            for tid, name in thread_names.items()]
+        for name, tid, start, duration, args in events:
+            trace_events.append({
+                'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                'ts': start * 1e6, 'dur': duration * 1e6,
+                'args': {key: _json_value(value)
+                         for key, value in args.items()}})
+        return trace_events
+
+    def export_chrome(self, path):
+        """Write the finished spans as a Chrome trace event file
+
+        :param path: Path of the JSON file
+        :type path: str
+        """
+        with open(path, 'w') as output:
+            json.dump({'traceEvents': self.chrome_events(),
+                       'displayTimeUnit': 'ms'}, output)
+
+
+def _json_value(value):
+    """Convert a counter to a value that JSON can encode"""
+    if isinstance(value, (bool, int, float, str)) or value is None:
+        return value
+    try:
+        return value.item()
+    except AttributeError:
+        return str(value)
+
+
+# The tracer of the application
+TRACER = Tracer(enabled=bool(os.environ.get('DART_VIEWER_TRACE')))
+
+
+def span(name, **args):
+    """Start a span of :data:`TRACER`, see :meth:`Tracer.span`"""
+    if not TRACER.enabled:
+        return NULL_SPAN
+    return Span(TRACER, name, args)
+
+
+def count(key, value):
+    """Add to the counters of the open spans, see :meth:`Tracer.count`"""
+    if TRACER.enabled:
+        TRACER.count(key, value)
+
+
+def traced(name=None):
+    """Decorate a function so that every call is a span of :data:`TRACER`
+
+    :param name: Name of the spans, the qualified name of the function by
+        default
+    :type name: str, optional
+    """
+    def decorate(function):
+        label = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return function(*args, **kwargs)
+            with Span(TRACER, label, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
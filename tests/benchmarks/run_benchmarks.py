@@ -0,0 +1,294 @@
+"""Benchmarks of DART Viewer on synthetic files of growing size
+
+For every size, a synthetic file is generated (see ``synthetic.py``) and
+then, in a fresh process, the steps of the GUI are timed without a display:
+opening the file without and with a cached summary, looking up the groups
+of observations, every subset predicate on its own and all of them
+together, loading a subset and drawing every plot of ``utils.plot``. The
+wall time and the peak resident memory of the process after each step are
+written as JSON, and can be compared with an earlier run::
+
+    python tests/benchmarks/run_benchmarks.py --sizes 1e4 1e5 1e6 \\
+        -o results.json --baseline previous.json
+"""
+
+# Standard library imports
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import resource
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Plotting library imports
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure  # noqa: E402
+from matplotlib.backends.backend_agg import FigureCanvasAgg  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'src', 'main', 'python'))
+
+# Local imports
+import synthetic  # noqa: E402
+from utils.io import DatasetHandle  # noqa: E402
+from utils.cache import get_summary  # noqa: E402
+from utils.chunked import load_subset  # noqa: E402
+from utils.subset import SubsetQuery, select_rows  # noqa: E402
+from utils.plot import (  # noqa: E402
+    Geo3DPlot, DensityPlot, QCTimeSeriesPlot, QCCountsPlot)
+
+# Number of observations whose groups are looked up
+PARENT_GROUP_LOOKUPS = 1000
+# A step slower than this many times its baseline is reported, unless it
+# is only slower by less than REGRESSION_SECONDS
+REGRESSION_RATIO = 1.2
+REGRESSION_SECONDS = 0.01
+
+
+def peak_rss_mb():
+    """Return the peak resident memory of this process so far, in MB
+
+    :rtype: float
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+
+def benchmark_queries(summary):
+    """Return the subsets timed for a file: every predicate on its own, all
+    of them together, and two leaf groups combined with "and"
+
+    :rtype: dict
+    """
+    tree = summary.group_tree
+    top_groups = [tree.paths[index] for index in tree.children(-1)]
+    leaves = [path for index, path in enumerate(tree.paths)
+              if not tree.children(index).size]
+    time_min, time_max = summary.extents['time']
+    span = time_max - time_min
+    middle = (time_min + 2 * span // 5, time_min + 3 * span // 5)
+    return {
+        'groups': SubsetQuery(groups=top_groups[:1]),
+        'groups_and': SubsetQuery(groups=[leaves[0], leaves[-1]],
+                                  operator='and'),
+        'bbox': SubsetQuery(bbox=(100, 200, -30, 30)),
+        'radius': SubsetQuery(radius=(150, 0, 2000)),
+        'time': SubsetQuery(time_range=middle),
+        'qc': SubsetQuery(qc=(0, 1)),
+        'combined': SubsetQuery(
+            groups=top_groups[:1], bbox=(0, 270, -60, 60), time_range=middle,
+            qc=(0, 1, 2)),
+    }
+
+
+def benchmark_file(path, variable='observation'):
+    """Time every step of the GUI on one file. Meant to run in a process of
+    its own, so that the peak memory is that of this file only.
+
+    :param path: Path of the netCDF file
+    :type path: str
+    :param variable: Name of the variable plotted
+    :type variable: str, optional
+    :return: For every step, its name, wall time in seconds, the peak
+        memory of the process after it in MB, and any error
+    :rtype: List of dict
+    """
+    steps = []
+    start = time.perf_counter()
+
+    def record(name, **values):
+        nonlocal start
+        now = time.perf_counter()
+        step = {'step': name, 'seconds': now - start,
+                'peak_rss_mb': peak_rss_mb()}
+        step.update(values)
+        steps.append(step)
+        start = time.perf_counter()
+
+    def run(name, function):
+        nonlocal start
+        start = time.perf_counter()
+        try:
+            result = function()
+        except Exception as error:  # pylint: disable=broad-except
+            record(name, error=str(error) or type(error).__name__)
+            return None
+        record(name)
+        return result
+
+    cache_dir = tempfile.mkdtemp(prefix='dart_viewer_benchmark_')
+    try:
+        record('startup')
+        with DatasetHandle(path) as handle:
+            get_summary(handle, cache_dir)
+        record('open_cold')
+        handle = DatasetHandle(path)
+        summary = get_summary(handle, cache_dir)
+        record('open_cached')
+
+        lookups = np.random.RandomState(0).randint(
+            0, summary.n_obs, PARENT_GROUP_LOOKUPS)
+        run('parent_groups', lambda: [
+            summary.membership_index.groups_of(int(obs)) for obs in lookups])
+
+        subsets = dict()
+        for name, query in benchmark_queries(summary).items():
+            rows = run('subset_' + name,
+                       lambda: select_rows(handle, query, summary))
+            if rows is not None:
+                steps[-1]['n_selected'] = int(rows.size)
+                subsets[name] = rows
+
+        rows = subsets.get('groups')
+        loaded = run('load_subset', lambda: load_subset(
+            handle.dataset, rows, {variable, 'qc'}))
+        if loaded is not None:
+            dataset, density = loaded
+            qc_counts = summary.qc_index.counts_of(rows)
+            plots = {
+                'plot_geo3d': lambda figure: Geo3DPlot(figure).update(
+                    dataset, variable),
+                'plot_density': lambda figure: DensityPlot(figure).update(
+                    dataset) if density is None
+                else DensityPlot(figure).show_grid(density),
+                'plot_timeseries': lambda figure: QCTimeSeriesPlot(
+                    figure).update(dataset),
+                'plot_qccounts': lambda figure: QCCountsPlot(figure).update(
+                    qc_counts),
+            }
+            for name, draw in plots.items():
+                run(name, lambda: _render(draw))
+        handle.close()
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return steps
+
+
+def _render(draw):
+    """Draw a plot into a new figure and render it to PNG in memory"""
+    figure = Figure(dpi=100)
+    FigureCanvasAgg(figure)
+    draw(figure)
+    figure.savefig(io.BytesIO(), format='png')
+
+
+def synthetic_path(data_dir, n_obs, depth, fan_out, seed):
+    """Return the path of the synthetic file with the given parameters
+
+    :rtype: str
+    """
+    return os.path.join(data_dir, 'synthetic_{}_{}x{}_{}.nc'.format(
+        n_obs, depth, fan_out, seed))
+
+
+def compare(results, baseline):
+    """Return a line for every step slower than :data:`REGRESSION_RATIO`
+    times the same step of the same size in ``baseline``, ignoring
+    differences below :data:`REGRESSION_SECONDS`
+
+    :rtype: List of str
+    """
+    previous = {(run['n_obs'], step['step']): step['seconds']
+                for run in baseline['runs'] for step in run['steps']}
+    lines = []
+    for run in results['runs']:
+        for step in run['steps']:
+            before = previous.get((run['n_obs'], step['step']))
+            if before and step['seconds'] > max(
+                    REGRESSION_RATIO * before, before + REGRESSION_SECONDS):
+                lines.append('{} obs, {}: {:.3f}s, was {:.3f}s'.format(
+                    run['n_obs'], step['step'], step['seconds'], before))
+    return lines
+
+
+def parse_args(argv=None):
+    """Parse the command line
+
+    :rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark DART Viewer on synthetic files.")
+    parser.add_argument('--sizes', type=float, nargs='+',
+                        default=[1e4, 1e5, 1e6],
+                        help="Numbers of observations (default: 1e4 1e5 1e6)")
+    parser.add_argument('--depth', type=int, default=2,
+                        help="Number of levels of groups (default: 2)")
+    parser.add_argument('--fan-out', type=int, default=3,
+                        help="Children of every group (default: 3)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed of the synthetic files (default: 0)")
+    parser.add_argument('--variable', default='observation',
+                        help="Variable plotted (default: observation)")
+    parser.add_argument('--data-dir',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'dart_viewer_benchmarks'),
+                        help="Directory of the synthetic files, which are "
+                             "reused between runs")
+    parser.add_argument('-o', '--output', default='benchmarks.json',
+                        help="JSON file written (default: benchmarks.json)")
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="Earlier results to compare with")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Entry point of the benchmarks
+
+    :return: Exit status, 1 if any step regressed against the baseline
+    :rtype: int
+    """
+    args = parse_args(argv)
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'runs': [],
+    }
+    for n_obs in sorted(int(size) for size in args.sizes):
+        path = synthetic_path(args.data_dir, n_obs, args.depth, args.fan_out,
+                              args.seed)
+        start = time.perf_counter()
+        if not os.path.exists(path):
+            synthetic.generate(path + '.tmp', n_obs, args.depth,
+                               args.fan_out, seed=args.seed)
+            os.replace(path + '.tmp', path)
+        generate_seconds = time.perf_counter() - start
+
+        # A new process per file, so that peak memory is per file
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            steps = executor.submit(benchmark_file, path,
+                                    args.variable).result()
+        results['runs'].append({
+            'n_obs': n_obs, 'depth': args.depth, 'fan_out': args.fan_out,
+            'file_bytes': os.path.getsize(path),
+            'generate_seconds': generate_seconds, 'steps': steps})
+        for step in steps:
+            print('{:>10} obs  {:<20} {:8.3f}s {:8.1f} MB {}'.format(
+                n_obs, step['step'], step['seconds'], step['peak_rss_mb'],
+                step.get('error', '')), flush=True)
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file))
+        for line in regressions:
+            print('Slower: ' + line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
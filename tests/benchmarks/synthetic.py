@@ -0,0 +1,220 @@
+"""Generator of synthetic DART obs_seq netCDF files, laid out like the files
+DART Viewer reads (see ``tests/datasets/template.txt``): observations along
+``obs`` in the root group and a tree of groups, each with the ``obs_id`` of
+its observations.
+
+Every observation belongs to one leaf group, and to a second one with
+probability ``overlap``, unless it is left out of every group with
+probability ``ungrouped``; a group holds the observations of all its
+descendants. Files are written in blocks, so files larger than memory can
+be generated::
+
+    python tests/benchmarks/synthetic.py synthetic.nc --n-obs 100000000 \\
+        --depth 3 --fan-out 4
+"""
+
+# Standard library imports
+import argparse
+
+import numpy as np
+import netCDF4
+
+# Number of observations generated and written at a time
+BLOCK_SIZE = 1000000
+# Probability of each DART QC flag, 0 to 7
+DEFAULT_QC_WEIGHTS = (0.7, 0.05, 0.05, 0.0, 0.1, 0.05, 0.0, 0.05)
+# Days since 1601-01-01 of 2017-03-01, the start of the observations
+DEFAULT_TIME_START = 152000.0
+# Names of the groups at each level of the tree
+GROUP_NAMES = ('Apple', 'Orange', 'Purple', 'Lemon', 'Cherry', 'Plum',
+               'Grape', 'Peach')
+
+
+def group_tree(depth, fan_out):
+    """Return the groups of a tree of ``depth`` levels with ``fan_out``
+    children per group. Leaf groups are numbered in depth first order, so the
+    leaves below any group are a contiguous range.
+
+    :return: For every group, its path and the range [first, last) of the
+        leaves below it, parents before children
+    :rtype: List of tuples
+    """
+    groups = []
+
+    def add(path, level, first):
+        n_leaves = fan_out ** (depth - level)
+        groups.append((path, first, first + n_leaves))
+        if level < depth:
+            for child in range(fan_out):
+                name = '{}{}'.format(path.rsplit('/', 1)[-1],
+                                     chr(ord('A') + child))
+                add('{}/{}'.format(path, name), level + 1,
+                    first + child * n_leaves // fan_out)
+
+    for child in range(fan_out):
+        add('/' + GROUP_NAMES[child % len(GROUP_NAMES)] +
+            ('' if child < len(GROUP_NAMES)
+             else str(child // len(GROUP_NAMES))),
+            1, child * fan_out ** (depth - 1))
+    return groups
+
+
+def generate(path, n_obs, depth=2, fan_out=3, overlap=0.2,
+             qc_weights=DEFAULT_QC_WEIGHTS, lon_range=(0.0, 360.0),
+             lat_range=(-90.0, 90.0), time_start=DEFAULT_TIME_START,
+             time_span=1.0, seed=0, ungrouped=0.0):
+    """Write a synthetic DART obs_seq file
+
+    :param path: Path of the netCDF file written
+    :type path: str
+    :param n_obs: Number of observations
+    :type n_obs: int
+    :param depth: Number of levels of groups
+    :type depth: int, optional
+    :param fan_out: Number of children of every group, and of top level
+        groups
+    :type fan_out: int, optional
+    :param overlap: Probability that an observation is in a second leaf
+    :type overlap: float, optional
+    :param qc_weights: Probability of each DART QC flag, 0 to 7
+    :type qc_weights: Sequence of float, optional
+    :param lon_range: (min, max) of the longitudes, in 0..360
+    :type lon_range: tuple, optional
+    :param lat_range: (min, max) of the latitudes
+    :type lat_range: tuple, optional
+    :param time_start: Time of the first observation, in days since
+        1601-01-01
+    :type time_start: float, optional
+    :param time_span: Number of days covered by the observations
+    :type time_span: float, optional
+    :param seed: Seed of the random values
+    :type seed: int, optional
+    :param ungrouped: Probability that an observation is in no group
+    :type ungrouped: float, optional
+    """
+    qc_weights = np.asarray(qc_weights, dtype=np.float64)
+    qc_weights = qc_weights / qc_weights.sum()
+    groups = group_tree(depth, fan_out)
+    n_leaves = fan_out ** depth
+
+    dataset = netCDF4.Dataset(path, 'w', format='NETCDF4')
+    try:
+        dataset.author = "DART Viewer benchmark suite"
+        dataset.source = "synthetic"
+        dataset.conventions = "CF-1.7"
+        dataset.createDimension('obs', n_obs)
+        dataset.createDimension('qc_copy', 2)
+        variables = {
+            'obs': dataset.createVariable('obs', 'i4', ('obs',)),
+            'time': dataset.createVariable('time', 'f8', ('obs',)),
+            'lon': dataset.createVariable('lon', 'f8', ('obs',)),
+            'lat': dataset.createVariable('lat', 'f8', ('obs',)),
+            'vertical': dataset.createVariable('vertical', 'f8', ('obs',)),
+            'qc': dataset.createVariable('qc', 'i4', ('obs', 'qc_copy')),
+            'obs_key': dataset.createVariable('obs_key', 'i4', ('obs',)),
+            'observation': dataset.createVariable(
+                'observation', 'f8', ('obs',)),
+            'prior_ensemble_mean': dataset.createVariable(
+                'prior_ensemble_mean', 'f8', ('obs',)),
+        }
+        variables['time'].units = "days since 1601-1-1"
+        variables['time'].calendar = "GREGORIAN"
+        variables['lon'].units = "degrees_east"
+        variables['lat'].units = "degrees_north"
+        variables['vertical'].long_name = \
+            "vertical distance above the surface"
+        for name in ('qc', 'obs_key', 'observation', 'prior_ensemble_mean'):
+            variables[name].coordinates = "lat lon vertical time"
+        qc_copy = dataset.createVariable('qc_copy', 'i4', ('qc_copy',))
+        qc_copy.long_name = "quality control types"
+        qc_copy[:] = [1, 2]
+
+        obs_ids = dict()
+        for group_path, _, _ in groups:
+            group = dataset.createGroup(group_path)
+            group.createDimension('obs_id', None)
+            obs_ids[group_path] = group.createVariable(
+                'obs_id', 'i4', ('obs_id',), fill_value=-1,
+                chunksizes=(min(BLOCK_SIZE, 1 << 16),))
+        written = {group_path: 0 for group_path, _, _ in groups}
+
+        for start in range(0, n_obs, BLOCK_SIZE):
+            stop = min(n_obs, start + BLOCK_SIZE)
+            size = stop - start
+            random = np.random.RandomState([seed, start // BLOCK_SIZE])
+            obs = np.arange(start, stop)
+            variables['obs'][start:stop] = obs
+            variables['obs_key'][start:stop] = obs + 1
+            variables['time'][start:stop] = time_start + time_span * (
+                obs + random.uniform(size=size)) / n_obs
+            variables['lon'][start:stop] = random.uniform(*lon_range,
+                                                          size=size)
+            variables['lat'][start:stop] = random.uniform(*lat_range,
+                                                          size=size)
+            variables['vertical'][start:stop] = random.uniform(
+                0, 20000, size=size)
+            variables['qc'][start:stop] = np.stack(
+                [np.ones(size, dtype=np.int32),
+                 random.choice(8, size=size, p=qc_weights)], axis=1)
+            variables['observation'][start:stop] = random.normal(size=size)
+            variables['prior_ensemble_mean'][start:stop] = \
+                random.normal(size=size)
+
+            leaves = random.randint(0, n_leaves, size=size)
+            second = np.where(random.uniform(size=size) < overlap,
+                              random.randint(0, n_leaves, size=size), -1)
+            if ungrouped:
+                alone = random.uniform(size=size) < ungrouped
+                leaves[alone] = -1
+                second[alone] = -1
+            for group_path, first, last in groups:
+                members = obs[((leaves >= first) & (leaves < last)) |
+                              ((second >= first) & (second < last))]
+                offset = written[group_path]
+                obs_ids[group_path][offset:offset + members.size] = members
+                written[group_path] += members.size
+    finally:
+        dataset.close()
+
+
+def parse_args(argv=None):
+    """Parse the command line
+
+    :rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic DART obs_seq netCDF file.")
+    parser.add_argument('path', help="netCDF file written")
+    parser.add_argument('--n-obs', type=float, default=1e5,
+                        help="Number of observations (default: 1e5)")
+    parser.add_argument('--depth', type=int, default=2,
+                        help="Number of levels of groups (default: 2)")
+    parser.add_argument('--fan-out', type=int, default=3,
+                        help="Children of every group (default: 3)")
+    parser.add_argument('--overlap', type=float, default=0.2,
+                        help="Probability that an observation is in a "
+                             "second leaf group (default: 0.2)")
+    parser.add_argument('--qc-weights', type=float, nargs=8,
+                        default=DEFAULT_QC_WEIGHTS, metavar='WEIGHT',
+                        help="Relative frequency of DART QC flags 0 to 7")
+    parser.add_argument('--lon', type=float, nargs=2, default=(0.0, 360.0),
+                        metavar=('MIN', 'MAX'), help="Longitude range")
+    parser.add_argument('--lat', type=float, nargs=2, default=(-90.0, 90.0),
+                        metavar=('MIN', 'MAX'), help="Latitude range")
+    parser.add_argument('--days', type=float, default=1.0,
+                        help="Number of days covered (default: 1)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed of the random values (default: 0)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Entry point of the generator"""
+    args = parse_args(argv)
+    generate(args.path, int(args.n_obs), args.depth, args.fan_out,
+             args.overlap, args.qc_weights, tuple(args.lon), tuple(args.lat),
+             time_span=args.days, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,14 @@
+"""Configuration of the unit tests, run from the root of the repository with
+``python -m pytest tests``
+"""
+
+# Standard library imports
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'src', 'main', 'python'))
+sys.path.insert(0, os.path.join(TESTS_DIR, 'benchmarks'))
+
+# Notebook exports, benchmarks and data files are not unit tests
+collect_ignore = ['jupyter_tests', 'benchmarks', 'datasets']
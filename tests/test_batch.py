@@ -0,0 +1,27 @@
+"""Tests of the batch renderer"""
+
+# Local imports
+import synthetic
+import batch
+
+
+def test_empty_subset_is_skipped(tmp_path, capsys, monkeypatch):
+    monkeypatch.setenv('DART_VIEWER_CACHE_DIR', str(tmp_path))
+    path = str(tmp_path / 'obs.nc')
+    synthetic.generate(path, 1000, depth=1, fan_out=2)
+    argv = [path, '-v', 'observation', '-o', str(tmp_path / 'plots'),
+            '--plots', 'qccounts', '-j', '1',
+            '--groups', '/Apple', '/Lemon', '--operator', 'and']
+    assert batch.main(argv) == 0
+    output = capsys.readouterr().out
+    assert '0 observations, skipped' in output
+    assert '1 skipped, 0 failed' in output
+
+
+def test_invalid_query_fails(tmp_path, monkeypatch):
+    monkeypatch.setenv('DART_VIEWER_CACHE_DIR', str(tmp_path))
+    path = str(tmp_path / 'obs.nc')
+    synthetic.generate(path, 1000, depth=1, fan_out=2)
+    argv = [path, '-v', 'observation', '-o', str(tmp_path / 'plots'),
+            '-j', '1', '--groups', '/Apple', '--operator', 'and']
+    assert batch.main(argv) == 1
@@ -0,0 +1,21 @@
+"""Tests of utils.cache"""
+
+import numpy as np
+import xarray as xr
+
+# Local imports
+from utils.cache import read_whole
+
+
+def test_read_whole_matches_the_variables():
+    n_obs = 1003
+    dataset = xr.Dataset(
+        {'lon': ('obs', np.linspace(0, 359, n_obs)),
+         'time': ('obs', np.datetime64('2017-03-01') +
+                  np.arange(n_obs).astype('timedelta64[m]'))},
+        coords={'obs': np.arange(n_obs)})
+    arrays = read_whole(dataset, ('lon', 'time'), size=100)
+    for name in ('lon', 'time'):
+        assert arrays[name].dtype == dataset[name].dtype
+        assert (arrays[name] == dataset[name].values).all()
+    assert read_whole(dataset.isel(obs=slice(0)), ('lon',))['lon'].size == 0
@@ -0,0 +1,138 @@
+"""Tests of utils.catalog"""
+
+from functools import reduce
+
+import numpy as np
+import netCDF4
+import pytest
+
+# Local imports
+import synthetic
+from utils.catalog import FileCollection, MAX_OPEN_FILES
+from utils.io import FileClosedError
+from utils.subset import SubsetQuery, SubsetError
+
+N_OBS = 2000
+
+
+@pytest.fixture
+def collection(tmp_path):
+    # The first file has the groups /Apple and /Orange, the second one
+    # also has /Purple
+    paths = []
+    for index, fan_out in enumerate((2, 3)):
+        path = str(tmp_path / 'obs_{}.nc'.format(index))
+        synthetic.generate(path, N_OBS, depth=1, fan_out=fan_out,
+                           time_start=synthetic.DEFAULT_TIME_START + index,
+                           seed=index)
+        paths.append(path)
+    collection = FileCollection.open(paths, cache_dir=str(tmp_path))
+    yield collection
+    collection.close()
+
+
+def members(path, group):
+    with netCDF4.Dataset(path) as dataset:
+        return np.asarray(dataset[group]['obs_id'][:])
+
+
+def subset_keys(collection, query):
+    subset, _, _ = collection.subset(query, ['obs_key'])
+    return subset['obs_key'].values.tolist()
+
+
+def test_and_with_group_missing_from_a_file(collection):
+    first, second = collection.paths
+    query = SubsetQuery(['/Apple', '/Purple'], 'and')
+    expected = np.intersect1d(members(second, '/Apple'),
+                              members(second, '/Purple')) + 1
+    assert subset_keys(collection, query) == expected.tolist()
+
+
+def test_and_with_group_missing_from_every_file(collection):
+    query = SubsetQuery(['/Apple', '/Lemon'], 'and')
+    with pytest.raises(SubsetError):
+        collection.subset(query, ['obs_key'])
+
+
+def test_or_skips_group_missing_from_a_file(collection):
+    first, second = collection.paths
+    query = SubsetQuery(['/Apple', '/Purple'], 'or')
+    expected = np.concatenate([
+        members(first, '/Apple'),
+        np.union1d(members(second, '/Apple'), members(second, '/Purple'))])
+    assert subset_keys(collection, query) == (expected + 1).tolist()
+
+
+def brute_force(path, query):
+    """Keys of the observations of one file selected by the groups and QC
+    flags of a query, or an empty array if an "and" group is missing
+    """
+    with netCDF4.Dataset(path) as dataset:
+        ids = []
+        for group in query.groups:
+            if group.lstrip('/') not in dataset.groups:
+                if query.operator == 'and':
+                    return np.arange(0)
+                continue
+            ids.append(np.asarray(dataset[group]['obs_id'][:]))
+        qc = dataset['qc'][:, 1]
+    if not ids:
+        return np.arange(0)
+    if query.operator == 'and':
+        selected = reduce(np.intersect1d, ids)
+    else:
+        selected = np.unique(np.concatenate(ids))
+    if query.qc is not None:
+        selected = selected[np.isin(qc[selected], sorted(query.qc))]
+    return selected + 1
+
+
+def test_random_queries_match_brute_force(collection):
+    random = np.random.RandomState(0)
+    paths = ['/Apple', '/Orange', '/Purple']
+    for _ in range(20):
+        operator = random.choice(['and', 'or'])
+        query = SubsetQuery(
+            list(random.choice(paths, random.randint(2, 4), replace=False)),
+            operator,
+            qc=set(random.choice(8, 2)) if random.uniform() < 0.5 else None)
+        expected = np.concatenate([brute_force(path, query)
+                                   for path in collection.paths])
+        if not expected.size:
+            with pytest.raises(SubsetError):
+                collection.subset(query, ['obs_key'])
+        else:
+            assert subset_keys(collection, query) == expected.tolist()
+
+
+def test_pinned_file_outlives_eviction(tmp_path):
+    paths = []
+    for index in range(MAX_OPEN_FILES + 2):
+        path = str(tmp_path / 'f{:02d}.nc'.format(index))
+        synthetic.generate(path, 200, depth=1, fan_out=2,
+                           time_start=synthetic.DEFAULT_TIME_START + index,
+                           seed=index)
+        paths.append(path)
+    collection = FileCollection.open(paths, cache_dir=str(tmp_path))
+    try:
+        # As in the main window, the first file is shown while subsets read
+        # every file
+        shown, _ = collection.acquire(collection.paths[0])
+        evicted, _ = collection.get(collection.paths[1])
+        subset, _, _ = collection.subset(SubsetQuery(), {'qc'})
+        assert subset.sizes['obs'] == 200 * len(paths)
+
+        with netCDF4.Dataset(collection.paths[0]) as dataset:
+            expected = dataset['observation'][:]
+        assert not shown.closed
+        assert shown.dataset['observation'].values.tolist() == \
+            expected.tolist()
+        # A file that is not pinned is closed, and is never read again
+        assert evicted.closed
+        with pytest.raises(FileClosedError):
+            evicted.dataset['observation'].values
+        assert not collection.get(collection.paths[1])[0].closed
+    finally:
+        collection.close()
+    assert shown.closed
@@ -0,0 +1,72 @@
+"""Tests of utils.chunked"""
+
+import numpy as np
+import xarray as xr
+import pytest
+
+# Local imports
+from utils.chunked import (sample_positions, sample_rows, gather_rows,
+                           load_subset)
+
+
+class Stop(Exception):
+    pass
+
+
+@pytest.mark.parametrize('n, k', [(10, 0), (10, 3), (10, 7), (10, 10),
+                                  (10 ** 9, 1000)])
+def test_sample_positions_are_distinct_and_sorted(n, k):
+    positions = sample_positions(n, k, np.random.RandomState(0))
+    assert positions.size == k
+    assert (np.diff(positions) > 0).all()
+    assert positions.size == 0 or (0 <= positions[0] and positions[-1] < n)
+
+
+def test_sample_positions_are_uniform():
+    random = np.random.RandomState(0)
+    counts = np.zeros(20)
+    for _ in range(4000):
+        counts[sample_positions(20, 5, random)] += 1
+    # Every position is kept a quarter of the time
+    assert np.abs(counts / 4000 - 0.25).max() < 0.03
+
+
+def test_sample_rows_keeps_small_subsets():
+    rows = np.array([1, 4, 6])
+    assert sample_rows(rows, 10, 5) is rows
+    assert sample_rows(None, 3, 5).tolist() == [0, 1, 2]
+    sample = sample_rows(np.arange(0, 100, 2), 100, 10)
+    assert sample.size == 10 and np.isin(sample, np.arange(0, 100, 2)).all()
+
+
+def make_dataset(n_obs=1000):
+    return xr.Dataset({'lon': ('obs', np.linspace(0, 359, n_obs)),
+                       'lat': ('obs', np.linspace(-89, 89, n_obs)),
+                       'value': ('obs', np.arange(n_obs, dtype=float))},
+                      coords={'obs': np.arange(n_obs)})
+
+
+def test_gather_rows_reports_progress():
+    dataset = make_dataset()
+    rows = np.arange(0, 1000, 3)
+    reported = []
+    # Chunks of 16 observations of 3 float variables
+    gathered = gather_rows(dataset, rows, ['lon', 'lat', 'value'],
+                           budget=16 * 24 * 4, progress=reported.append)
+    assert gathered['value'].values.tolist() == rows.tolist()
+    assert len(reported) > 1 and reported == sorted(reported)
+
+
+def test_progress_stops_reduce_subset():
+    dataset = make_dataset()
+    reported = []
+
+    def progress(percent):
+        reported.append(percent)
+        if len(reported) == 3:
+            raise Stop()
+
+    with pytest.raises(Stop):
+        load_subset(dataset, None, ['value'], budget=1000,
+                    point_budget=10, progress=progress)
+    assert len(reported) == 3
@@ -0,0 +1,63 @@
+"""Tests of utils.group_model"""
+
+import numpy as np
+from PyQt5.QtCore import Qt
+
+# Local imports
+import synthetic
+from utils.io import GroupTree, DatasetHandle
+from utils.cache import get_summary
+from utils.group_model import GroupTreeModel
+from utils.subset import SubsetQuery, select_rows
+
+PATHS = ['/Apple', '/Apple/AppleA', '/Apple/AppleB', '/Orange']
+
+
+def make_model():
+    tree = GroupTree(PATHS, np.array([-1, 0, 0, -1]),
+                     np.array([5, 3, 3, 4]))
+    return GroupTreeModel(tree, n_obs=10)
+
+
+def test_checked_children_are_not_collapsed_for_and():
+    model = make_model()
+    model.set_checked(2, True)
+    model.set_checked(3, True)
+    assert model.states[1] == Qt.Checked
+    assert model.checked_paths() == {'/Apple'}
+    assert model.checked_paths(leaves=True) == \
+        {'/Apple/AppleA', '/Apple/AppleB'}
+
+
+def test_checked_root_stands_for_the_whole_file():
+    model = make_model()
+    model.set_checked(0, True)
+    assert model.checked_paths() == {'root'}
+    assert model.checked_paths(leaves=True) == \
+        {'root', '/Apple/AppleA', '/Apple/AppleB', '/Orange'}
+
+
+def test_checked_root_selects_every_observation(tmp_path):
+    path = str(tmp_path / 'obs.nc')
+    synthetic.generate(path, 1000, depth=2, fan_out=2, ungrouped=0.2)
+    with DatasetHandle(path) as handle:
+        summary = get_summary(handle, cache_dir=str(tmp_path))
+        model = GroupTreeModel(summary.group_tree, summary.n_obs)
+        model.set_checked(0, True)
+        rows = select_rows(handle, SubsetQuery(
+            sorted(model.checked_paths()), 'or'), summary)
+        n_selected = summary.n_obs if rows is None else rows.size
+        # The top level groups leave out the observations in no group
+        top_level = select_rows(handle, SubsetQuery(
+            ['/Apple', '/Orange'], 'or'), summary)
+    assert n_selected == 1000
+    assert top_level.size < 1000
+
+
+def test_partially_checked_branch():
+    model = make_model()
+    model.set_checked(2, True)
+    model.set_checked(4, True)
+    assert model.states[1] == Qt.PartiallyChecked
+    assert model.checked_paths() == {'/Apple/AppleA', '/Orange'}
+    assert model.checked_paths(leaves=True) == {'/Apple/AppleA', '/Orange'}
@@ -0,0 +1,153 @@
+"""Tests of utils.index"""
+
+from functools import reduce
+
+import numpy as np
+import pytest
+
+# Local imports
+import synthetic
+from utils.index import GroupMembershipIndex, GroupBitmaps, TimeIndex, \
+    QCIndex
+
+GROUPS = {
+    '/Apple/AppleA': [0, 1, 2, 3],
+    '/Apple/AppleB': [2, 3, 4],
+    '/Orange': [1, 3, 5, 7],
+}
+N_OBS = 10
+
+
+def make_bitmaps(groups=None):
+    groups = GROUPS if groups is None else groups
+    paths = list(groups)
+    return GroupBitmaps(GroupMembershipIndex.from_obs_ids(
+        paths, [np.array(groups[path]) for path in paths], N_OBS))
+
+
+def selected(bitmaps, expression):
+    return np.flatnonzero(bitmaps.to_mask(bitmaps.evaluate(expression)))
+
+
+def test_empty_and_selects_nothing():
+    bitmaps = make_bitmaps()
+    assert selected(bitmaps, ('and',)).size == 0
+    assert selected(bitmaps, ('or',)).size == 0
+
+
+def test_and_with_unknown_group_selects_nothing():
+    bitmaps = make_bitmaps()
+    assert selected(bitmaps, ('and', '/Nope', '/Nope2')).size == 0
+    assert selected(bitmaps, ('and', '/Apple/AppleA', '/Nope')).size == 0
+
+
+def test_or_skips_unknown_group():
+    bitmaps = make_bitmaps()
+    assert selected(bitmaps, ('or', '/Orange', '/Nope')).tolist() == \
+        GROUPS['/Orange']
+
+
+def test_parent_stands_for_its_descendants():
+    bitmaps = make_bitmaps()
+    apple_and = np.intersect1d(GROUPS['/Apple/AppleA'],
+                               GROUPS['/Apple/AppleB'])
+    apple_or = np.union1d(GROUPS['/Apple/AppleA'], GROUPS['/Apple/AppleB'])
+    assert selected(bitmaps, ('and', '/Apple')).tolist() == \
+        apple_and.tolist()
+    assert selected(bitmaps, ('or', '/Apple')).tolist() == apple_or.tolist()
+    # A path on its own is combined with "or"
+    assert selected(bitmaps, '/Apple').tolist() == apple_or.tolist()
+    assert selected(bitmaps, ('and', '/Apple', '/Orange')).tolist() == \
+        np.intersect1d(apple_and, GROUPS['/Orange']).tolist()
+
+
+def test_not_excludes():
+    bitmaps = make_bitmaps()
+    expected = np.setdiff1d(np.arange(N_OBS), GROUPS['/Orange'])
+    assert selected(bitmaps, ('not', '/Orange')).tolist() == \
+        expected.tolist()
+
+
+def random_groups(random, n_obs, depth=2, fan_out=3):
+    """Members of the groups of a synthetic tree, where a group holds the
+    observations of all its descendants
+    """
+    tree = synthetic.group_tree(depth, fan_out)
+    leaves = random.randint(0, fan_out ** depth, size=n_obs)
+    return {path: np.flatnonzero((leaves >= first) & (leaves < last))
+            for path, first, last in tree}
+
+
+def expand(groups, path):
+    descendants = [other for other in groups
+                   if other.startswith(path + '/')]
+    return [groups[other] for other in descendants or [path]]
+
+
+def brute_force(groups, expression, n_obs):
+    if isinstance(expression, str):
+        expression = ('or', expression)
+    operator, operands = expression[0], expression[1:]
+    if operator == 'not':
+        return np.setdiff1d(np.arange(n_obs),
+                            brute_force(groups, operands[0], n_obs))
+    members = []
+    for operand in operands:
+        if isinstance(operand, str):
+            members += expand(groups, operand)
+        else:
+            members.append(brute_force(groups, operand, n_obs))
+    if operator == 'and':
+        return reduce(np.intersect1d, members)
+    return np.unique(np.concatenate(members))
+
+
+def test_random_expressions_match_brute_force():
+    random = np.random.RandomState(0)
+    n_obs = 1000
+    groups = random_groups(random, n_obs)
+    paths = list(groups)
+    bitmaps = GroupBitmaps(GroupMembershipIndex.from_obs_ids(
+        paths, [groups[path] for path in paths], n_obs))
+    for _ in range(200):
+        operator = random.choice(['and', 'or'])
+        expression = (operator,) + tuple(
+            random.choice(paths, random.randint(1, 4), replace=False))
+        if random.uniform() < 0.3:
+            expression = ('and', expression, ('not', random.choice(paths)))
+        assert np.flatnonzero(bitmaps.to_mask(
+            bitmaps.evaluate(expression))).tolist() == \
+            brute_force(groups, expression, n_obs).tolist()
+
+
+@pytest.mark.parametrize('shuffled', [False, True])
+def test_time_window_matches_brute_force(shuffled):
+    random = np.random.RandomState(0)
+    times = np.datetime64('2017-03-01', 'ns') + np.sort(
+        random.randint(0, 10 ** 12, size=500)).astype('timedelta64[ns]')
+    if shuffled:
+        random.shuffle(times)
+        times[::50] = np.datetime64('NaT')
+    index = TimeIndex.from_times(times)
+    assert index.is_sorted != shuffled
+    for _ in range(50):
+        low, high = np.sort(random.choice(times[~np.isnat(times)], 2))
+        window = index.window(low, high)
+        positions = np.arange(times.size)[window] \
+            if isinstance(window, slice) else window
+        expected = np.flatnonzero((times >= low) & (times <= high))
+        assert positions.tolist() == expected.tolist()
+
+
+def test_qc_rows_match_brute_force():
+    random = np.random.RandomState(0)
+    qc = random.randint(0, 10, size=1000).astype(float)
+    qc[::7] = np.nan
+    index = QCIndex.from_values(qc)
+    for flags in ([0], [1, 4], [7, 2, 5]):
+        assert index.rows(flags).tolist() == \
+            np.flatnonzero(np.isin(qc, flags)).tolist()
+    assert index.counts[:8].tolist() == \
+        [int((qc == flag).sum()) for flag in range(8)]
+    assert index.counts_of(np.arange(0, 1000, 3)).tolist() == \
+        np.bincount(QCIndex.encode(qc[::3]), minlength=9).tolist()
@@ -0,0 +1,60 @@
+"""Tests of utils.io"""
+
+import numpy as np
+import netCDF4
+import pytest
+
+# Local imports
+import synthetic
+from utils import io, trace
+from utils.io import DatasetHandle, FileClosedError
+
+N_OBS = 5000
+
+
+def test_read_rows_counts_slices_read(tmp_path, monkeypatch):
+    path = str(tmp_path / 'obs.nc')
+    synthetic.generate(path, N_OBS, depth=1, fan_out=2)
+    # Runs of float64 rows at most 10 rows apart are read as one slice
+    monkeypatch.setattr(io, 'READ_GAP_BYTES', 80)
+    rows = np.array([4000, 3, 10, 20, 35, 4000, 4004])
+    with netCDF4.Dataset(path) as dataset:
+        expected = dataset['observation'][:][rows]
+    with DatasetHandle(path) as handle:
+        before = handle.bytes_read
+        values = handle.dataset['observation'].isel(obs=rows).values
+        # Slices [3, 20], [35, 35] and [4000, 4004]
+        assert handle.bytes_read - before == (18 + 1 + 5) * 8
+    assert values.tolist() == expected.tolist()
+
+
+def test_prefetched_bytes_are_counted_by_the_consumer(tmp_path, monkeypatch):
+    path = str(tmp_path / 'obs.nc')
+    synthetic.generate(path, N_OBS, depth=1, fan_out=2)
+    tracer = trace.Tracer(enabled=True)
+    monkeypatch.setattr(trace, 'TRACER', tracer)
+    with DatasetHandle(path) as handle:
+        before = handle.bytes_read
+        with trace.span('iter_blocks') as current:
+            blocks = list(handle.iter_blocks('/observation',
+                                             block_bytes=8000))
+        assert len(blocks) > 2
+        assert current.args['bytes_read'] == handle.bytes_read - before
+
+
+def test_closed_handle_does_not_read_another_file(tmp_path):
+    paths = [str(tmp_path / 'obs_{}.nc'.format(seed)) for seed in (0, 1)]
+    for seed, path in enumerate(paths):
+        synthetic.generate(path, N_OBS, depth=1, fan_out=2, seed=seed)
+    handle = DatasetHandle(paths[0])
+    observation = handle.dataset['observation']
+    handle.close()
+    handle.close()
+    # The netCDF library may give the id of the closed file to this one
+    with DatasetHandle(paths[1]):
+        with pytest.raises(FileClosedError):
+            observation.values
+        with pytest.raises(FileClosedError):
+            handle.read_variable('/Apple/obs_id')
+        with pytest.raises(FileClosedError):
+            list(handle.iter_blocks('/Apple/obs_id'))
@@ -0,0 +1,148 @@
+"""Tests of utils.subset, against a brute force evaluation of random queries
+with the semantics of the original subset code: a group with children
+stands for its descendants, which are intersected with ``np.intersect1d``
+for "and" and united with ``np.unique`` for "or".
+"""
+
+from functools import reduce
+
+import numpy as np
+import netCDF4
+import pytest
+
+# Local imports
+import synthetic
+from utils.cache import get_summary
+from utils.io import DatasetHandle
+from utils.spatial import haversine_km
+from utils.subset import SubsetQuery, SubsetError, SubsetCache, select_rows
+
+N_OBS = 5000
+N_QUERIES = 60
+
+
+@pytest.fixture(scope='module')
+def dataset_file(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('subset')
+    path = str(directory / 'obs.nc')
+    synthetic.generate(path, N_OBS, depth=2, fan_out=3, overlap=0.3)
+    with netCDF4.Dataset(path) as dataset:
+        groups = {group_path: np.asarray(dataset[group_path]['obs_id'][:])
+                  for group_path, _, _ in synthetic.group_tree(2, 3)}
+    handle = DatasetHandle(path)
+    summary = get_summary(handle, cache_dir=str(directory))
+    columns = {name: handle.dataset[name].values
+               for name in ('lon', 'lat', 'time')}
+    columns['qc'] = handle.dataset['qc'].values[:, 1]
+    yield handle, summary, groups, columns
+    handle.close()
+
+
+def obs_ids(groups, selected):
+    """The obs_id arrays of the selected groups, with every group that has
+    children replaced by its descendants
+    """
+    expanded = []
+    for group in selected:
+        descendants = [path for path in groups
+                       if path.startswith(group + '/')]
+        expanded += descendants or [group]
+    return [groups[path] for path in expanded]
+
+
+def brute_force(query, groups, columns):
+    mask = np.ones(N_OBS, dtype=bool)
+    if query.groups:
+        ids = obs_ids(groups, query.groups)
+        if query.operator == 'and':
+            selected = reduce(np.intersect1d, ids)
+        else:
+            selected = np.unique(np.concatenate(ids))
+        mask &= np.isin(np.arange(N_OBS), selected)
+    if query.exclude_groups:
+        mask &= ~np.isin(np.arange(N_OBS), np.concatenate(
+            obs_ids(groups, query.exclude_groups)))
+    lon_min, lon_max, lat_min, lat_max = query.bbox
+    if lon_min is not None:
+        mask &= (columns['lon'] >= lon_min) & (columns['lon'] <= lon_max)
+    if lat_min is not None:
+        mask &= (columns['lat'] >= lat_min) & (columns['lat'] <= lat_max)
+    if query.radius is not None:
+        lon, lat, radius = query.radius
+        mask &= haversine_km(lon, lat, columns['lon'],
+                             columns['lat']) <= radius
+    time_min, time_max = query.time_range
+    if time_min is not None:
+        mask &= (columns['time'] >= time_min) & (columns['time'] <= time_max)
+    if query.qc is not None:
+        mask &= np.isin(columns['qc'], sorted(query.qc))
+    return np.flatnonzero(mask)
+
+
+def random_queries(columns, seed=0):
+    random = np.random.RandomState(seed)
+    paths = [path for path, _, _ in synthetic.group_tree(2, 3)]
+    times = np.sort(columns['time'])
+    queries = []
+    for _ in range(N_QUERIES):
+        operator = random.choice(['and', 'or'])
+        n_groups = random.randint(2 if operator == 'and' else 0, 4)
+        kwargs = {'groups': list(random.choice(paths, n_groups,
+                                               replace=False)),
+                  'operator': operator}
+        if random.uniform() < 0.3:
+            kwargs['exclude_groups'] = [random.choice(paths)]
+        if random.uniform() < 0.4:
+            lon = np.sort(random.uniform(0, 360, 2))
+            lat = np.sort(random.uniform(-90, 90, 2))
+            kwargs['bbox'] = (lon[0], lon[1], lat[0], lat[1])
+        if random.uniform() < 0.2:
+            kwargs['radius'] = (random.uniform(0, 360),
+                                random.uniform(-60, 60),
+                                random.uniform(500, 5000))
+        if random.uniform() < 0.4:
+            kwargs['time_range'] = tuple(np.sort(
+                random.choice(times, 2, replace=False)))
+        if random.uniform() < 0.4:
+            kwargs['qc'] = set(random.choice(8, random.randint(1, 4)))
+        queries.append(SubsetQuery(**kwargs))
+    return queries
+
+
+def evaluate(handle, summary, query, cache=None):
+    try:
+        rows = select_rows(handle, query, summary, cache=cache)
+    except SubsetError:
+        return np.arange(0)
+    return np.arange(N_OBS) if rows is None else rows
+
+
+def test_select_rows_matches_brute_force(dataset_file):
+    handle, summary, groups, columns = dataset_file
+    n_empty = 0
+    for query in random_queries(columns):
+        expected = brute_force(query, groups, columns)
+        rows = evaluate(handle, summary, query)
+        assert rows.tolist() == expected.tolist()
+        n_empty += not expected.size
+    # Both empty and non empty subsets are covered
+    assert 0 < n_empty < N_QUERIES
+
+
+def test_cached_select_rows_matches_uncached(dataset_file):
+    handle, summary, _, columns = dataset_file
+    cache = SubsetCache()
+    queries = random_queries(columns, seed=1)
+    # Narrow every query step by step, as the user does
+    for query in queries + [SubsetQuery(
+            query.groups, query.operator, (10, 200, -45, 45),
+            query.time_range, query.qc, query.exclude_groups)
+            for query in queries]:
+        assert evaluate(handle, summary, query, cache).tolist() == \
+            evaluate(handle, summary, query).tolist()
+
+
+def test_and_needs_two_groups():
+    with pytest.raises(SubsetError):
+        SubsetQuery(['/Apple'], 'and').predicates()
+    assert SubsetQuery(['root'], 'or').predicates() == []